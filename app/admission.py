@@ -0,0 +1,129 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from metrics import REGISTRY
+from sender import TokenBucket
+
+
+REPLY = 0  # follow-ups in an existing thread go first
+QUESTION = 1
+
+USER_QUOTA = "user_quota"
+CHAT_QUOTA = "chat_quota"
+OVERLOADED = "overloaded"
+
+
+class AdmissionController:
+    """
+    Admission control in front of answer().
+
+    admit() is checked when a message arrives: it rejects the message if the
+    user or the chat has used up its token bucket, or sheds it early if the
+    expected wait for a free slot exceeds the latency SLO. The wait is
+    estimated from the queue length and a moving average of answer times.
+    slot() then bounds the number of concurrent answers to `max_concurrency`;
+    waiting requests are served by priority (replies first), FIFO within one.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        user_rate: float = 5 / 60,
+        user_burst: float = 3,
+        chat_rate: float = 20 / 60,
+        chat_burst: float = 10,
+        slo: float = 30.0,
+        max_buckets: int = 10000,
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.slo = slo
+        self.max_buckets = max_buckets
+        self.active = 0
+        self.service_time = 5.0  # moving average of the answer time, seconds
+        self._user_buckets: dict[int, TokenBucket] = {}
+        self._chat_buckets: dict[int, TokenBucket] = {}
+        self._waiting: list[tuple[int, int, asyncio.Future[None]]] = []
+        self._counter = itertools.count()
+
+        REGISTRY.gauge("admission_active", "Answers being generated", callback=lambda: self.active)
+        REGISTRY.gauge("admission_queued", "Answers waiting for a slot", callback=lambda: self.queued)
+        REGISTRY.gauge("admission_expected_wait_seconds", "Expected wait of a new request", callback=self.expected_wait)
+        self._wait = REGISTRY.summary("admission_wait_seconds", "Time spent waiting for an answer slot")
+        self._admitted = REGISTRY.counter("admission_admitted", "Requests admitted")
+
+    @property
+    def queued(self) -> int:
+        return sum(not future.done() for _, _, future in self._waiting)
+
+    def expected_wait(self) -> float:
+        if self.active < self.max_concurrency:
+            return 0.0
+        return (self.queued + 1) * self.service_time / self.max_concurrency
+
+    def _bucket(self, buckets: dict[int, TokenBucket], key: int, rate: float, burst: float) -> TokenBucket:
+        if key not in buckets:
+            if len(buckets) >= self.max_buckets:
+                # Full buckets hold no state worth keeping
+                for stale in [k for k, bucket in buckets.items() if bucket.delay(bucket.capacity) == 0]:
+                    del buckets[stale]
+            buckets[key] = TokenBucket(rate, burst)
+        return buckets[key]
+
+    def admit(self, user_id: int, chat_id: int) -> str | None:
+        """None if the request may be answered, otherwise the reason of the rejection"""
+        reason = None
+        if self.expected_wait() > self.slo:
+            reason = OVERLOADED
+        elif not self._bucket(self._user_buckets, user_id, self.user_rate, self.user_burst).try_acquire():
+            reason = USER_QUOTA
+        elif not self._bucket(self._chat_buckets, chat_id, self.chat_rate, self.chat_burst).try_acquire():
+            self._user_buckets[user_id].tokens += 1  # the user is not charged for a rejected request
+            reason = CHAT_QUOTA
+
+        if reason is None:
+            self._admitted.inc()
+        else:
+            REGISTRY.counter("admission_rejected", "Requests rejected", labels={"reason": reason}).inc()
+            logging.info("Request of user %s in chat %s rejected: %s", user_id, chat_id, reason)
+        return reason
+
+    @asynccontextmanager
+    async def slot(self, priority: int = QUESTION) -> AsyncIterator[None]:
+        started = time.perf_counter()
+        if self.active >= self.max_concurrency or self.queued:
+            future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiting, (priority, next(self._counter), future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._release()  # the slot was handed over just as the waiter was cancelled
+                raise
+        else:
+            self.active += 1
+        self._wait.observe(time.perf_counter() - started)
+
+        served = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.service_time = 0.9 * self.service_time + 0.1 * (time.perf_counter() - served)
+            self._release()
+
+    def _release(self) -> None:
+        """Hands the slot over to the first live waiter or frees it"""
+        while self._waiting:
+            _, _, future = heapq.heappop(self._waiting)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
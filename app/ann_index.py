@@ -0,0 +1,269 @@
+import argparse
+import json
+import logging
+import math
+import os
+import time
+from typing import Sequence
+
+import numpy as np
+import numpy.typing as npt
+
+
+IVF_FILE = "ivf.json"
+CENTROIDS_FILE = "ivf_centroids{run}.f32"  # every training run writes its own files, named in the meta file
+LISTS_FILE = "ivf_lists{run}.i32"
+RETRAIN_GROWTH = 4  # centroids are retrained once the index outgrows the training set this many times
+ASSIGN_BATCH = 65536
+
+
+def default_nlist(count: int) -> int:
+    """4 * sqrt(N) lists, but at least ~39 vectors per list to train the centroids on"""
+    return max(1, min(int(4 * math.sqrt(count)), count // 39))
+
+
+def _normalize(matrix: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32)
+
+
+def _assign(vectors: npt.NDArray[np.float32], centroids: npt.NDArray[np.float32]) -> npt.NDArray[np.int32]:
+    """Nearest centroid of every row, computed in batches to bound memory"""
+    lists = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_BATCH):
+        batch = np.asarray(vectors[start : start + ASSIGN_BATCH], dtype=np.float32)
+        lists[start : start + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+    return lists
+
+
+def train_centroids(
+    vectors: npt.NDArray[np.float32], nlist: int, iterations: int = 20, sample: int = 256, seed: int = 0
+) -> npt.NDArray[np.float32]:
+    """Spherical k-means on at most `sample` vectors per list"""
+    rng = np.random.default_rng(seed)
+    count = len(vectors)
+    rows = np.sort(rng.choice(count, min(count, nlist * sample), replace=False))
+    train = _normalize(np.asarray(vectors[rows], dtype=np.float32))
+    centroids = train[rng.choice(len(train), nlist, replace=False)]
+    for _ in range(iterations):
+        lists = np.argmax(train @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, lists, train)
+        empty = ~sums.any(axis=1)
+        sums[empty] = train[rng.choice(len(train), int(empty.sum()))]  # reseed empty lists
+        centroids = _normalize(sums)
+    return centroids
+
+
+def _paths(folder: str, meta: dict[str, int]) -> tuple[str, str]:
+    """Centroids and lists files of the training run in meta; indexes written before runs were numbered use run 0"""
+    run = meta.get("run", 0)
+    suffix = f".{run}" if run else ""
+    return (
+        os.path.join(folder, CENTROIDS_FILE.format(run=suffix)),
+        os.path.join(folder, LISTS_FILE.format(run=suffix)),
+    )
+
+
+def build_ivf_index(folder: str, vectors: npt.NDArray[np.float32], nlist: int | None = None) -> None:
+    """
+    Trains the coarse quantizer and writes the list of every row next to the mmap vector index.
+
+    The centroids and lists go to new files of the next training run and the
+    meta file is switched to them last, so a bot reloading the index never
+    reads a half-written file. The previous run's files are then unlinked.
+    """
+    started = time.perf_counter()
+    previous = IvfIndex.meta(folder)
+    nlist = min(nlist or default_nlist(len(vectors)), max(1, len(vectors)))
+    centroids = train_centroids(vectors, nlist) if len(vectors) else np.zeros((1, vectors.shape[1]), np.float32)
+    meta = {
+        "nlist": len(centroids),
+        "dim": vectors.shape[1],
+        "count": len(vectors),
+        "trained_on": len(vectors),
+        "run": previous.get("run", 0) + 1 if previous else 1,
+    }
+    centroids_path, lists_path = _paths(folder, meta)
+    for path, array in ((centroids_path, centroids), (lists_path, _assign(vectors, centroids))):
+        with open(path, "wb") as f:
+            array.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+    _write_meta(folder, meta)
+    if previous is not None:
+        for path in _paths(folder, previous):
+            if os.path.exists(path):
+                os.remove(path)
+    logging.info(
+        "IVF index written to %s: %s lists over %s vectors in %.1f s",
+        folder,
+        len(centroids),
+        len(vectors),
+        time.perf_counter() - started,
+    )
+
+
+def update_ivf_index(folder: str, vectors: npt.NDArray[np.float32], nlist: int | None = None) -> None:
+    """
+    Assigns rows appended to the vector index since the last update to the
+    existing lists. Retrains from scratch when there is no IVF index yet, the
+    dimension changed, or the index grew RETRAIN_GROWTH times since training.
+    """
+    meta = IvfIndex.meta(folder)
+    if (
+        meta is None
+        or meta["dim"] != vectors.shape[1]
+        or meta["count"] > len(vectors)
+        or len(vectors) > RETRAIN_GROWTH * max(meta["trained_on"], 1)
+        or (nlist and min(nlist, len(vectors)) != meta["nlist"])
+    ):
+        build_ivf_index(folder, vectors, nlist)
+        return
+    if meta["count"] == len(vectors):
+        return
+    centroids_path, lists_path = _paths(folder, meta)
+    centroids = np.fromfile(centroids_path, dtype=np.float32).reshape(meta["nlist"], -1)
+    lists = _assign(vectors[meta["count"] :], centroids)
+    # Append-only: bots read the first meta["count"] rows, which are left untouched
+    with open(lists_path, "r+b") as f:
+        f.truncate(meta["count"] * 4)  # drop rows left by an interrupted update
+        f.seek(0, os.SEEK_END)
+        f.write(lists.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    _write_meta(folder, {**meta, "count": len(vectors)})
+    logging.info("IVF index in %s: %s rows assigned to existing lists", folder, len(lists))
+
+
+def _write_meta(folder: str, meta: dict[str, int]) -> None:
+    tmp_path = os.path.join(folder, f"{IVF_FILE}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(folder, IVF_FILE))
+
+
+class IvfIndex:
+    """
+    Inverted-file ANN search over the memory-mapped vector matrix.
+
+    Only the `nprobe` lists whose centroids are closest to the query are
+    scanned exactly, so a query touches about nprobe / nlist of the vectors.
+    More probes give higher recall and higher latency. Rows added to the
+    vector index after the IVF files were written are assigned on load.
+    """
+
+    def __init__(self, folder: str, vectors: npt.NDArray[np.float32], nprobe: int = 8) -> None:
+        meta = self.meta(folder)
+        if meta is None:
+            raise FileNotFoundError(os.path.join(folder, IVF_FILE))
+        self.vectors = vectors
+        self.nprobe = nprobe
+        self.nlist: int = meta["nlist"]
+        centroids_path, lists_path = _paths(folder, meta)
+        self.centroids = np.fromfile(centroids_path, dtype=np.float32).reshape(self.nlist, -1)
+        lists = np.fromfile(lists_path, dtype=np.int32, count=min(meta["count"], len(vectors)))
+        if len(lists) < len(vectors):
+            lists = np.concatenate([lists, _assign(vectors[len(lists) :], self.centroids)])
+        self._order = np.argsort(lists, kind="stable").astype(np.int32)
+        self._indptr = np.searchsorted(lists[self._order], np.arange(self.nlist + 1))
+
+    @staticmethod
+    def meta(folder: str) -> dict[str, int] | None:
+        path = os.path.join(folder, IVF_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            meta: dict[str, int] = json.load(f)
+        return meta
+
+    def search(
+        self, query: Sequence[float] | npt.NDArray[np.float32], top_k: int, nprobe: int | None = None
+    ) -> list[tuple[int, float]]:
+        """Returns (row, cosine similarity) pairs of the approximate top_k, best first"""
+        if top_k <= 0 or not len(self.vectors):
+            return []
+        q = _normalize(np.asarray(query, dtype=np.float32))
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        probe = np.argpartition(self.centroids @ q, -nprobe)[-nprobe:]
+        candidates = np.sort(np.concatenate([self._order[self._indptr[c] : self._indptr[c + 1]] for c in probe]))
+        if not len(candidates):
+            return []
+        scores = self.vectors[candidates] @ q
+        top_k = min(top_k, len(candidates))
+        best = np.argpartition(scores, -top_k)[-top_k:]
+        best = best[np.argsort(scores[best])[::-1]]
+        return [(int(candidates[i]), float(scores[i])) for i in best]
+
+
+def measure_recall(
+    vectors: npt.NDArray[np.float32],
+    index: IvfIndex,
+    nprobes: Sequence[int],
+    top_k: int = 10,
+    queries: Sequence[Sequence[float]] | None = None,
+    sample_size: int = 200,
+    noise: float = 0.05,
+    seed: int = 0,
+) -> list[dict[str, float]]:
+    """
+    recall@top_k of the IVF search against the exact search and mean latencies.
+    Without queries, `sample_size` stored vectors with gaussian noise are used,
+    so the queries do not coincide with a row.
+    """
+    if queries is None:
+        rng = np.random.default_rng(seed)
+        rows = rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)
+        sample = np.asarray(vectors[np.sort(rows)], dtype=np.float32)
+        sample = _normalize(sample + rng.normal(0, noise, sample.shape).astype(np.float32))
+    else:
+        sample = _normalize(np.asarray(queries, dtype=np.float32))
+
+    started = time.perf_counter()
+    exact = []
+    for q in sample:
+        scores = vectors @ q
+        k = min(top_k, len(scores))
+        exact.append(set(np.argpartition(scores, -k)[-k:].tolist()))
+    exact_ms = (time.perf_counter() - started) * 1000 / len(sample)
+
+    results = []
+    for nprobe in nprobes:
+        started = time.perf_counter()
+        found = [{row for row, _ in index.search(q, top_k, nprobe)} for q in sample]
+        results.append(
+            {
+                "nprobe": nprobe,
+                f"recall@{top_k}": sum(len(f & e) / len(e) for f, e in zip(found, exact)) / len(sample),
+                "latency_ms": (time.perf_counter() - started) * 1000 / len(sample),
+                "exact_latency_ms": exact_ms,
+            }
+        )
+    return results
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Build the IVF index and measure its recall against exact search")
+    arg_parser.add_argument("mmap_folder", nargs="?", default="data/index_mmap_1024")
+    arg_parser.add_argument("--nlist", type=int, help="number of lists, 4 * sqrt(N) by default")
+    arg_parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    arg_parser.add_argument("--top-k", type=int, default=10)
+    arg_parser.add_argument("--rebuild", action="store_true")
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(module)s: %(message)s")
+
+    from vector_store import MmapVectorStore
+
+    matrix = MmapVectorStore(args.mmap_folder).vectors
+    if args.rebuild:
+        build_ivf_index(args.mmap_folder, matrix, args.nlist)
+    else:
+        update_ivf_index(args.mmap_folder, matrix, args.nlist)
+    ivf = IvfIndex(args.mmap_folder, matrix)
+    print(f"{len(matrix)} vectors, {ivf.nlist} lists")
+    for row in measure_recall(matrix, ivf, args.nprobe, args.top_k):
+        print(
+            f"nprobe={row['nprobe']:<4} recall@{args.top_k}={row[f'recall@{args.top_k}']:.3f} "
+            f"ivf={row['latency_ms']:.3f} ms exact={row['exact_latency_ms']:.3f} ms"
+        )
@@ -0,0 +1,205 @@
+import logging
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Sequence
+
+import numpy as np
+import numpy.typing as npt
+
+
+_spaces_regex = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    """Key of the exact-text fast path: case, spacing and trailing punctuation are ignored"""
+    return _spaces_regex.sub(" ", text.lower()).strip(" ?!.,")
+
+
+@dataclass()
+class _Entry:
+    text: str
+    embedding: npt.NDArray[np.float32]
+    answer: str
+    created_at: float
+    last_access: float
+
+
+class AnswerCache:
+    """
+    Semantic cache of generated answers backed by SQLite.
+
+    A lookup first tries the normalized query text, then the nearest cached
+    query embedding above the cosine similarity threshold. Entries expire
+    after ttl seconds, the least recently used ones are evicted above
+    max_entries, and everything is dropped when the index version changes.
+
+    Hits only update the access time in memory; the times are written to
+    SQLite in one batch with the next put(), at most every flush_interval
+    seconds otherwise, and on flush().
+    """
+
+    def __init__(
+        self,
+        path: str,
+        index_version: str,
+        threshold: float = 0.95,
+        max_entries: int = 1000,
+        ttl: float = 7 * 24 * 3600,
+        flush_interval: float = 60.0,
+    ) -> None:
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.hits_exact = 0
+        self.hits_semantic = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS answers (
+                text TEXT PRIMARY KEY,
+                embedding BLOB NOT NULL,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            """
+        )
+        self._entries: dict[str, _Entry] = {}
+        self._touched: set[str] = set()
+        self._flushed_at = time.monotonic()
+        self._matrix: npt.NDArray[np.float32] | None = None
+        self._keys: list[str] = []
+        self.index_version = ""
+        self._load()
+        self.ensure_version(index_version)
+
+    def _load(self) -> None:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'index_version'").fetchone()
+        self.index_version = row[0] if row else ""
+        for text, embedding, answer, created_at, last_access in self._conn.execute(
+            "SELECT text, embedding, answer, created_at, last_access FROM answers"
+        ):
+            self._entries[text] = _Entry(
+                text, np.frombuffer(embedding, dtype=np.float32), answer, created_at, last_access
+            )
+        self._matrix = None
+
+    def ensure_version(self, index_version: str) -> None:
+        """Drops all answers produced against another index version"""
+        if index_version == self.index_version:
+            return
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM answers")
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('index_version', ?)", (index_version,))
+            self._entries.clear()
+            self._touched.clear()
+            self._matrix = None
+            self.index_version = index_version
+        logging.info("Answer cache cleared for index version %s", index_version)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits_exact + self.hits_semantic + self.misses
+        return (self.hits_exact + self.hits_semantic) / total if total else 0.0
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "entries": len(self._entries),
+            "hits_exact": self.hits_exact,
+            "hits_semantic": self.hits_semantic,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+        }
+
+    def _touch(self, entry: _Entry) -> str | None:
+        now = time.time()
+        if now - entry.created_at > self.ttl:
+            self._delete([entry.text])
+            return None
+        entry.last_access = now
+        self._touched.add(entry.text)
+        if time.monotonic() - self._flushed_at > self.flush_interval:
+            with self._conn:
+                self._write_touches()
+        return entry.answer
+
+    def _write_touches(self) -> None:
+        """Access times of the hits since the last write; runs inside the caller's transaction"""
+        touched = [(self._entries[key].last_access, key) for key in self._touched if key in self._entries]
+        self._conn.executemany("UPDATE answers SET last_access = ? WHERE text = ?", touched)
+        self._touched.clear()
+        self._flushed_at = time.monotonic()
+
+    def flush(self) -> None:
+        with self._lock, self._conn:
+            self._write_touches()
+
+    def _delete(self, keys: Sequence[str]) -> None:
+        with self._conn:
+            self._conn.executemany("DELETE FROM answers WHERE text = ?", [(k,) for k in keys])
+        for key in keys:
+            self._entries.pop(key, None)
+        self._matrix = None
+
+    def get_exact(self, query: str) -> str | None:
+        """Fast path that needs no embedding. A miss here is not counted, get_similar follows it"""
+        with self._lock:
+            entry = self._entries.get(normalize_query(query))
+            answer = self._touch(entry) if entry else None
+            if answer is not None:
+                self.hits_exact += 1
+            return answer
+
+    def get_similar(self, embedding: Sequence[float]) -> str | None:
+        with self._lock:
+            answer = None
+            if self._entries:
+                if self._matrix is None:
+                    self._keys = list(self._entries)
+                    self._matrix = np.stack([self._entries[k].embedding for k in self._keys])
+                q = np.asarray(embedding, dtype=np.float32)
+                scores = self._matrix @ (q / (np.linalg.norm(q) or 1.0))
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    answer = self._touch(self._entries[self._keys[best]])
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits_semantic += 1
+            return answer
+
+    def put(self, query: str, embedding: Sequence[float], answer: str) -> None:
+        key = normalize_query(query)
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)",
+                    (key, vector.tobytes(), answer, now, now),
+                )
+                self._touched.discard(key)
+                self._write_touches()
+            self._entries[key] = _Entry(key, vector, answer, now, now)
+            self._matrix = None
+            self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        expired = [k for k, e in self._entries.items() if now - e.created_at > self.ttl]
+        overflow = len(self._entries) - len(expired) - self.max_entries
+        if overflow > 0:
+            alive = sorted(
+                (e for e in self._entries.values() if now - e.created_at <= self.ttl), key=lambda e: e.last_access
+            )
+            expired.extend(e.text for e in alive[:overflow])
+        if expired:
+            self._delete(expired)
@@ -2,27 +2,75 @@ import asyncio
 import logging
 import os
 import re
+import time
+import weakref
+from dataclasses import dataclass
+from dataclasses import replace
 from logging.handlers import RotatingFileHandler
-
-import httpx
-import openai
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Callable
+from typing import Hashable
+
+from admission import OVERLOADED
+from admission import QUESTION
+from admission import REPLY
+from admission import AdmissionController
 from aiogram import Bot
 from aiogram import Dispatcher
 from aiogram import executor
 from aiogram import types
-from custom_embedding import OpenAIEmbeddingProxy
+from ann_index import IvfIndex
+from answer_cache import AnswerCache
+from answer_cache import normalize_query
+from context_packer import ContextSpan
+from context_packer import pack_context
 from dotenv import load_dotenv
-from llama_index import ServiceContext
-from llama_index import StorageContext
-from llama_index import load_index_from_storage
-from openai import AsyncOpenAI
-
+from lexical_index import LexicalIndex
+from lexical_index import reciprocal_rank_fusion
+from metrics import REGISTRY
+from metrics import start_metrics_server
+from quantization import QuantizedIndex
+from relevance import RelevanceGate
+from reranker import Reranker
+from sender import MessageSender
+from sender import SharedTokenBucket
+from single_flight import SingleFlight
+from startup import StartupProfile
+from startup import current_rss_mb
+from startup import process_age
+from streaming import StreamingReply
+from telegram_html import escape_html
+from tokens import count_tokens
+from tracing import Tracer
+from tracing import add_tokens
+from tracing import span
+from vector_store import MANIFEST_FILE
+from vector_store import MmapQueryEngine
+from vector_store import MmapVectorStore
+from vector_store import SourceNode
+from vector_store import convert_json_index
+from vector_store import read_generation
+from work_queue import QueueWorker
+from work_queue import WorkQueue
+
+
+# Тяжелые модули (openai, llama_index, nltk, pymystem3) импортируются в фоне при загрузке индекса
+if TYPE_CHECKING:
+    import httpx
+    from custom_embedding import EmbeddingCache
+    from custom_embedding import OpenAIEmbeddingProxy
+    from http_clients import HttpClientConfig
+    from openai import AsyncOpenAI
+
+startup_profile = StartupProfile()
+startup_profile.record("imports", process_age() or 0.0)
 
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(module)s: %(message)s",
     handlers=[
-        RotatingFileHandler("app/logs/app.log", maxBytes=5_000_000, backupCount=2),
+        RotatingFileHandler(os.getenv("LOG_FILE", "app/logs/app.log"), maxBytes=5_000_000, backupCount=2),
         logging.StreamHandler(),
     ],
 )
@@ -32,56 +80,368 @@ load_dotenv()
 TOKEN = os.getenv("TG_TOKEN")
 BOT_ID_ = os.getenv("BOT_ID")
 BOT_ID = int(BOT_ID_) if BOT_ID_ else None
-PROXY = os.getenv("PROXY")
 
 MODEL_NAME = "gpt-4o-mini"
+JSON_INDEX_DIR = "data/index_storage_1024"
+MMAP_INDEX_DIR = os.getenv("MMAP_INDEX_DIR", "data/index_mmap_1024")
+SIMILARITY_TOP_K = 3
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"  # BM25 + векторный поиск с RRF
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "10"))  # кандидатов от каждого ретривера
+RERANK = os.getenv("RERANK", "1") == "1"  # реранк расширенной выдачи смесью косинуса и BM25
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "30"))  # кандидатов от каждого ретривера для реранка
+RERANK_TOP_K = int(os.getenv("RERANK_TOP_K", "5"))  # максимум чанков после реранка
+RERANK_VECTOR_WEIGHT = float(os.getenv("RERANK_VECTOR_WEIGHT", "0.6"))  # вес косинуса, остальное - BM25
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "50"))  # дольше - реранк пропускается
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2500"))  # токенов контекста в промпте (tiktoken)
+VECTOR_SEARCH = os.getenv("VECTOR_SEARCH", "exact")  # exact | ivf | int8 (коды пишет пайплайн)
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "8"))  # списков IVF, просматриваемых на запрос
+INT8_RESCORE = int(os.getenv("INT8_RESCORE", "4"))  # кандидатов на top_k, пересчитываемых по float-векторам, 0 - выкл.
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "data/answer_cache.sqlite3")
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(7 * 24 * 3600)))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "data/embedding_cache.sqlite3")
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))  # эмбеддингов в памяти (LRU)
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", str(20 / 60)))  # сообщений в секунду в один чат
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))  # сообщений в секунду во все чаты
+STREAM_ANSWERS = os.getenv("STREAM_ANSWERS", "0") == "1"  # выводить ответ по мере генерации
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))  # секунд между правками сообщения
+JUDGE_MODE = os.getenv("JUDGE_MODE", "sequential")  # sequential | speculative | score
+JUDGE_SCORE_THRESHOLD = float(os.getenv("JUDGE_SCORE_THRESHOLD", "0.8"))
+JUDGE_AUDIT_RATE = float(os.getenv("JUDGE_AUDIT_RATE", "0.1"))  # доля запросов, проверяемых LLM в режиме score
+JUDGE_CALIBRATION_LOG = os.getenv("JUDGE_CALIBRATION_LOG", "data/judge_calibration.jsonl")
+METRICS_PORT_ = os.getenv("METRICS_PORT")
+METRICS_PORT = int(METRICS_PORT_) if METRICS_PORT_ else None
+TRACE_LOG = os.getenv("TRACE_LOG")  # JSONL-файл с таймингами этапов каждого ответа
+MAX_CONCURRENT_ANSWERS = int(os.getenv("MAX_CONCURRENT_ANSWERS", "8"))  # ответов, генерируемых одновременно
+ANSWER_SLO = float(os.getenv("ANSWER_SLO", "30"))  # при большем ожидаемом ожидании запрос сразу отклоняется
+USER_QUESTION_RATE = float(os.getenv("USER_QUESTION_RATE", str(5 / 60)))  # вопросов в секунду от пользователя
+USER_QUESTION_BURST = float(os.getenv("USER_QUESTION_BURST", "3"))
+CHAT_QUESTION_RATE = float(os.getenv("CHAT_QUESTION_RATE", str(20 / 60)))  # вопросов в секунду из одного чата
+CHAT_QUESTION_BURST = float(os.getenv("CHAT_QUESTION_BURST", "10"))
+INDEX_RELOAD_INTERVAL = float(
+    os.getenv("INDEX_RELOAD_INTERVAL", "30")
+)  # секунд между проверками нового индекса, 0 - выкл.
+STARTUP_TARGET = float(os.getenv("STARTUP_TARGET", "3"))  # секунд от запуска процесса до приема апдейтов
+JUDGE_TIMEOUT = float(os.getenv("JUDGE_TIMEOUT", "20"))  # секунд ожидания ответа судьи (read timeout)
+GENERATION_TIMEOUT = float(os.getenv("GENERATION_TIMEOUT", "60"))  # секунд между чанками генерации (read timeout)
+WARMUP_WAIT = float(os.getenv("WARMUP_WAIT", "10"))  # столько вопрос ждет загрузки индекса до ответа-заглушки
+WORKER_ID_ = os.getenv("WORKER_ID")
+WORKER_ID = int(WORKER_ID_) if WORKER_ID_ else None  # задается app/webhook.py: воркер берет апдейты из очереди
+WORK_QUEUE_PATH = os.getenv("WORK_QUEUE_PATH", "data/work_queue.sqlite3")
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "16"))  # апдейтов в обработке на воркер
+
+
+@dataclass(frozen=True)
+class SearchIndex:
+    generation: int  # номер поколения индекса, опубликованный пайплайном
+    vector_store: MmapVectorStore
+    query_engine: MmapQueryEngine
+    lexical_index: LexicalIndex | None
+    reranker: Reranker | None
+
+
+@dataclass(frozen=True)
+class Services:
+    """Everything answer() needs that is slow to import or load, built by warm_up()"""
+
+    client: "AsyncOpenAI"
+    http_config: "HttpClientConfig"
+    embedding_cache: "EmbeddingCache"
+    embed_model: "OpenAIEmbeddingProxy"
+    answer_cache: AnswerCache
+    index: SearchIndex
+
+
+def side_index_usable(name: str, meta: dict[str, int] | None, vector_store: MmapVectorStore) -> bool:
+    """Whether the IVF or int8 files written by the pipeline match the vector index"""
+    if meta is not None and meta["dim"] == vector_store.vectors.shape[1] and meta["count"] <= vector_store.count:
+        return True
+    logging.warning("No %s index for the vectors in %s, using exact search", name, MMAP_INDEX_DIR)
+    return False
+
+
+def load_search_index(embed_model: "OpenAIEmbeddingProxy", profile: StartupProfile) -> SearchIndex:
+    # Read first: a generation published while loading is picked up by the next reload
+    generation = read_generation(MMAP_INDEX_DIR)
+    with profile.phase("vector_store"):
+        if not os.path.exists(os.path.join(MMAP_INDEX_DIR, MANIFEST_FILE)):
+            logging.info("Converting JSON index %s to %s", JSON_INDEX_DIR, MMAP_INDEX_DIR)
+            convert_json_index(JSON_INDEX_DIR, MMAP_INDEX_DIR)
+        vector_store = MmapVectorStore(MMAP_INDEX_DIR)
+
+    # The bot only reads the index folder: the pipeline is its single writer, and rows it appended
+    # after a side index was written are assigned or quantized in memory on load
+    searcher: IvfIndex | QuantizedIndex | None = None
+    if VECTOR_SEARCH == "ivf":
+        with profile.phase("ivf_index"):
+            if side_index_usable("IVF", IvfIndex.meta(MMAP_INDEX_DIR), vector_store):
+                searcher = IvfIndex(MMAP_INDEX_DIR, vector_store.vectors, nprobe=IVF_NPROBE)
+    elif VECTOR_SEARCH == "int8":
+        with profile.phase("int8_codes"):
+            if side_index_usable("int8", QuantizedIndex.meta(MMAP_INDEX_DIR), vector_store):
+                searcher = QuantizedIndex(MMAP_INDEX_DIR, vector_store.vectors, rescore=INT8_RESCORE)
+    elif VECTOR_SEARCH != "exact":
+        raise ValueError(f"Unknown VECTOR_SEARCH {VECTOR_SEARCH!r}, expected exact, ivf or int8")
+
+    query_engine = MmapQueryEngine(vector_store, embed_model, similarity_top_k=SIMILARITY_TOP_K, searcher=searcher)
+
+    lexical_index: LexicalIndex | None = None
+    if HYBRID_SEARCH:
+        with profile.phase("lexical_index"):
+            from utils import tokenize_batch
+
+            if LexicalIndex.exists(MMAP_INDEX_DIR):
+                try:
+                    lexical_index = LexicalIndex(MMAP_INDEX_DIR)
+                except ValueError:
+                    logging.warning("Lexical index in %s is being rewritten", MMAP_INDEX_DIR)
+            if lexical_index is None or lexical_index.count != vector_store.count:
+                # Missing, being rewritten, or left over from a previous version of the vector index
+                logging.warning(
+                    "No lexical index for the %s vectors in %s, building it in memory",
+                    vector_store.count,
+                    MMAP_INDEX_DIR,
+                )
+                lexical_index = LexicalIndex.from_docs(
+                    tokenize_batch([record["text"] for record in vector_store.records()])
+                )
+
+    reranker: Reranker | None = None
+    if RERANK:
+        reranker = Reranker(
+            vector_store.vectors, lexical_index, vector_weight=RERANK_VECTOR_WEIGHT, budget=RERANK_BUDGET_MS / 1000
+        )
+    return SearchIndex(generation, vector_store, query_engine, lexical_index, reranker)
+
+
+def load_services() -> Services:
+    """Imports the heavy modules and loads the index; blocking, runs in a thread"""
+    with startup_profile.phase("import_clients"):
+        from custom_embedding import EmbeddingCache
+        from custom_embedding import OpenAIEmbeddingProxy
+        from http_clients import HttpClientConfig
+        from http_clients import PoolStats
+        from http_clients import create_async_client
+        from openai import AsyncOpenAI
+
+    with startup_profile.phase("clients"):
+        http_config = HttpClientConfig.from_env()
+        pool_stats = PoolStats()
+        http_client = create_async_client(http_config, pool_stats)
+        client = AsyncOpenAI(http_client=http_client, timeout=http_config.timeout())
+        embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, memory_size=EMBEDDING_CACHE_SIZE)
+        embed_model = OpenAIEmbeddingProxy(
+            http_client=http_client, timeout=http_config.read_timeout, cache=embedding_cache
+        )
+    REGISTRY.gauge("http_requests", "Requests sent to the OpenAI API", callback=lambda: pool_stats.requests)
+    REGISTRY.gauge(
+        "http_connections_opened",
+        "Connections opened, the other requests reused a kept-alive one",
+        callback=lambda: pool_stats.connections_opened,
+    )
+    REGISTRY.gauge(
+        "http_connection_reuse_rate", "Share of requests on a reused connection", callback=lambda: pool_stats.reuse_rate
+    )
+    REGISTRY.gauge(
+        "http_pool_wait_seconds_total",
+        "Time spent waiting for a pooled connection",
+        callback=lambda: pool_stats.pool_wait_seconds,
+    )
+    REGISTRY.gauge(
+        "http_pool_wait_max_seconds", "Longest wait for a pooled connection", callback=lambda: pool_stats.max_pool_wait
+    )
+    REGISTRY.gauge(
+        "http_pool_timeouts", "Requests that timed out waiting for the pool", callback=lambda: pool_stats.pool_timeouts
+    )
+    REGISTRY.gauge("embedding_cache_hits", "Texts embedded from the cache", callback=lambda: embedding_cache.hits)
+    REGISTRY.gauge("embedding_cache_misses", "Texts sent to the embedding API", callback=lambda: embedding_cache.misses)
+    REGISTRY.gauge(
+        "embedding_cache_saved_seconds",
+        "Estimated embedding API time saved by the cache",
+        callback=lambda: embedding_cache.time_saved,
+    )
 
-logging.info("Initialization has started")
+    index = load_search_index(embed_model, startup_profile)
 
-http_client = httpx.AsyncClient(proxies=PROXY)
-client = AsyncOpenAI(http_client=http_client)
+    with startup_profile.phase("answer_cache"):
+        answer_cache = AnswerCache(
+            ANSWER_CACHE_PATH,
+            index_version=index.vector_store.version,
+            threshold=ANSWER_CACHE_THRESHOLD,
+            max_entries=ANSWER_CACHE_SIZE,
+            ttl=ANSWER_CACHE_TTL,
+        )
 
-embed_model = OpenAIEmbeddingProxy(http_client=http_client)
-service_context = ServiceContext.from_defaults(embed_model=embed_model)
+    with startup_profile.phase("import_tokenizers"):
+        import tokens
+        import utils
 
-storage_context = StorageContext.from_defaults(persist_dir="data/index_storage_1024")
+        tokens.count_tokens("")  # loads the tiktoken encoding
+        utils.lemmatizer.start()
+    return Services(client, http_config, embedding_cache, embed_model, answer_cache, index)
 
-index = load_index_from_storage(
-    storage_context,
-    service_context=service_context,
+
+services: Services | None = None
+ready = asyncio.Event()
+load_failed = False
+index_watch_task: asyncio.Task[None] | None = None
+
+
+def reranker_stat(name: str) -> float:
+    reranker = services.index.reranker if services else None
+    return float(getattr(reranker, name)) if reranker else 0.0
+
+
+# Колбэки читают текущий индекс: после перезагрузки метрики не держат старый индекс в памяти
+REGISTRY.gauge("rerank_cache_hits", "Queries served from the rerank cache", callback=lambda: reranker_stat("hits"))
+REGISTRY.gauge(
+    "rerank_over_budget", "Rerankings skipped over the latency budget", callback=lambda: reranker_stat("over_budget")
 )
+REGISTRY.gauge(
+    "index_generation", "Generation of the served index", callback=lambda: services.index.generation if services else 0
+)
+
+
+async def warm_up() -> None:
+    """Loads the services in a thread while the bot already accepts updates"""
+    global services, load_failed
+    started = time.perf_counter()
+    try:
+        services = await asyncio.get_running_loop().run_in_executor(None, load_services)
+    except Exception:
+        load_failed = True
+        logging.exception("Failed to load the index")
+        raise
+    startup_profile.record("warm_up", time.perf_counter() - started)
+    ready.set()
+    startup_profile.report("Index is loaded")
+    if INDEX_RELOAD_INTERVAL > 0:
+        global index_watch_task
+        index_watch_task = asyncio.create_task(watch_index())
+
+
+async def watch_index() -> None:
+    """Reloads the index whenever the pipeline publishes a newer generation"""
+    while True:
+        await asyncio.sleep(INDEX_RELOAD_INTERVAL)
+        assert services is not None
+        try:
+            if read_generation(MMAP_INDEX_DIR) > services.index.generation:
+                await reload_index()
+        except Exception:
+            logging.exception("Failed to reload the index, the previous version is kept")
+
+
+async def reload_index() -> None:
+    """
+    Loads the new index version in a thread and swaps it in with one assignment.
+    Requests in flight keep the Services object they started with and finish on
+    the old version, whose memory is released once the last of them completes.
+    """
+    global services
+    assert services is not None
+    old = services
+    rss_before = current_rss_mb()
+    profile = StartupProfile("index_reload_phase_seconds")
+    started = time.perf_counter()
+    index = await asyncio.get_running_loop().run_in_executor(None, load_search_index, old.embed_model, profile)
+    rss_loaded = current_rss_mb()
+
+    swap_started = time.perf_counter()
+    services = replace(old, index=index)
+    old.answer_cache.ensure_version(index.vector_store.version)
+    swapped = time.perf_counter()
+
+    def released(generation: int) -> None:
+        logging.info(
+            "Index generation %s released %.1f s after the swap, RSS %s MB",
+            generation,
+            time.perf_counter() - swapped,
+            current_rss_mb(),
+        )
 
-query_engine = index.as_query_engine(
-    similarity_top_k=3,
-    response_mode="no_text",
-    include_text=True,
+    weakref.finalize(old.index.vector_store, released, old.index.generation)
+    del old
+    logging.info(
+        "Index generation %s (%s vectors) loaded in %.2f s (%s), swapped in %.1f ms; "
+        "RSS %s MB before loading, %s MB with both versions",
+        index.generation,
+        index.vector_store.count,
+        swapped - started,
+        profile.breakdown(),
+        (swapped - swap_started) * 1000,
+        rss_before,
+        rss_loaded,
+    )
+
+
+relevance_gate = RelevanceGate(
+    JUDGE_MODE,
+    threshold=JUDGE_SCORE_THRESHOLD,
+    audit_rate=JUDGE_AUDIT_RATE,
+    calibration_path=JUDGE_CALIBRATION_LOG,
 )
 
-logging.info("Initialization is complete")
+tracer = Tracer(TRACE_LOG)
 
+admission = AdmissionController(
+    max_concurrency=MAX_CONCURRENT_ANSWERS,
+    user_rate=USER_QUESTION_RATE,
+    user_burst=USER_QUESTION_BURST,
+    chat_rate=CHAT_QUESTION_RATE,
+    chat_burst=CHAT_QUESTION_BURST,
+    slo=ANSWER_SLO,
+)
+
+single_flight: SingleFlight[str] = SingleFlight()
+REGISTRY.gauge(
+    "answers_coalesced",
+    "Questions answered by an identical in-flight request",
+    callback=lambda: single_flight.coalesced,
+)
+REGISTRY.gauge("answers_in_flight", "Distinct questions being answered", callback=lambda: single_flight.in_flight)
 
 bot = Bot(token=TOKEN)
 dp = Dispatcher(bot)
 
-message_queue: asyncio.Queue[tuple[int, str]] = asyncio.Queue()
+sender = MessageSender(
+    bot,
+    chat_rate=SEND_CHAT_RATE,
+    chat_burst=SEND_CHAT_BURST,
+    global_rate=SEND_GLOBAL_RATE,
+    global_burst=SEND_GLOBAL_RATE,
+    # Воркеры webhook-режима делят общий лимит Telegram через базу очереди
+    global_bucket=(
+        SharedTokenBucket(WORK_QUEUE_PATH, "telegram", SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+        if WORKER_ID is not None
+        else None
+    ),
+)
 
 retrival_query_regex = re.compile(r"Вопрос: (.*?)\n\n", re.DOTALL)
 message_regex = re.compile(r'@rag_youtube_itmo_bot[,\s]*')
+NO_INFORMATION = "<b>Ответ:</b> В базе знаний нет информации по этому вопросу."
+NO_RELEVANT_INFORMATION = "<b>Ответ:</b> В базе знаний нет релевантной информации для ответа на этот вопрос."
 
 
-def escape_html(text: str) -> str:
-    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+warm_up_task: asyncio.Task[None] | None = None
 
 
-async def message_worker() -> None:
-    while True:
-        chat_id, text = await message_queue.get()
-        await bot.send_message(chat_id, text, parse_mode="HTML")
-        await asyncio.sleep(6)
+async def on_startup(_: Dispatcher) -> None:
+    global warm_up_task
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_PORT)
+    if WORKER_ID is None:
+        warm_up_task = asyncio.create_task(warm_up())
+        startup_profile.report("Polling started", STARTUP_TARGET)
 
 
-async def on_startup(_: Dispatcher) -> None:
-    asyncio.create_task(message_worker())
+async def on_shutdown(_: Dispatcher) -> None:
+    if services is not None:
+        services.answer_cache.flush()
+    relevance_gate.flush()
 
 
 async def keep_typing(chat_id: int, interval: int = 5) -> None:
@@ -93,7 +453,7 @@ async def keep_typing(chat_id: int, interval: int = 5) -> None:
 # -------------------- core logic --------------------
 
 
-async def llm_context_judge(context: str, question: str) -> bool:
+async def llm_context_judge(client: "AsyncOpenAI", context: str, question: str, http_timeout: "httpx.Timeout") -> bool:
     """
     LLM: отвечает, содержит ли контекст
     ДОСТАТОЧНУЮ информацию для ответа на вопрос.
@@ -112,46 +472,168 @@ async def llm_context_judge(context: str, question: str) -> bool:
 
         Ответь строго одним словом: YES или NO.
         """
-    resp = await client.chat.completions.create(
-        model=MODEL_NAME,
-        temperature=0,
-        messages=[{"role": "user", "content": prompt}],
-    )
+    with span("judge"):
+        resp = await client.chat.completions.create(
+            model=MODEL_NAME,
+            temperature=0,
+            messages=[{"role": "user", "content": prompt}],
+            timeout=http_timeout,
+        )
+    if resp.usage:
+        add_tokens("judge_prompt", resp.usage.prompt_tokens)
+        add_tokens("judge_completion", resp.usage.completion_tokens)
     x: str = resp.choices[0].message.content.strip()
     return x == "YES"
 
 
-async def answer(user_message: str, reply_to_message: str | None = None) -> str:
-    # ---------- retrieval ----------
-    if reply_to_message:
-        retrival_query = retrival_query_regex.findall(reply_to_message)[0] + user_message
-    else:
-        retrival_query = user_message
+def retrieval_query(user_message: str, reply_to_message: str | None = None) -> str:
+    if not reply_to_message:
+        return user_message
+    question: str = retrival_query_regex.findall(reply_to_message)[0]
+    return question + user_message
 
-    retrival = await query_engine.aquery(retrival_query)
 
-    source_nodes = retrival.source_nodes
+def flight_key(user_message: str, reply_to_message: str | None = None, fresh: bool = False) -> Hashable:
+    """Questions with the same key share one answer in flight"""
+    return normalize_query(retrieval_query(user_message, reply_to_message)), normalize_query(user_message), fresh
 
-    for i, node in enumerate(source_nodes, 1):
-        logging.info("%s node: %s", i, node.text)
 
-    if not source_nodes:
-        return (
-            f"<b>Вопрос:</b> <i>{escape_html(user_message)}</i>\n\n"
-            f"<b>Ответ:</b> В базе знаний нет информации по этому вопросу."
+async def answer(
+    user_message: str,
+    reply_to_message: str | None = None,
+    on_delta: Callable[[str], None] | None = None,
+    fresh: bool = False,
+) -> str:
+    """
+    Answers the question as HTML. If on_delta is given, the generation is streamed
+    and on_delta receives the whole message-so-far after every received chunk.
+    Identical questions asked while one is being answered share its answer,
+    which takes one slot of the admission controller. With fresh the answer cache
+    is not read, only updated. Requires warm_up().
+    """
+    loaded = services
+    assert loaded is not None, "answer() before warm_up()"
+    retrival_query = retrieval_query(user_message, reply_to_message)
+
+    async def admitted(publish: Callable[[str], None] | None) -> str:
+        async with admission.slot(REPLY if reply_to_message else QUESTION):
+            return await answer_text(loaded, user_message, retrival_query, publish, fresh)
+
+    header = f"<b>Вопрос:</b> <i>{escape_html(user_message)}</i>\n\n"
+    body: str = await single_flight.run(
+        flight_key(user_message, reply_to_message, fresh),
+        admitted,
+        on_delta=(lambda partial: on_delta(header + partial)) if on_delta else None,
+    )
+    return header + body
+
+
+async def answer_text(
+    loaded: Services,
+    user_message: str,
+    retrival_query: str,
+    on_delta: Callable[[str], None] | None = None,
+    fresh: bool = False,
+) -> str:
+    """Answer without the question header, from the answer cache if possible"""
+    answer_cache = loaded.answer_cache
+    # ---------- answer cache ----------
+    cached: str | None = None if fresh else answer_cache.get_exact(retrival_query)
+    if cached is None:
+        with span("embedding"):
+            query_embedding = await loaded.embed_model.aget_query_embedding(retrival_query)
+        logging.info(
+            "Embedding cache hit rate %.2f, %.2f s saved",
+            loaded.embedding_cache.hit_rate,
+            loaded.embedding_cache.time_saved,
         )
+        if not fresh:
+            with span("answer_cache"):
+                cached = answer_cache.get_similar(query_embedding)
+    if cached is not None:
+        logging.info("Answer cache hit, hit rate %.2f", answer_cache.hit_rate)
+        return cached
+
+    body = await answer_body(loaded, user_message, retrival_query, query_embedding, on_delta=on_delta)
+    # Refusals are not cached: lectures indexed later may answer the question
+    if body not in (NO_INFORMATION, NO_RELEVANT_INFORMATION) and (
+        loaded.index.vector_store.version == answer_cache.index_version  # the index was not swapped meanwhile
+    ):
+        answer_cache.put(retrival_query, query_embedding, body)
+    logging.info("Answer cache miss, hit rate %.2f", answer_cache.hit_rate)
+    return body
+
+
+async def first_stage(
+    index: SearchIndex, retrival_query: str, query_embedding: list[float], candidates: int
+) -> tuple[list[int], list[str] | None]:
+    """
+    Vector top candidates, fused with BM25 ones by reciprocal rank when the lexical index is loaded.
+    Returns the ranked rows and the query tokens (None without the lexical index).
+    """
+    from utils import preprocess_text  # loaded by warm_up()
 
-    context_text = " ".join(node.text for node in source_nodes)
-    context_text = escape_html(context_text)
+    with span("vector_search"):
+        vector_rows = [node.row for node in index.query_engine.retrieve(query_embedding, candidates).source_nodes]
+    if index.lexical_index is None:
+        return vector_rows, None
 
-    is_relevant = await llm_context_judge(context_text, user_message)
-    logging.info("Context judge: %s", is_relevant)
+    with span("lexical_search"):
+        tokens = await preprocess_text(retrival_query)
+        lexical_rows = [row for row, _ in index.lexical_index.search(tokens, candidates)]
+    return [row for row, _ in reciprocal_rank_fusion([vector_rows, lexical_rows])], tokens
 
-    if not is_relevant:
-        return (
-            f"<b>Вопрос:</b> <i>{escape_html(user_message)}</i>\n\n"
-            f"<b>Ответ:</b> В базе знаний нет релевантной информации для ответа на этот вопрос."
-        )
+
+async def retrieve(index: SearchIndex, retrival_query: str, query_embedding: list[float]) -> list[SourceNode]:
+    """
+    First-stage top-k, or with the reranker: RERANK_CANDIDATES candidates of every
+    retriever reranked on CPU, best RERANK_TOP_K first (cached per query)
+    """
+    if index.reranker is None:
+        rows, _ = await first_stage(index, retrival_query, query_embedding, HYBRID_CANDIDATES)
+        nodes: list[SourceNode] = index.query_engine.nodes(query_embedding, rows[:SIMILARITY_TOP_K])
+        return nodes
+
+    key = f"{index.vector_store.version}:{normalize_query(retrival_query)}"
+    reranked = index.reranker.cached(key)
+    if reranked is None:
+        candidates, tokens = await first_stage(index, retrival_query, query_embedding, RERANK_CANDIDATES)
+        with span("rerank"):
+            reranked = index.reranker.rerank(key, query_embedding, tokens, candidates)
+    nodes = index.query_engine.nodes(query_embedding, reranked[:RERANK_TOP_K])
+    return nodes
+
+
+async def answer_body(
+    loaded: Services,
+    user_message: str,
+    retrival_query: str,
+    query_embedding: list[float],
+    on_delta: Callable[[str], None] | None = None,
+) -> str:
+    """Retrieval, relevance judge and generation. Returns the answer without the question header"""
+    # ---------- retrieval ----------
+    source_nodes = await retrieve(loaded.index, retrival_query, query_embedding)
+
+    if not source_nodes:
+        return NO_INFORMATION
+
+    # ---------- context ----------
+    with span("context"):
+        packed = pack_context(source_nodes, CONTEXT_TOKEN_BUDGET)
+    add_tokens("context", packed.tokens)
+    add_tokens("context_saved", packed.saved_tokens)
+    logging.info(
+        "Context: %s spans from %s chunks, %s tokens, %s saved",
+        len(packed.spans),
+        len(source_nodes),
+        packed.tokens,
+        packed.saved_tokens,
+    )
+    for i, context_span in enumerate(packed.spans, 1):
+        logging.info("%s span (rows %s): %s", i, context_span.rows, context_span.text)
+
+    context_text = escape_html(packed.text)
 
     generation_prompt = f"""
         Используя информацию ниже, ответь на вопрос пользователя.
@@ -166,64 +648,167 @@ async def answer(user_message: str, reply_to_message: str | None = None) -> str:
         {user_message}
         """
 
-    gpt_response = await client.chat.completions.create(
-        model=MODEL_NAME,
-        temperature=0,
-        messages=[{"role": "user", "content": generation_prompt}],
+    main_answer = await relevance_gate.run(
+        judge=lambda: llm_context_judge(
+            loaded.client, context_text, user_message, loaded.http_config.timeout(read=JUDGE_TIMEOUT)
+        ),
+        generate=lambda on_text: generate(
+            loaded.client, generation_prompt, loaded.http_config.timeout(read=GENERATION_TIMEOUT), on_text
+        ),
+        top_score=max(context_span.score for context_span in packed.spans),
+        on_delta=(lambda text: on_delta(f"<b>Ответ:</b> {text}")) if on_delta else None,
     )
 
-    main_answer = gpt_response.choices[0].message.content
+    if main_answer is None:
+        return NO_RELEVANT_INFORMATION
+
+    with span("html"):
+        return f"<b>Ответ:</b> {main_answer}{sources_block(packed.spans)}"
+
 
-    urls = {
-        f'&#x25CF; <a href="{n.metadata["url"]}">{escape_html(n.metadata["title"])}</a>'
-        for n in source_nodes
-        if "url" in n.metadata and "title" in n.metadata
-    }
+def sources_block(spans: list[ContextSpan]) -> str:
+    """Links to the videos of the context spans, in the order of the spans"""
+    urls = dict.fromkeys(
+        f'&#x25CF; <a href="{context_span.url}">{escape_html(context_span.title)}</a>'
+        for context_span in spans
+        if context_span.url and context_span.title
+    )
+
+    if not urls:
+        return ""
+    return "\n\n<b>Источники:</b>\n" + "\n".join(urls)
 
-    extended = ""
-    if urls:
-        extended = "\n\n<b>Источники:</b>\n" + "\n".join(urls)
 
-    return f"<b>Вопрос:</b> <i>{escape_html(user_message)}</i>\n\n" f"<b>Ответ:</b> {main_answer}" f"{extended}"
+async def generate(
+    client: "AsyncOpenAI", prompt: str, http_timeout: "httpx.Timeout", on_delta: Callable[[str], None] | None = None
+) -> str:
+    """
+    Answer generation. With on_delta the completion is requested with stream=True,
+    on_delta receives the accumulated text and the time to first token is logged.
+    """
+    if not on_delta:
+        with span("generation"):
+            gpt_response = await client.chat.completions.create(
+                model=MODEL_NAME,
+                temperature=0,
+                messages=[{"role": "user", "content": prompt}],
+                timeout=http_timeout,
+            )
+        if gpt_response.usage:
+            add_tokens("prompt", gpt_response.usage.prompt_tokens)
+            add_tokens("completion", gpt_response.usage.completion_tokens)
+        main_answer: str = gpt_response.choices[0].message.content or ""  # as the stream path, which skips None deltas
+        return main_answer
+
+    with span("generation"):
+        started = time.perf_counter()
+        stream = await client.chat.completions.create(
+            model=MODEL_NAME,
+            temperature=0,
+            messages=[{"role": "user", "content": prompt}],
+            stream=True,
+            timeout=http_timeout,
+        )
+        text = ""
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            if not text:
+                logging.info("Time to first token: %.2f s", time.perf_counter() - started)
+            text += delta
+            on_delta(text)
+    # The pinned openai has no stream_options, so the stream reports no usage: the tokens are counted locally
+    add_tokens("completion", count_tokens(text))
+    logging.info("Generation streamed in %.2f s", time.perf_counter() - started)
+    return text
 
 
 @dp.message_handler(commands=["start", "help"])
 async def send_welcome(message: types.Message) -> None:
     greeting = "Привет, я RAG-бот по YouTube-контенту.\n" "Задавай вопросы, тегнув меня: @rag_youtube_itmo_bot"
-    await message_queue.put((message.chat.id, greeting))
+    await sender.enqueue(message.chat.id, greeting)
 
 
-@dp.message_handler(lambda m: "@rag_youtube_itmo_bot" in m.text)
-async def handle_tag(message: types.Message) -> None:
-    logging.info("Message accepted: %s", message.text)
-    typing_task = asyncio.create_task(keep_typing(message.chat.id))
+async def respond(message: types.Message, user_message: str, reply_to_message: str | None = None) -> None:
+    chat_id = message.chat.id
+    if load_failed:
+        await sender.enqueue(chat_id, "Сервис временно недоступен.")
+        return
+    if not ready.is_set():
+        try:
+            await asyncio.wait_for(asyncio.shield(ready.wait()), WARMUP_WAIT)
+        except asyncio.TimeoutError:
+            await sender.enqueue(chat_id, "Бот загружает базу знаний, повторите вопрос через минуту.")
+            return
+
+    # A question joining an identical one in flight costs nothing upstream, so it is not charged to the quotas
+    coalesced = flight_key(user_message, reply_to_message) in single_flight
+    rejected = None if coalesced else admission.admit(message.from_user.id, chat_id)
+    if rejected:
+        if rejected == OVERLOADED:
+            await sender.enqueue(chat_id, "Сейчас слишком много вопросов, попробуйте через пару минут.")
+        else:
+            await sender.enqueue(chat_id, "Слишком много вопросов подряд, попробуйте немного позже.")
+        return
+
+    trace = tracer.start("reply" if reply_to_message else "question")
+    reply = StreamingReply(bot, sender, chat_id, min_interval=STREAM_EDIT_INTERVAL) if STREAM_ANSWERS else None
+    typing_task = asyncio.create_task(keep_typing(chat_id))
     try:
-        user_message = message_regex.sub("", message.text)
+        if reply:
+            await reply.start(f"<b>Вопрос:</b> <i>{escape_html(user_message)}</i>\n\n⏳")
+        from openai import APITimeoutError  # loaded by warm_up()
+
         try:
-            response = await answer(user_message)
-        except openai.APITimeoutError:
+            response = await answer(user_message, reply_to_message, on_delta=reply.update if reply else None)
+        except APITimeoutError:
             response = "Сервис временно недоступен."
     finally:
         typing_task.cancel()
 
-    await message_queue.put((message.chat.id, response))
+    sent_at = time.perf_counter()
+    if reply:
+        await reply.finish(response)
+        trace.add_span("send", time.perf_counter() - sent_at)
+        tracer.finish(trace)
+        return
+
+    def delivered() -> None:
+        trace.add_span("send", time.perf_counter() - sent_at)
+        tracer.finish(trace)
+
+    await sender.enqueue(chat_id, response, on_done=delivered)
+
+
+@dp.message_handler(lambda m: "@rag_youtube_itmo_bot" in m.text)
+async def handle_tag(message: types.Message) -> None:
+    logging.info("Message accepted: %s", message.text)
+    await respond(message, message_regex.sub("", message.text))
 
 
 @dp.message_handler(lambda m: m.reply_to_message and m.reply_to_message.from_user.id == BOT_ID)
 async def handle_reply(message: types.Message) -> None:
     logging.info("Reply accepted: %s", message.text)
-    typing_task = asyncio.create_task(keep_typing(message.chat.id))
-    try:
-        original = message.reply_to_message.text
-        try:
-            response = await answer(message.text, reply_to_message=original)
-        except openai.APITimeoutError:
-            response = "Сервис временно недоступен."
-    finally:
-        typing_task.cancel()
+    await respond(message, message.text, reply_to_message=message.reply_to_message.text)
+
+
+async def run_worker(worker_id: int) -> None:
+    """Worker of the webhook mode: processes the updates of its chats from the work queue"""
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    await on_startup(dp)
+    # The webhook front end waits for the first heartbeat, so the index is loaded before the queue is polled
+    await warm_up()
 
-    await message_queue.put((message.chat.id, response))
+    async def handle(update: dict[str, Any]) -> None:
+        await dp.process_update(types.Update.to_object(update))
+
+    await QueueWorker(WorkQueue(WORK_QUEUE_PATH), worker_id, handle, concurrency=WORKER_CONCURRENCY).run()
 
 
 if __name__ == "__main__":
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
+    if WORKER_ID is not None:
+        asyncio.get_event_loop().run_until_complete(run_worker(WORKER_ID))
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
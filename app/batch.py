@@ -0,0 +1,152 @@
+import argparse
+import asyncio
+import html
+import json
+import logging
+import os
+import re
+import sys
+import time
+from dataclasses import replace
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import TextIO
+from typing import cast
+
+
+os.environ.setdefault("LOG_FILE", "app/logs/batch.log")
+# The bot module imports its neighbours as top-level modules, as when it runs as app/app.py
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import app as bot  # noqa: E402  (reads LOG_FILE on import)
+from app.answer_cache import AnswerCache  # noqa: E402
+from evaluation.fakes import FakeLLM  # noqa: E402
+from evaluation.fakes import HashingEmbedder  # noqa: E402
+
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+
+_source_regex = re.compile(r'<a href="(.*?)">(.*?)</a>')
+
+
+def read_questions(path: str) -> list[dict[str, Any]]:
+    """Questions of a JSONL file: "question", optional "reply_to" and "id" (the line number by default)"""
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                item = json.loads(line)
+                questions.append({**item, "id": item.get("id", number)})
+    return questions
+
+
+def answered_ids(path: str) -> set[Any]:
+    """Ids already written to the output; a line cut by an interrupted run is dropped"""
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb") as f:
+        data = f.read()
+    complete = data[: data.rfind(b"\n") + 1]
+    if len(complete) < len(data):
+        with open(path, "r+b") as f:
+            f.truncate(len(complete))
+    return {json.loads(line)["id"] for line in complete.decode("utf-8").splitlines() if line.strip()}
+
+
+def parse_sources(answer_html: str) -> list[dict[str, str]]:
+    """Videos listed in the sources block of an answer"""
+    _, _, block = answer_html.partition("<b>Источники:</b>")
+    return [{"url": html.unescape(url), "title": html.unescape(title)} for url, title in _source_regex.findall(block)]
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+async def run(args: argparse.Namespace, pending: list[dict[str, Any]], output: TextIO) -> dict[str, Any]:
+    """Answers the questions with bounded concurrency, appending every answer to output as soon as it is ready"""
+    await bot.warm_up()
+    assert bot.services is not None
+    if args.llm == "fake":
+        # Offline: fake chat and query embeddings, and answers kept out of the bot's answer cache
+        vector_store = bot.services.index.vector_store
+        bot.services = replace(
+            bot.services,
+            client=cast("AsyncOpenAI", FakeLLM(delay=args.llm_delay)),
+            embed_model=HashingEmbedder(dim=vector_store.vectors.shape[1]),
+            answer_cache=AnswerCache(
+                ":memory:",
+                index_version=vector_store.version,
+                threshold=bot.ANSWER_CACHE_THRESHOLD,
+                max_entries=bot.ANSWER_CACHE_SIZE,
+                ttl=bot.ANSWER_CACHE_TTL,
+            ),
+        )
+    bot.admission.max_concurrency = args.concurrency
+
+    queue: asyncio.Queue[dict[str, Any]] = asyncio.Queue()
+    for question in pending:
+        queue.put_nowait(question)
+    latencies: list[float] = []
+    errors = 0
+    started = time.perf_counter()
+
+    async def worker() -> None:
+        nonlocal errors
+        while not queue.empty():
+            question = queue.get_nowait()
+            question_started = time.perf_counter()
+            try:
+                answer_html = await bot.answer(question["question"], question.get("reply_to"), fresh=args.fresh)
+            except Exception:
+                errors += 1  # not written, so the next run retries it
+                logging.exception("Question %s failed", question["id"])
+                continue
+            seconds = time.perf_counter() - question_started
+            latencies.append(seconds)
+            record = {
+                "id": question["id"],
+                "question": question["question"],
+                "answer": answer_html,
+                "sources": parse_sources(answer_html),
+                "seconds": round(seconds, 3),
+            }
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+            if len(latencies) % 50 == 0:
+                elapsed = time.perf_counter() - started
+                logging.info("%s/%s answered, %.2f questions/s", len(latencies), len(pending), len(latencies) / elapsed)
+
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+
+    elapsed = time.perf_counter() - started
+    return {
+        "answered": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 2),
+        "questions_per_second": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_p50": round(percentile(latencies, 0.5), 3),
+        "latency_p95": round(percentile(latencies, 0.95), 3),
+        "answer_cache_hit_rate": round(bot.services.answer_cache.hit_rate, 3),
+    }
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Answer a JSONL file of questions and warm the answer cache")
+    arg_parser.add_argument("questions", help='JSONL with "question" and optional "id", "reply_to"')
+    arg_parser.add_argument("output", help="JSONL with the answers; a rerun skips the ids already written")
+    arg_parser.add_argument("--concurrency", type=int, default=8, help="questions answered at once")
+    arg_parser.add_argument("--llm", choices=["openai", "fake"], default="openai", help="fake runs without the API")
+    arg_parser.add_argument("--llm-delay", type=float, default=0.0, help="seconds per call of the fake LLM")
+    arg_parser.add_argument("--fresh", action="store_true", help="do not read the answer cache, only refill it")
+    args = arg_parser.parse_args()
+    questions = read_questions(args.questions)
+    done = answered_ids(args.output)
+    pending = [question for question in questions if question["id"] not in done]
+    logging.info("%s questions, %s already answered", len(questions), len(questions) - len(pending))
+    with open(args.output, "a", encoding="utf-8") as f:
+        report = asyncio.run(run(args, pending, f))
+    logging.info("Batch done: %s", json.dumps(report))
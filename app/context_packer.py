@@ -0,0 +1,116 @@
+from dataclasses import dataclass
+from typing import Sequence
+
+from tokens import count_tokens
+from tokens import truncate_tokens
+from vector_store import SourceNode
+
+
+MIN_TAIL_TOKENS = 50  # a span is cut to the remaining budget only if at least this much is left
+
+
+@dataclass(frozen=True)
+class ContextSpan:
+    """Continuous piece of one video: one chunk or several adjacent chunks merged"""
+
+    text: str
+    url: str
+    title: str
+    rows: tuple[int, ...]
+    score: float
+
+
+@dataclass(frozen=True)
+class PackedContext:
+    spans: list[ContextSpan]
+    text: str
+    tokens: int
+    naive_tokens: int  # tokens of the retrieved chunks simply joined with spaces
+
+    @property
+    def saved_tokens(self) -> int:
+        return max(self.naive_tokens - self.tokens, 0)
+
+
+def overlap_words(left: Sequence[str], right: Sequence[str], max_words: int = 200) -> int:
+    """Length of the longest word suffix of left that is a prefix of right"""
+    if not left or not right:
+        return 0
+    first = right[0]
+    for k in range(min(len(left), len(right), max_words), 0, -1):
+        if left[-k] == first and list(left[-k:]) == list(right[:k]):
+            return k
+    return 0
+
+
+def _video(node: SourceNode) -> str:
+    return str(node.metadata.get("url") or node.node_id)
+
+
+def merge_spans(nodes: Sequence[SourceNode]) -> list[ContextSpan]:
+    """
+    Groups the nodes by video and merges chunks with adjacent rows, dropping
+    the words their overlap repeats. Spans keep the rank of their best node.
+    """
+    groups: dict[str, list[tuple[int, SourceNode]]] = {}
+    for rank, node in enumerate(nodes):
+        groups.setdefault(_video(node), []).append((rank, node))
+
+    ranked: list[tuple[int, ContextSpan]] = []
+    for group in groups.values():
+        group.sort(key=lambda item: item[1].row)
+        runs: list[list[SourceNode]] = []
+        run_ranks: list[int] = []
+        for rank, node in group:
+            if runs and node.row >= 0 and node.row == runs[-1][-1].row + 1:
+                runs[-1].append(node)
+                run_ranks[-1] = min(run_ranks[-1], rank)
+            else:
+                runs.append([node])
+                run_ranks.append(rank)
+        for run, rank in zip(runs, run_ranks):
+            words = run[0].text.split()
+            for node in run[1:]:
+                next_words = node.text.split()
+                words.extend(next_words[overlap_words(words, next_words) :])
+            span = ContextSpan(
+                text=" ".join(words),
+                url=run[0].metadata.get("url", ""),
+                title=run[0].metadata.get("title", ""),
+                rows=tuple(node.row for node in run),
+                score=max(node.score for node in run),
+            )
+            ranked.append((rank, span))
+    ranked.sort(key=lambda item: item[0])
+    return [span for _, span in ranked]
+
+
+def render_span(index: int, span: ContextSpan) -> str:
+    return f"[{index}] {span.title}\n{span.text}" if span.title else f"[{index}] {span.text}"
+
+
+def pack_context(nodes: Sequence[SourceNode], budget: int) -> PackedContext:
+    """
+    Merges the ranked nodes into spans and adds them in rank order while they
+    fit `budget` tokens; the first span that does not fit is cut to the rest
+    of the budget. Every span is numbered and titled with its video.
+    """
+    spans = []
+    parts: list[str] = []
+    used = 0
+    for span in merge_spans(nodes):
+        left = budget - used
+        if parts and left < MIN_TAIL_TOKENS:
+            break
+        part = render_span(len(parts) + 1, span)
+        part_tokens = count_tokens(part)
+        if part_tokens > left:
+            part = truncate_tokens(part, max(left, MIN_TAIL_TOKENS))
+            part_tokens = count_tokens(part)
+        parts.append(part)
+        spans.append(span)
+        used += part_tokens + 2  # the separating blank line
+
+    text = "\n\n".join(parts)
+    naive = count_tokens(" ".join(node.text for node in nodes))
+    return PackedContext(spans=spans, text=text, tokens=count_tokens(text), naive_tokens=naive)
@@ -1,7 +1,18 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from typing import Any
+from typing import Awaitable
+from typing import Callable
 from typing import Dict
+from typing import List
+from typing import Sequence
 
 import httpx
+import numpy as np
+import numpy.typing as npt
 from dotenv import load_dotenv
 from llama_index.bridge.pydantic import PrivateAttr
 from llama_index.callbacks.base import CallbackManager
@@ -14,10 +25,122 @@ from llama_index.embeddings.openai import OpenAIEmbeddingModelType
 load_dotenv()
 
 
+class EmbeddingCache:
+    """
+    Persistent cache of embeddings keyed by (model, sha256 of the text).
+
+    Vectors are stored as float32 blobs in SQLite with an in-memory LRU of
+    `memory_size` entries in front. Hits and misses are counted per text;
+    time saved is the number of upstream requests avoided times the mean
+    upstream request latency.
+    """
+
+    def __init__(self, path: str, memory_size: int = 4096) -> None:
+        self.memory_size = memory_size
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+        self.requests_saved = 0
+        self.request_seconds = 0.0
+
+        self._lock = threading.Lock()
+        self._memory: OrderedDict[tuple[str, bytes], npt.NDArray[np.float32]] = OrderedDict()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                hash BLOB NOT NULL,
+                embedding BLOB NOT NULL,
+                PRIMARY KEY (model, hash)
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _hash(text: str) -> bytes:
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def _remember(self, key: tuple[str, bytes], vector: npt.NDArray[np.float32]) -> None:
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get_many(self, model: str, texts: Sequence[str]) -> list[List[float] | None]:
+        found: list[List[float] | None] = []
+        with self._lock:
+            for text in texts:
+                key = (model, self._hash(text))
+                vector = self._memory.get(key)
+                if vector is None:
+                    row = self._conn.execute(
+                        "SELECT embedding FROM embeddings WHERE model = ? AND hash = ?", key
+                    ).fetchone()
+                    if row:
+                        vector = np.frombuffer(row[0], dtype=np.float32)
+                if vector is None:
+                    self.misses += 1
+                    found.append(None)
+                else:
+                    self.hits += 1
+                    self._remember(key, vector)
+                    found.append(vector.tolist())
+        return found
+
+    def put_many(self, model: str, texts: Sequence[str], embeddings: Sequence[Sequence[float]]) -> None:
+        rows = []
+        with self._lock:
+            for text, embedding in zip(texts, embeddings):
+                key = (model, self._hash(text))
+                vector = np.asarray(embedding, dtype=np.float32)
+                self._remember(key, vector)
+                rows.append((*key, vector.tobytes()))
+            with self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+
+    def record_request(self, seconds: float) -> None:
+        self.requests += 1
+        self.request_seconds += seconds
+
+    def record_saved_request(self) -> None:
+        self.requests_saved += 1
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def time_saved(self) -> float:
+        return self.requests_saved * self.request_seconds / self.requests if self.requests else 0.0
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "requests": self.requests,
+            "requests_saved": self.requests_saved,
+            "time_saved": self.time_saved,
+        }
+
+    def close(self) -> None:
+        self._conn.close()
+
+
 class OpenAIEmbeddingProxy(OpenAIEmbedding):
-    """Custom OpenAIEmbedding with proxy http_client"""
+    """
+    Custom OpenAIEmbedding with proxy http_client.
+    With a cache, only texts missing from it are sent upstream, in one request per call;
+    on_upstream is called with the texts of every upstream request.
+    """
 
     _http_client: httpx.Client = PrivateAttr()
+    _cache: EmbeddingCache | None = PrivateAttr()
+    _on_upstream: Callable[[Sequence[str]], None] | None = PrivateAttr()
 
     def __init__(
         self,
@@ -32,9 +155,13 @@ class OpenAIEmbeddingProxy(OpenAIEmbedding):
         timeout: float = 60.0,
         callback_manager: CallbackManager | None = None,
         http_client: httpx.Client | None = None,  # Add http_client as an argument
+        cache: EmbeddingCache | None = None,
+        on_upstream: Callable[[Sequence[str]], None] | None = None,
         **kwargs: Any,
     ) -> None:
         self._http_client = http_client  # Store http_client as an attribute
+        self._cache = cache
+        self._on_upstream = on_upstream
 
         super().__init__(
             mode=mode,
@@ -54,3 +181,82 @@ class OpenAIEmbeddingProxy(OpenAIEmbedding):
         credential_kwargs: dict[str, Any] = super()._get_credential_kwargs()
         credential_kwargs["http_client"] = self._http_client
         return credential_kwargs
+
+    @property
+    def cache(self) -> EmbeddingCache | None:
+        return self._cache
+
+    @staticmethod
+    def _merge(
+        texts: Sequence[str], found: list[List[float] | None], missing: list[str], fetched: List[List[float]]
+    ) -> List[List[float]]:
+        by_text = dict(zip(missing, fetched))
+        return [embedding if embedding is not None else by_text[text] for text, embedding in zip(texts, found)]
+
+    def _sending(self, texts: Sequence[str]) -> None:
+        if self._on_upstream is not None:
+            self._on_upstream(texts)
+
+    def _lookup(self, engine: str, texts: Sequence[str]) -> tuple[list[List[float] | None], list[str]]:
+        assert self._cache is not None
+        found = self._cache.get_many(engine, texts)
+        missing = list(dict.fromkeys(text for text, embedding in zip(texts, found) if embedding is None))
+        if not missing:
+            self._cache.record_saved_request()
+        return found, missing
+
+    def _cached_embeddings(
+        self, engine: str, texts: List[str], upstream: Callable[[List[str]], List[List[float]]]
+    ) -> List[List[float]]:
+        if self._cache is None:
+            self._sending(texts)
+            return upstream(texts)
+        found, missing = self._lookup(engine, texts)
+        fetched: List[List[float]] = []
+        if missing:
+            self._sending(missing)
+            started = time.perf_counter()
+            fetched = upstream(missing)
+            self._cache.record_request(time.perf_counter() - started)
+            self._cache.put_many(engine, missing, fetched)
+        return self._merge(texts, found, missing, fetched)
+
+    async def _acached_embeddings(
+        self, engine: str, texts: List[str], upstream: Callable[[List[str]], Awaitable[List[List[float]]]]
+    ) -> List[List[float]]:
+        if self._cache is None:
+            self._sending(texts)
+            return await upstream(texts)
+        found, missing = self._lookup(engine, texts)
+        fetched: List[List[float]] = []
+        if missing:
+            self._sending(missing)
+            started = time.perf_counter()
+            fetched = await upstream(missing)
+            self._cache.record_request(time.perf_counter() - started)
+            self._cache.put_many(engine, missing, fetched)
+        return self._merge(texts, found, missing, fetched)
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        upstream = super()._get_query_embedding
+        return self._cached_embeddings(self._query_engine, [query], lambda texts: [upstream(texts[0])])[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        upstream = super()._aget_query_embedding
+
+        async def fetch(texts: List[str]) -> List[List[float]]:
+            return [await upstream(texts[0])]
+
+        return (await self._acached_embeddings(self._query_engine, [query], fetch))[0]
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._cached_embeddings(self._text_engine, texts, super()._get_text_embeddings)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return await self._acached_embeddings(self._text_engine, texts, super()._aget_text_embeddings)
@@ -0,0 +1,193 @@
+import importlib.util
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any
+
+import httpx
+
+
+@dataclass(frozen=True)
+class HttpClientConfig:
+    """Connection pool, protocol and timeout policy of the clients talking to the OpenAI API"""
+
+    proxy: str | None = None
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0  # seconds an idle connection is kept open for reuse
+    http2: bool = False  # needs the h2 package, falls back to HTTP/1.1 without it
+    connect_timeout: float = 5.0
+    read_timeout: float = 60.0
+    write_timeout: float = 60.0
+    pool_timeout: float = 10.0  # seconds to wait for a free connection of the pool
+
+    @classmethod
+    def from_env(cls) -> "HttpClientConfig":
+        def number(name: str, default: float) -> float:
+            value = os.getenv(name)
+            return float(value) if value else default
+
+        return cls(
+            proxy=os.getenv("PROXY") or None,
+            max_connections=int(number("HTTP_MAX_CONNECTIONS", cls.max_connections)),
+            max_keepalive_connections=int(number("HTTP_MAX_KEEPALIVE", cls.max_keepalive_connections)),
+            keepalive_expiry=number("HTTP_KEEPALIVE_EXPIRY", cls.keepalive_expiry),
+            http2=os.getenv("HTTP2", "0") == "1",
+            connect_timeout=number("HTTP_CONNECT_TIMEOUT", cls.connect_timeout),
+            read_timeout=number("HTTP_READ_TIMEOUT", cls.read_timeout),
+            write_timeout=number("HTTP_WRITE_TIMEOUT", cls.write_timeout),
+            pool_timeout=number("HTTP_POOL_TIMEOUT", cls.pool_timeout),
+        )
+
+    @property
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    def timeout(self, read: float | None = None) -> httpx.Timeout:
+        """Timeouts of one operation: `read` overrides the default, e.g. longer for a transcription"""
+        return httpx.Timeout(
+            connect=self.connect_timeout,
+            read=self.read_timeout if read is None else read,
+            write=self.write_timeout,
+            pool=self.pool_timeout,
+        )
+
+
+class PoolStats:
+    """
+    Connection pool counters of a client: requests, connections opened for them
+    (the rest reused a kept-alive connection), the time requests spent
+    waiting for a connection of the pool and the requests that gave up waiting
+    after the pool timeout. Thread-safe for the sync clients.
+    """
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.connections_opened = 0
+        self.pool_timeouts = 0
+        self.pool_wait_seconds = 0.0
+        self.max_pool_wait = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, pool_wait: float, new_connection: bool) -> None:
+        with self._lock:
+            self.requests += 1
+            self.connections_opened += new_connection
+            self.pool_wait_seconds += pool_wait
+            self.max_pool_wait = max(self.max_pool_wait, pool_wait)
+
+    def record_pool_timeout(self) -> None:
+        with self._lock:
+            self.pool_timeouts += 1
+
+    @property
+    def reuse_rate(self) -> float:
+        return 1 - self.connections_opened / self.requests if self.requests else 0.0
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "requests": self.requests,
+            "connections_opened": self.connections_opened,
+            "pool_timeouts": self.pool_timeouts,
+            "reuse_rate": self.reuse_rate,
+            "mean_pool_wait": self.pool_wait_seconds / self.requests if self.requests else 0.0,
+            "max_pool_wait": self.max_pool_wait,
+        }
+
+
+class _Probe:
+    """
+    httpcore trace callback of one request. The first connect (a new connection)
+    or send-headers (a pooled one) event marks the moment a connection was got.
+    """
+
+    def __init__(self, chained: Any = None) -> None:
+        self.started = time.perf_counter()
+        self.acquired: float | None = None
+        self.new_connection = False
+        self.chained = chained
+
+    def _observe(self, name: str) -> None:
+        if self.acquired is None and (
+            name == "connection.connect_tcp.started" or name.endswith("send_request_headers.started")
+        ):
+            self.acquired = time.perf_counter()
+            self.new_connection = name.startswith("connection.")
+
+    def trace(self, name: str, info: dict[str, Any]) -> None:
+        self._observe(name)
+        if self.chained:
+            self.chained(name, info)
+
+    async def atrace(self, name: str, info: dict[str, Any]) -> None:
+        self._observe(name)
+        if self.chained:
+            await self.chained(name, info)
+
+    def record(self, stats: PoolStats) -> None:
+        if self.acquired is not None:  # requests failed before getting a connection are not counted
+            stats.record(self.acquired - self.started, self.new_connection)
+
+
+class _MeteredTransport(httpx.HTTPTransport):
+    def __init__(self, stats: PoolStats, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        probe = _Probe(request.extensions.get("trace"))
+        request.extensions = {**request.extensions, "trace": probe.trace}
+        try:
+            return super().handle_request(request)
+        except httpx.PoolTimeout:
+            self.stats.record_pool_timeout()
+            raise
+        finally:
+            probe.record(self.stats)
+
+
+class _MeteredAsyncTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, stats: PoolStats, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        probe = _Probe(request.extensions.get("trace"))
+        request.extensions = {**request.extensions, "trace": probe.atrace}
+        try:
+            return await super().handle_async_request(request)
+        except httpx.PoolTimeout:
+            self.stats.record_pool_timeout()
+            raise
+        finally:
+            probe.record(self.stats)
+
+
+def _transport_kwargs(config: HttpClientConfig) -> dict[str, Any]:
+    http2 = config.http2
+    if http2 and importlib.util.find_spec("h2") is None:
+        logging.warning("HTTP/2 requested but the h2 package is not installed, using HTTP/1.1")
+        http2 = False
+    return {
+        "http2": http2,
+        "limits": config.limits,
+        "proxy": httpx.Proxy(config.proxy) if config.proxy else None,
+    }
+
+
+def create_client(config: HttpClientConfig, stats: PoolStats | None = None) -> httpx.Client:
+    """Sync client with the pool and timeouts of the config; its pool usage is counted in stats"""
+    transport = _MeteredTransport(stats or PoolStats(), **_transport_kwargs(config))
+    return httpx.Client(transport=transport, timeout=config.timeout())
+
+
+def create_async_client(config: HttpClientConfig, stats: PoolStats | None = None) -> httpx.AsyncClient:
+    """Async client with the pool and timeouts of the config; its pool usage is counted in stats"""
+    transport = _MeteredAsyncTransport(stats or PoolStats(), **_transport_kwargs(config))
+    return httpx.AsyncClient(transport=transport, timeout=config.timeout())
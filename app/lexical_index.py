@@ -0,0 +1,233 @@
+import json
+import logging
+import os
+from collections import Counter
+from typing import Callable
+from typing import Iterable
+from typing import Sequence
+
+import numpy as np
+import numpy.typing as npt
+
+
+LEXICAL_FILE = "lexical.json"
+INDPTR_FILE = "lexical_indptr.i64"
+ROWS_FILE = "lexical_rows.i32"
+WEIGHTS_FILE = "lexical_weights.f32"
+TFS_FILE = "lexical_tfs.i32"  # term frequency of every posting and length of every document: enough to
+LENGTHS_FILE = "lexical_lengths.i32"  # recompute the weights when documents are appended, without re-tokenizing
+
+
+def _postings(
+    tokenized_docs: Sequence[Sequence[str]], vocab: dict[str, int], first_row: int = 0
+) -> tuple[npt.NDArray[np.int64], npt.NDArray[np.int32], npt.NDArray[np.int32]]:
+    """(term id, row, term frequency) of every posting; terms missing from vocab are added to it"""
+    term_ids: list[int] = []
+    rows: list[int] = []
+    tfs: list[int] = []
+    for row, doc in enumerate(tokenized_docs, first_row):
+        for term, tf in Counter(doc).items():
+            term_ids.append(vocab.setdefault(term, len(vocab)))
+            rows.append(row)
+            tfs.append(tf)
+    return np.array(term_ids, dtype=np.int64), np.array(rows, dtype=np.int32), np.array(tfs, dtype=np.int32)
+
+
+def _csr(
+    term_ids: npt.NDArray[np.int64], rows: npt.NDArray[np.int32], tfs: npt.NDArray[np.int32], n_terms: int
+) -> tuple[npt.NDArray[np.int64], npt.NDArray[np.int32], npt.NDArray[np.int32]]:
+    """Postings grouped by term; the sort is stable, so rows of a term stay ascending"""
+    order = np.argsort(term_ids, kind="stable")
+    indptr = np.zeros(n_terms + 1, dtype=np.int64)
+    np.cumsum(np.bincount(term_ids, minlength=n_terms), out=indptr[1:])
+    return indptr, rows[order], tfs[order]
+
+
+def _weights(
+    indptr: npt.NDArray[np.int64],
+    rows: npt.NDArray[np.int32],
+    tfs: npt.NDArray[np.int32],
+    lengths: npt.NDArray[np.int32],
+    k1: float,
+    b: float,
+) -> npt.NDArray[np.float32]:
+    """Final Okapi BM25 weight of every posting"""
+    n_docs = len(lengths)
+    avgdl = float(lengths.mean()) if n_docs else 0.0
+    df = np.diff(indptr).astype(np.float64)
+    idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+    norm = k1 * (1 - b + b * lengths[rows] / avgdl) if avgdl else np.full(len(rows), k1)
+    tf = tfs.astype(np.float64)
+    return (np.repeat(idf, np.diff(indptr)) * tf * (k1 + 1) / (tf + norm)).astype(np.float32)
+
+
+def _tf_index(
+    tokenized_docs: Sequence[Sequence[str]],
+) -> tuple[dict[str, int], npt.NDArray[np.int64], npt.NDArray[np.int32], npt.NDArray[np.int32], npt.NDArray[np.int32]]:
+    vocab: dict[str, int] = {}
+    term_ids, rows, tfs = _postings(tokenized_docs, vocab)
+    lengths = np.array([len(doc) for doc in tokenized_docs], dtype=np.int32)
+    return (vocab, *_csr(term_ids, rows, tfs, len(vocab)), lengths)
+
+
+def _bm25(
+    tokenized_docs: Sequence[Sequence[str]], k1: float, b: float
+) -> tuple[dict[str, int], npt.NDArray[np.int64], npt.NDArray[np.int32], npt.NDArray[np.float32]]:
+    vocab, indptr, rows, tfs, lengths = _tf_index(tokenized_docs)
+    return vocab, indptr, rows, _weights(indptr, rows, tfs, lengths, k1, b)
+
+
+def _write_array(folder: str, name: str, array: npt.NDArray[np.generic]) -> None:
+    tmp_path = os.path.join(folder, f"{name}.tmp")
+    with open(tmp_path, "wb") as f:
+        array.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(folder, name))
+
+
+def _write_index(
+    folder: str,
+    vocab: dict[str, int],
+    indptr: npt.NDArray[np.int64],
+    rows: npt.NDArray[np.int32],
+    tfs: npt.NDArray[np.int32],
+    lengths: npt.NDArray[np.int32],
+    k1: float,
+    b: float,
+) -> None:
+    os.makedirs(folder, exist_ok=True)
+    # Arrays are replaced before the meta file; a reader that pairs the old meta with new arrays sees a size mismatch
+    _write_array(folder, INDPTR_FILE, indptr)
+    _write_array(folder, ROWS_FILE, rows)
+    _write_array(folder, WEIGHTS_FILE, _weights(indptr, rows, tfs, lengths, k1, b))
+    _write_array(folder, TFS_FILE, tfs)
+    _write_array(folder, LENGTHS_FILE, lengths)
+    tmp_path = os.path.join(folder, f"{LEXICAL_FILE}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        meta = {"count": len(lengths), "postings": len(rows), "k1": k1, "b": b, "vocab": vocab}
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(folder, LEXICAL_FILE))
+
+
+def build_lexical_index(folder: str, tokenized_docs: Sequence[Sequence[str]], k1: float = 1.5, b: float = 0.75) -> None:
+    """
+    Precomputes an Okapi BM25 inverted index in CSR layout next to the mmap vector index.
+
+    Postings of term t are rows[indptr[t]:indptr[t + 1]] with their final BM25
+    weights, so scoring a query is only a sum of weight slices.
+    Row numbers are the rows of the vector index the documents were taken from.
+    """
+    vocab, indptr, rows, tfs, lengths = _tf_index(tokenized_docs)
+    _write_index(folder, vocab, indptr, rows, tfs, lengths, k1, b)
+    logging.info(
+        "Lexical index written to %s: %s docs, %s terms, %s postings", folder, len(lengths), len(vocab), len(rows)
+    )
+
+
+def update_lexical_index(
+    folder: str,
+    texts: Sequence[str],
+    tokenize: Callable[[Sequence[str]], Sequence[Sequence[str]]],
+    k1: float = 1.5,
+    b: float = 0.75,
+) -> None:
+    """
+    Adds documents appended to the vector index since the last update.
+
+    `texts` are the texts of all rows of the vector index; only the rows past
+    the indexed count are tokenized. Their postings are merged into the CSR
+    arrays and every weight is recomputed from the stored term frequencies and
+    document lengths, since the IDF and average length change with every
+    document. Rebuilds from scratch when there is no index with term
+    frequencies yet, the parameters changed, or the vector index was rewritten
+    with fewer rows.
+    """
+    meta = None
+    if LexicalIndex.exists(folder) and os.path.exists(os.path.join(folder, TFS_FILE)):
+        with open(os.path.join(folder, LEXICAL_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    if meta is None or meta["count"] > len(texts) or (meta["k1"], meta["b"]) != (k1, b):
+        build_lexical_index(folder, tokenize(texts), k1, b)
+        return
+    if meta["count"] == len(texts):
+        return
+
+    vocab: dict[str, int] = meta["vocab"]
+    indptr = np.fromfile(os.path.join(folder, INDPTR_FILE), dtype=np.int64)
+    old_term_ids = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))
+    old_rows = np.fromfile(os.path.join(folder, ROWS_FILE), dtype=np.int32)
+    old_tfs = np.fromfile(os.path.join(folder, TFS_FILE), dtype=np.int32)
+    old_lengths = np.fromfile(os.path.join(folder, LENGTHS_FILE), dtype=np.int32)
+
+    new_docs = tokenize(texts[meta["count"] :])
+    term_ids, rows, tfs = _postings(new_docs, vocab, first_row=meta["count"])
+    indptr, rows, tfs = _csr(
+        np.concatenate([old_term_ids, term_ids]),
+        np.concatenate([old_rows, rows]),
+        np.concatenate([old_tfs, tfs]),
+        len(vocab),
+    )
+    lengths = np.concatenate([old_lengths, np.array([len(doc) for doc in new_docs], dtype=np.int32)])
+    _write_index(folder, vocab, indptr, rows, tfs, lengths, k1, b)
+    logging.info(
+        "Lexical index in %s: %s docs added, %s terms, %s postings", folder, len(new_docs), len(vocab), len(rows)
+    )
+
+
+class LexicalIndex:
+    """BM25 retriever over the precomputed CSR inverted index"""
+
+    def __init__(self, folder: str) -> None:
+        with open(os.path.join(folder, LEXICAL_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.count: int = meta["count"]
+        self.vocab: dict[str, int] = meta["vocab"]
+        self.indptr: npt.NDArray[np.int64] = np.fromfile(os.path.join(folder, INDPTR_FILE), dtype=np.int64)
+        self.rows: npt.NDArray[np.int32] = np.fromfile(os.path.join(folder, ROWS_FILE), dtype=np.int32)
+        self.weights: npt.NDArray[np.float32] = np.fromfile(os.path.join(folder, WEIGHTS_FILE), dtype=np.float32)
+        postings = meta.get("postings", len(self.rows))
+        if len(self.indptr) != len(self.vocab) + 1 or not len(self.rows) == len(self.weights) == postings:
+            raise ValueError(f"Lexical index files in {folder} do not match {LEXICAL_FILE}, it is being rewritten")
+
+    @classmethod
+    def from_docs(cls, tokenized_docs: Sequence[Sequence[str]], k1: float = 1.5, b: float = 0.75) -> "LexicalIndex":
+        """The same index built in memory, for readers that must not write to the index folder"""
+        index = cls.__new__(cls)
+        index.count = len(tokenized_docs)
+        index.vocab, index.indptr, index.rows, index.weights = _bm25(tokenized_docs, k1, b)
+        return index
+
+    @staticmethod
+    def exists(folder: str) -> bool:
+        return os.path.exists(os.path.join(folder, LEXICAL_FILE))
+
+    def scores(self, tokens: Iterable[str]) -> npt.NDArray[np.float32]:
+        scores = np.zeros(self.count, dtype=np.float32)
+        for token in tokens:
+            term_id = self.vocab.get(token)
+            if term_id is None:
+                continue
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            # rows of one term are unique, so fancy-index addition is safe here
+            scores[self.rows[start:end]] += self.weights[start:end]
+        return scores
+
+    def search(self, tokens: Iterable[str], top_k: int) -> list[tuple[int, float]]:
+        """Returns (row, BM25 score) of the top_k documents with a non-zero score, best first"""
+        scores = self.scores(tokens)
+        top_k = min(top_k, int(np.count_nonzero(scores)))
+        if top_k <= 0:
+            return []
+        rows = np.argpartition(scores, -top_k)[-top_k:]
+        rows = rows[np.argsort(scores[rows])[::-1]]
+        return [(int(row), float(scores[row])) for row in rows]
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int = 60) -> list[tuple[int, float]]:
+    """Fuses ranked row lists by sum of 1 / (k + rank), best first"""
+    fused: dict[int, float] = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, 1):
+            fused[row] = fused.get(row, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
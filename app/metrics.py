@@ -0,0 +1,134 @@
+import logging
+import threading
+from collections import deque
+from typing import Callable
+
+from aiohttp import web
+
+
+class Counter:
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def samples(self, name: str, labels: str) -> list[str]:
+        return [f"{name}_total{labels} {self.value}"]
+
+
+class Gauge:
+    """Either set explicitly or computed on every scrape from a callback"""
+
+    def __init__(self, callback: Callable[[], float] | None = None) -> None:
+        self.value = 0.0
+        self.callback = callback
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def samples(self, name: str, labels: str) -> list[str]:
+        value = self.callback() if self.callback else self.value
+        return [f"{name}{labels} {value}"]
+
+
+class Summary:
+    """Count, sum and p50/p95/p99 over a rolling window of the last observations"""
+
+    quantiles = (0.5, 0.95, 0.99)
+
+    def __init__(self, window: int = 2048) -> None:
+        self.count = 0
+        self.sum = 0.0
+        self._window: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            self._window.append(value)
+
+    def percentiles(self) -> dict[float, float]:
+        with self._lock:
+            ordered = sorted(self._window)
+        if not ordered:
+            return {q: 0.0 for q in self.quantiles}
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in self.quantiles}
+
+    def samples(self, name: str, labels: str) -> list[str]:
+        inner = labels[1:-1] + "," if labels else ""
+        lines = [f'{name}{{{inner}quantile="{q}"}} {v}' for q, v in self.percentiles().items()]
+        lines.append(f"{name}_sum{labels} {self.sum}")
+        lines.append(f"{name}_count{labels} {self.count}")
+        return lines
+
+
+Metric = Counter | Gauge | Summary
+
+
+class MetricsRegistry:
+    """Process-wide metrics rendered in the Prometheus text exposition format"""
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, tuple[str, str, dict[str, Metric]]] = {}
+        self._lock = threading.Lock()
+
+    def _get(
+        self, kind: str, factory: Callable[[], Metric], name: str, doc: str, labels: dict[str, str] | None
+    ) -> Metric:
+        label_str = "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}" if labels else ""
+        with self._lock:
+            _, _, series = self._metrics.setdefault(name, (kind, doc, {}))
+            if label_str not in series:
+                series[label_str] = factory()
+            return series[label_str]
+
+    def counter(self, name: str, doc: str, labels: dict[str, str] | None = None) -> Counter:
+        metric = self._get("counter", Counter, name, doc, labels)
+        assert isinstance(metric, Counter)
+        return metric
+
+    def gauge(
+        self, name: str, doc: str, labels: dict[str, str] | None = None, callback: Callable[[], float] | None = None
+    ) -> Gauge:
+        metric = self._get("gauge", lambda: Gauge(callback), name, doc, labels)
+        assert isinstance(metric, Gauge)
+        return metric
+
+    def summary(self, name: str, doc: str, labels: dict[str, str] | None = None) -> Summary:
+        metric = self._get("summary", Summary, name, doc, labels)
+        assert isinstance(metric, Summary)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            items = [(name, kind, doc, dict(series)) for name, (kind, doc, series) in self._metrics.items()]
+        for name, kind, doc, series in sorted(items):
+            lines.append(f"# HELP {name} {doc}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in series.items():
+                try:
+                    lines.extend(metric.samples(name, labels))
+                except Exception:  # a broken gauge callback must not break the whole scrape
+                    logging.exception("Failed to collect metric %s", name)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+async def start_metrics_server(port: int, registry: MetricsRegistry = REGISTRY) -> web.AppRunner:
+    """Serves registry.render() on http://0.0.0.0:<port>/metrics"""
+
+    async def handle(_: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type="text/plain")
+
+    web_app = web.Application()
+    web_app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    logging.info("Metrics are served on port %s", port)
+    return runner
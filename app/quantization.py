@@ -0,0 +1,297 @@
+import argparse
+import json
+import logging
+import os
+import time
+import weakref
+from typing import Any
+from typing import Callable
+from typing import Sequence
+
+import numpy as np
+import numpy.typing as npt
+
+
+QUANTIZATION_FILE = "int8.json"
+CODES_FILE = "codes{run}.i8"  # every training run writes its own files, named in the meta file
+SCALES_FILE = "scales{run}.f32"
+RETRAIN_GROWTH = 4  # scales are retrained once the index outgrows the training set this many times
+SCAN_BATCH = 256  # rows dequantized at once; 1.5 MB of floats stay in the CPU cache for the dot product
+
+
+def _normalize(matrix: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32)
+
+
+def train_scales(vectors: npt.NDArray[np.float32], sample: int = 65536, seed: int = 0) -> npt.NDArray[np.float32]:
+    """
+    Symmetric per-dimension scales: the largest absolute value of a dimension
+    over at most `sample` rows maps to 127.
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(vectors), min(len(vectors), sample), replace=False))
+    peaks = np.abs(np.asarray(vectors[rows], dtype=np.float32)).max(axis=0)
+    peaks[peaks == 0] = 1.0
+    return (peaks / 127).astype(np.float32)
+
+
+def quantize(vectors: npt.NDArray[np.float32], scales: npt.NDArray[np.float32]) -> npt.NDArray[np.int8]:
+    """int8 codes of the rows; values beyond the trained range are clipped"""
+    codes = np.empty(vectors.shape, dtype=np.int8)
+    for start in range(0, len(vectors), SCAN_BATCH):
+        batch = np.asarray(vectors[start : start + SCAN_BATCH], dtype=np.float32)
+        codes[start : start + len(batch)] = np.clip(np.rint(batch / scales), -127, 127)
+    return codes
+
+
+def _paths(folder: str, meta: dict[str, int]) -> tuple[str, str]:
+    """Codes and scales files of the training run in meta; indexes written before runs were numbered use run 0"""
+    run = meta.get("run", 0)
+    suffix = f".{run}" if run else ""
+    return (
+        os.path.join(folder, CODES_FILE.format(run=suffix)),
+        os.path.join(folder, SCALES_FILE.format(run=suffix)),
+    )
+
+
+def build_quantized_index(folder: str, vectors: npt.NDArray[np.float32]) -> None:
+    """
+    Trains the scales and writes the int8 codes of every row next to the mmap vector index.
+
+    The codes and scales go to new files of the next training run and the meta
+    file is switched to them last. Running bots keep their mapping of the
+    previous run's files, which are only unlinked, never rewritten.
+    """
+    started = time.perf_counter()
+    previous = QuantizedIndex.meta(folder)
+    meta = {
+        "dim": vectors.shape[1],
+        "count": len(vectors),
+        "trained_on": len(vectors),
+        "run": previous.get("run", 0) + 1 if previous else 1,
+    }
+    codes_path, scales_path = _paths(folder, meta)
+    scales = train_scales(vectors) if len(vectors) else np.ones(vectors.shape[1], np.float32)
+    scales.tofile(scales_path)
+    with open(codes_path, "wb") as f:
+        quantize(vectors, scales).tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    _write_meta(folder, meta)
+    if previous is not None:
+        for path in _paths(folder, previous):
+            if os.path.exists(path):
+                os.remove(path)
+    logging.info("int8 codes written to %s: %s vectors in %.1f s", folder, len(vectors), time.perf_counter() - started)
+
+
+def update_quantized_index(folder: str, vectors: npt.NDArray[np.float32]) -> None:
+    """
+    Quantizes rows appended to the vector index since the last update with the
+    existing scales. Retrains from scratch when there are no codes yet, the
+    dimension changed, the vector index was rewritten with fewer rows, or it
+    grew RETRAIN_GROWTH times since training.
+    """
+    meta = QuantizedIndex.meta(folder)
+    if (
+        meta is None
+        or meta["dim"] != vectors.shape[1]
+        or meta["count"] > len(vectors)
+        or len(vectors) > RETRAIN_GROWTH * max(meta["trained_on"], 1)
+    ):
+        build_quantized_index(folder, vectors)
+        return
+    if meta["count"] == len(vectors):
+        return
+    codes_path, scales_path = _paths(folder, meta)
+    scales = np.fromfile(scales_path, dtype=np.float32)
+    codes = quantize(vectors[meta["count"] :], scales)
+    # Append-only: bots map the first meta["count"] rows, which are left untouched
+    with open(codes_path, "r+b") as f:
+        f.truncate(meta["count"] * meta["dim"])  # drop rows left by an interrupted update
+        f.seek(0, os.SEEK_END)
+        f.write(codes.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    _write_meta(folder, {**meta, "count": len(vectors)})
+    logging.info("int8 codes in %s: %s rows quantized", folder, len(codes))
+
+
+def _write_meta(folder: str, meta: dict[str, int]) -> None:
+    tmp_path = os.path.join(folder, f"{QUANTIZATION_FILE}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(folder, QUANTIZATION_FILE))
+
+
+class QuantizedIndex:
+    """
+    Exhaustive search over int8 scalar-quantized vectors.
+
+    The codes take a quarter of the float32 matrix, so a full scan reads four
+    times less memory. With `rescore` > 0 the rescore * top_k best candidates
+    are re-scored exactly on the float vectors, which touches only their rows
+    and makes the returned scores exact. Rows added to the vector index after
+    the codes were written are quantized on load.
+    """
+
+    def __init__(self, folder: str, vectors: npt.NDArray[np.float32], rescore: int = 4) -> None:
+        meta = self.meta(folder)
+        if meta is None:
+            raise FileNotFoundError(os.path.join(folder, QUANTIZATION_FILE))
+        self.vectors = vectors
+        self.rescore = rescore
+        codes_path, scales_path = _paths(folder, meta)
+        self.scales = np.fromfile(scales_path, dtype=np.float32)
+        count = min(meta["count"], len(vectors))
+        codes: npt.NDArray[np.int8] = (
+            np.memmap(codes_path, dtype=np.int8, mode="r", shape=(count, meta["dim"]))
+            if count
+            else np.empty((0, vectors.shape[1]), dtype=np.int8)
+        )
+        if count < len(vectors):
+            codes = np.concatenate([codes, quantize(vectors[count:], self.scales)])
+        self.codes = codes
+        # Mapped float rows would be faulted in with their neighbours and stay in RSS;
+        # read only the candidate rows through the page cache instead
+        self._fd: int | None = None
+        if isinstance(vectors, np.memmap) and vectors.filename:
+            self._fd = os.open(vectors.filename, os.O_RDONLY)
+            weakref.finalize(self, os.close, self._fd)
+
+    @staticmethod
+    def meta(folder: str) -> dict[str, int] | None:
+        path = os.path.join(folder, QUANTIZATION_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            meta: dict[str, int] = json.load(f)
+        return meta
+
+    def scores(self, query: Sequence[float] | npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+        """Approximate cosine similarity of the query to every row"""
+        q = _normalize(np.asarray(query, dtype=np.float32)) * self.scales
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        # numpy has no int8 BLAS: codes are widened batch by batch into a reused buffer
+        buffer = np.empty((SCAN_BATCH, self.codes.shape[1]), dtype=np.float32)
+        for start in range(0, len(self.codes), SCAN_BATCH):
+            batch = buffer[: min(SCAN_BATCH, len(self.codes) - start)]
+            batch[:] = self.codes[start : start + len(batch)]
+            np.dot(batch, q, out=scores[start : start + len(batch)])
+        return scores
+
+    def float_rows(self, rows: npt.NDArray[np.int64]) -> npt.NDArray[np.float32]:
+        if self._fd is None:
+            return np.asarray(self.vectors[rows], dtype=np.float32)
+        assert isinstance(self.vectors, np.memmap)
+        row_bytes = self.vectors.shape[1] * 4
+        offset = self.vectors.offset
+        data = b"".join(os.pread(self._fd, row_bytes, offset + int(row) * row_bytes) for row in rows)
+        return np.frombuffer(data, dtype=np.float32).reshape(len(rows), -1)
+
+    def search(
+        self, query: Sequence[float] | npt.NDArray[np.float32], top_k: int, rescore: int | None = None
+    ) -> list[tuple[int, float]]:
+        """Returns (row, cosine similarity) pairs of the approximate top_k, best first"""
+        if top_k <= 0 or not len(self.codes):
+            return []
+        rescore = self.rescore if rescore is None else rescore
+        scores = self.scores(query)
+        k = min(max(top_k * rescore, top_k), len(scores))
+        rows = np.argpartition(scores, -k)[-k:] if k < len(scores) else np.arange(len(scores))
+        if rescore > 0:
+            rows = np.sort(rows)  # sequential reads of the float rows
+            top = self.float_rows(rows) @ _normalize(np.asarray(query, dtype=np.float32))
+        else:
+            top = scores[rows]
+        best = np.argsort(top)[::-1][:top_k]
+        return [(int(rows[i]), float(top[i])) for i in best]
+
+
+def _rss_bytes() -> int:
+    with open("/proc/self/statm", "r", encoding="utf-8") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _exact_search(vectors: npt.NDArray[np.float32], q: npt.NDArray[np.float32], top_k: int) -> list[tuple[int, float]]:
+    scores = vectors @ q
+    rows = np.argpartition(scores, -top_k)[-top_k:]
+    return [(int(row), float(scores[row])) for row in rows]
+
+
+def benchmark(
+    folder: str,
+    open_vectors: Callable[[], npt.NDArray[np.float32]],
+    rescores: Sequence[int],
+    top_k: int = 10,
+    sample_size: int = 200,
+    noise: float = 0.05,
+    seed: int = 0,
+) -> list[dict[str, Any]]:
+    """
+    Index size, resident memory growth, mean latency and recall@top_k of the
+    int8 search against the exact float search, for every rescore factor.
+    Queries are stored vectors with gaussian noise. open_vectors maps the
+    float matrix anew for every variant, so the RSS growth counts only the
+    pages touched by its queries.
+    """
+    vectors = open_vectors()
+    update_quantized_index(folder, vectors)
+    top_k = min(top_k, len(vectors))
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)
+    sample = np.asarray(vectors[np.sort(rows)], dtype=np.float32)
+    sample = _normalize(sample + rng.normal(0, noise, sample.shape).astype(np.float32))
+
+    def run(search: Callable[[npt.NDArray[np.float32]], list[tuple[int, float]]]) -> tuple[list[set[int]], float, int]:
+        rss = _rss_bytes()
+        started = time.perf_counter()
+        found = [{row for row, _ in search(q)} for q in sample]
+        return found, (time.perf_counter() - started) * 1000 / len(sample), _rss_bytes() - rss
+
+    float_vectors = open_vectors()
+    exact, exact_ms, exact_rss = run(lambda q: _exact_search(float_vectors, q, top_k))
+    results: list[dict[str, Any]] = [
+        {
+            "variant": "float32",
+            "size_mb": vectors.nbytes / 2**20,
+            "rss_mb": exact_rss / 2**20,
+            "latency_ms": exact_ms,
+            "recall": 1.0,
+        }
+    ]
+    meta = QuantizedIndex.meta(folder)
+    assert meta is not None
+    codes_bytes = sum(os.path.getsize(path) for path in _paths(folder, meta))
+    for rescore in rescores:
+        index = QuantizedIndex(folder, open_vectors())
+        found, latency_ms, rss = run(lambda q: index.search(q, top_k, rescore))
+        results.append(
+            {
+                "variant": f"int8 rescore={rescore}",
+                "size_mb": codes_bytes / 2**20,
+                "rss_mb": rss / 2**20,
+                "latency_ms": latency_ms,
+                "recall": sum(len(f & e) / len(e) for f, e in zip(found, exact)) / len(sample),
+            }
+        )
+    return results
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Write int8 codes and compare them with the float index")
+    arg_parser.add_argument("mmap_folder", nargs="?", default="data/index_mmap_1024")
+    arg_parser.add_argument("--rescore", type=int, nargs="+", default=[0, 2, 4, 8])
+    arg_parser.add_argument("--top-k", type=int, default=10)
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(module)s: %(message)s")
+
+    from vector_store import MmapVectorStore
+
+    for row in benchmark(args.mmap_folder, lambda: MmapVectorStore(args.mmap_folder).vectors, args.rescore, args.top_k):
+        print(
+            f"{row['variant']:<18} size={row['size_mb']:.1f} MB rss=+{row['rss_mb']:.1f} MB "
+            f"latency={row['latency_ms']:.3f} ms recall@{args.top_k}={row['recall']:.3f}"
+        )
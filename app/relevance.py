@@ -0,0 +1,186 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import random
+import time
+from logging.handlers import MemoryHandler
+from typing import Awaitable
+from typing import Callable
+from typing import Iterable
+
+from metrics import REGISTRY
+
+
+JUDGE_MODES = ("sequential", "speculative", "score")
+
+Judge = Callable[[], Awaitable[bool]]
+Generate = Callable[[Callable[[str], None] | None], Awaitable[str]]
+
+
+def calibrate_threshold(samples: Iterable[tuple[float, bool]]) -> tuple[float, float]:
+    """
+    Picks the retrieval score threshold that agrees most often with the LLM judge.
+    Takes (top similarity score, judge verdict) pairs, returns (threshold, agreement share).
+    """
+    pairs = sorted(samples)
+    if not pairs:
+        return 0.0, 0.0
+    positives = sum(verdict for _, verdict in pairs)
+    # Threshold below every score: all accepted, agreement = share of YES verdicts
+    best_threshold, best_agreed = pairs[0][0], positives
+    agreed = positives
+    for i, (score, verdict) in enumerate(pairs):
+        agreed += -1 if verdict else 1  # pairs[i] is rejected once the threshold moves above it
+        if i + 1 < len(pairs) and pairs[i + 1][0] == score:
+            continue
+        threshold = pairs[i + 1][0] if i + 1 < len(pairs) else score + 1e-6
+        if agreed > best_agreed:
+            best_threshold, best_agreed = threshold, agreed
+    return best_threshold, best_agreed / len(pairs)
+
+
+def read_calibration_log(path: str) -> list[tuple[float, bool]]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [(row["score"], row["judge"]) for row in map(json.loads, f) if row]
+
+
+class RelevanceGate:
+    """
+    Decides whether the retrieved context is good enough to answer.
+
+    - sequential: the LLM judge runs first, generation starts after YES;
+    - speculative: judge and generation start together, the generation is
+      cancelled (and its streamed output held back) until the judge says YES;
+    - score: the top retrieval similarity is compared with a calibrated
+      threshold and the judge is only called for a sample of requests
+      (audit_rate) in the background to measure agreement.
+
+    Whenever a judge verdict is known the score gate decision is compared
+    with it, and the pair is appended to calibration_path for calibrate_threshold.
+    The pairs are buffered in memory and written every calibration_buffer pairs,
+    so the event loop does not touch the file on every judgement.
+    """
+
+    def __init__(
+        self,
+        mode: str,
+        threshold: float,
+        audit_rate: float = 0.0,
+        calibration_path: str | None = None,
+        calibration_buffer: int = 100,
+    ) -> None:
+        if mode not in JUDGE_MODES:
+            raise ValueError(f"Unknown judge mode {mode!r}, expected one of {JUDGE_MODES}")
+        self.mode = mode
+        self.threshold = threshold
+        self.audit_rate = audit_rate
+        self._calibration: logging.Logger | None = None
+        if calibration_path:
+            self._calibration = logging.getLogger("relevance.calibration")
+            self._calibration.propagate = False
+            self._calibration.setLevel(logging.INFO)
+            target = logging.FileHandler(calibration_path, encoding="utf-8", delay=True)
+            self._calibration.addHandler(MemoryHandler(calibration_buffer, logging.CRITICAL, target))
+        self._audits: set[asyncio.Task[None]] = set()
+
+        self._latency = REGISTRY.summary(
+            "relevance_gate_seconds", "Time until the relevance decision", labels={"mode": mode}
+        )
+        self._compared = REGISTRY.counter("relevance_compared", "Score gate decisions with a known LLM verdict")
+        self._agreed = REGISTRY.counter("relevance_agreed", "Score gate decisions equal to the LLM verdict")
+        self._wasted = REGISTRY.counter("relevance_cancelled_generations", "Speculative generations thrown away")
+
+    @property
+    def agreement(self) -> float:
+        return self._agreed.value / self._compared.value if self._compared.value else 0.0
+
+    def _record(self, top_score: float, verdict: bool) -> None:
+        self._compared.inc()
+        if (top_score >= self.threshold) == verdict:
+            self._agreed.inc()
+        if self._calibration:
+            self._calibration.info(json.dumps({"score": top_score, "judge": verdict}))
+
+    def flush(self) -> None:
+        """Writes the buffered calibration pairs"""
+        if self._calibration:
+            for handler in self._calibration.handlers:
+                handler.flush()
+
+    async def _audit(self, judge: Judge, top_score: float) -> None:
+        try:
+            self._record(top_score, await judge())
+        except Exception:
+            logging.exception("Relevance audit failed")
+
+    @staticmethod
+    async def _discard(generation: asyncio.Task[str]) -> None:
+        """Cancels the speculative generation and retrieves its outcome, so a failure is not left unobserved"""
+        generation.cancel()
+        with contextlib.suppress(asyncio.CancelledError, Exception):
+            await generation
+
+    async def run(
+        self, judge: Judge, generate: Generate, top_score: float, on_delta: Callable[[str], None] | None = None
+    ) -> str | None:
+        """Returns the generated answer, or None when the context is not relevant"""
+        started = time.perf_counter()
+
+        if self.mode == "score":
+            is_relevant = top_score >= self.threshold
+            self._latency.observe(time.perf_counter() - started)
+            if random.random() < self.audit_rate:
+                task = asyncio.create_task(self._audit(judge, top_score))
+                self._audits.add(task)
+                task.add_done_callback(self._audits.discard)
+            logging.info("Score gate: %s (top score %.3f, threshold %.3f)", is_relevant, top_score, self.threshold)
+            return await generate(on_delta) if is_relevant else None
+
+        if self.mode == "sequential":
+            is_relevant = await judge()
+            self._latency.observe(time.perf_counter() - started)
+            self._record(top_score, is_relevant)
+            logging.info("Context judge: %s, score gate agreement %.2f", is_relevant, self.agreement)
+            return await generate(on_delta) if is_relevant else None
+
+        released = False
+        held_back: list[str] = []
+
+        def gated_delta(text: str) -> None:
+            if released and on_delta:
+                on_delta(text)
+            else:
+                held_back[:] = [text]
+
+        async def generating() -> str:
+            return await generate(gated_delta if on_delta else None)
+
+        generation: asyncio.Task[str] = asyncio.create_task(generating())
+        try:
+            is_relevant = await judge()
+        except BaseException:
+            await self._discard(generation)
+            raise
+        self._latency.observe(time.perf_counter() - started)
+        self._record(top_score, is_relevant)
+        logging.info("Context judge: %s, score gate agreement %.2f", is_relevant, self.agreement)
+
+        if not is_relevant:
+            await self._discard(generation)
+            self._wasted.inc()
+            return None
+        released = True
+        if held_back and on_delta:
+            on_delta(held_back[0])
+        return await generation
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Calibrate the score gate threshold on logged judge verdicts")
+    arg_parser.add_argument("calibration_log", nargs="?", default="data/judge_calibration.jsonl")
+    args = arg_parser.parse_args()
+    samples = read_calibration_log(args.calibration_log)
+    threshold, share = calibrate_threshold(samples)
+    print(f"samples: {len(samples)}, threshold: {threshold:.4f}, agreement with the judge: {share:.3f}")
@@ -0,0 +1,91 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Protocol
+from typing import Sequence
+
+import numpy as np
+import numpy.typing as npt
+
+
+class ScoresLexicon(Protocol):
+    def scores(self, tokens: Sequence[str]) -> npt.NDArray[np.float32]: ...
+
+
+class Reranker:
+    """
+    Second retrieval stage over an over-fetched candidate list.
+
+    Candidates are re-scored by a blend of cosine similarity (min-max scaled
+    over the candidates) and BM25 scaled by its maximum. If scoring the
+    candidates takes longer than `budget` seconds, the first-stage order is
+    kept as is; such skips are counted in `over_budget` and logged.
+    Reranked rows are cached per query key in an LRU of `cache_size` entries;
+    the key must include the index version.
+    """
+
+    def __init__(
+        self,
+        vectors: npt.NDArray[np.float32],
+        lexical_index: ScoresLexicon | None = None,
+        vector_weight: float = 0.6,
+        budget: float = 0.05,
+        cache_size: int = 1024,
+    ) -> None:
+        self.vectors = vectors
+        self.lexical_index = lexical_index
+        self.vector_weight = vector_weight if lexical_index else 1.0
+        self.budget = budget
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self.over_budget = 0
+        self._cache: OrderedDict[str, list[int]] = OrderedDict()
+
+    def cached(self, key: str) -> list[int] | None:
+        rows = self._cache.get(key)
+        if rows is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._cache.move_to_end(key)
+        return rows
+
+    def _remember(self, key: str, rows: list[int]) -> None:
+        self._cache[key] = rows
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def rerank(
+        self,
+        key: str,
+        query_embedding: Sequence[float],
+        tokens: Sequence[str] | None,
+        candidates: Sequence[int],
+    ) -> list[int]:
+        """Orders the candidate rows (given in first-stage order) best first"""
+        if not candidates:
+            return []
+
+        started = time.perf_counter()
+        rows = np.asarray(candidates)
+        q = np.asarray(query_embedding, dtype=np.float32)
+        cosine = self.vectors[rows] @ (q / (np.linalg.norm(q) or 1.0))
+        spread = float(cosine.max() - cosine.min())
+        blend = self.vector_weight * ((cosine - cosine.min()) / spread if spread else np.ones_like(cosine))
+        if self.lexical_index is not None and tokens:
+            elapsed = time.perf_counter() - started
+            if elapsed > self.budget:
+                self.over_budget += 1
+                logging.info(
+                    "Rerank skipped: scoring took %.1f ms of the %.0f ms budget", elapsed * 1000, self.budget * 1000
+                )
+                return list(candidates)
+            bm25 = self.lexical_index.scores(tokens)[rows]
+            if bm25.max() > 0:
+                blend += (1 - self.vector_weight) * bm25 / bm25.max()
+
+        order = [int(row) for row in rows[np.argsort(-blend, kind="stable")]]
+        self._remember(key, order)
+        return order
@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from typing import Callable
+
+import aiohttp
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+from aiogram.utils.exceptions import TelegramAPIError
+from metrics import REGISTRY
+from telegram_html import split_message
+
+
+class TokenBucket:
+    """
+    Token bucket: `rate` tokens per second, at most `capacity` accumulated.
+    acquire() reserves a token up front, so concurrent callers are served in FIFO order.
+    """
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def _delay(self, amount: float) -> float:
+        now = self.clock()
+        self._refill(now)
+        return max(self.updated - now, 0.0) + max(amount - self.tokens, 0.0) / self.rate
+
+    def delay(self, amount: float = 1.0) -> float:
+        """Seconds until `amount` tokens are available"""
+        return self._delay(amount)
+
+    def try_acquire(self, amount: float = 1.0) -> bool:
+        if self._delay(amount) > 0:
+            return False
+        self.tokens -= amount
+        return True
+
+    def reserve(self, amount: float = 1.0) -> float:
+        """Takes `amount` tokens, possibly going into debt; returns the seconds to wait before using them"""
+        wait = self._delay(amount)
+        self.tokens -= amount
+        return wait
+
+    async def acquire(self, amount: float = 1.0) -> None:
+        wait = self.reserve(amount)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def block(self, seconds: float) -> None:
+        """Back-off requested by the server: refilling resumes in `seconds`"""
+        self.updated = max(self.updated, self.clock() + seconds)
+        self.tokens = min(self.tokens, 0.0)
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    Token bucket whose state lives in a SQLite row, so several processes share
+    one limit. Every operation is a short IMMEDIATE transaction; wall-clock
+    time is used because the processes do not share a monotonic clock origin.
+    """
+
+    def __init__(self, path: str, name: str, rate: float, capacity: float) -> None:
+        super().__init__(rate, capacity, clock=time.time)
+        self.name = name
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        self._conn.execute("INSERT OR IGNORE INTO buckets VALUES (?, ?, ?)", (name, capacity, self.updated))
+
+    def _locked(self, operation: Callable[[], float]) -> float:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.tokens, self.updated = self._conn.execute(
+                    "SELECT tokens, updated FROM buckets WHERE name = ?", (self.name,)
+                ).fetchone()
+                result = operation()
+                self._conn.execute(
+                    "UPDATE buckets SET tokens = ?, updated = ? WHERE name = ?", (self.tokens, self.updated, self.name)
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def delay(self, amount: float = 1.0) -> float:
+        return self._locked(lambda: TokenBucket.delay(self, amount))
+
+    def try_acquire(self, amount: float = 1.0) -> bool:
+        return bool(self._locked(lambda: TokenBucket.try_acquire(self, amount)))
+
+    def reserve(self, amount: float = 1.0) -> float:
+        return self._locked(lambda: TokenBucket.reserve(self, amount))
+
+    def block(self, seconds: float) -> None:
+        def operation() -> float:
+            TokenBucket.block(self, seconds)
+            return 0.0
+
+        self._locked(operation)
+
+
+class MessageSender:
+    """
+    Delivers bot messages with one queue and one worker task per chat.
+
+    Every send takes a token from the chat bucket and from the global bucket,
+    so chats are served in parallel while both Telegram limits are respected.
+    Worker processes pass a SharedTokenBucket to share the global limit.
+    A chat worker exits after `idle_timeout` seconds without messages.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        chat_rate: float = 20 / 60,
+        chat_burst: float = 3,
+        global_rate: float = 25,
+        global_burst: float = 25,
+        idle_timeout: float = 60,
+        max_retries: int = 5,
+        global_bucket: TokenBucket | None = None,
+    ) -> None:
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.idle_timeout = idle_timeout
+        self.max_retries = max_retries
+        self.global_bucket = global_bucket or TokenBucket(global_rate, global_burst)
+        self._chat_buckets: dict[int, TokenBucket] = {}
+        self._queues: dict[int, asyncio.Queue[tuple[str, float, Callable[[], None] | None]]] = {}
+        self._workers: dict[int, asyncio.Task[None]] = {}
+
+        REGISTRY.gauge("sender_queue_depth", "Messages waiting to be sent", callback=self.queue_depth)
+        REGISTRY.gauge("sender_active_chats", "Chats with a running sender worker", callback=lambda: len(self._workers))
+        self._latency = REGISTRY.summary("sender_latency_seconds", "Time from enqueue to delivery of a message")
+        self._sent = REGISTRY.counter("sender_messages", "Message parts delivered to Telegram")
+        self._retry_after = REGISTRY.counter("sender_retry_after", "RetryAfter responses from Telegram")
+        self._failed = REGISTRY.counter("sender_failed", "Messages dropped after an API error")
+
+    def queue_depth(self) -> int:
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self._chat_buckets:
+            self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self._chat_buckets[chat_id]
+
+    async def acquire(self, chat_id: int) -> None:
+        """Reserves one API call to the chat, also used for message edits"""
+        await self._bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+
+    def block(self, chat_id: int, seconds: float) -> None:
+        self._retry_after.inc()
+        self._bucket(chat_id).block(seconds)
+
+    async def enqueue(self, chat_id: int, text: str, on_done: Callable[[], None] | None = None) -> None:
+        """Queues the text for the chat; on_done is called once all its parts are sent or dropped"""
+        if chat_id not in self._queues:
+            self._queues[chat_id] = asyncio.Queue()
+        await self._queues[chat_id].put((text, time.monotonic(), on_done))
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._chat_worker(chat_id))
+
+    async def _chat_worker(self, chat_id: int) -> None:
+        queue = self._queues[chat_id]
+        try:
+            while True:
+                try:
+                    text, enqueued_at, on_done = await asyncio.wait_for(queue.get(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    if queue.empty():
+                        return
+                    continue
+                try:
+                    for part in split_message(text):
+                        await self._send(chat_id, part)
+                    self._latency.observe(time.monotonic() - enqueued_at)
+                except Exception:
+                    # The message is dropped, the worker keeps serving the chat
+                    logging.exception("Failed to deliver message to chat %s", chat_id)
+                    self._failed.inc()
+                finally:
+                    if on_done:
+                        on_done()
+        finally:
+            del self._workers[chat_id]
+            if queue.empty():
+                self._queues.pop(chat_id, None)
+                self._chat_buckets.pop(chat_id, None)
+
+    async def _send(self, chat_id: int, text: str) -> None:
+        for _ in range(self.max_retries):
+            await self.acquire(chat_id)
+            try:
+                await self.bot.send_message(chat_id, text, parse_mode="HTML")
+                self._sent.inc()
+                return
+            except RetryAfter as e:
+                logging.warning("Flood control in chat %s, retry in %s s", chat_id, e.timeout)
+                self.block(chat_id, e.timeout)
+            except (TelegramAPIError, aiohttp.ClientError, asyncio.TimeoutError):
+                logging.exception("Failed to send message to chat %s", chat_id)
+                break
+        self._failed.inc()
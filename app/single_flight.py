@@ -0,0 +1,89 @@
+import asyncio
+import logging
+from typing import Awaitable
+from typing import Callable
+from typing import Generic
+from typing import Hashable
+from typing import TypeVar
+
+
+T = TypeVar("T")
+OnDelta = Callable[[str], None]
+
+
+class _Flight(Generic[T]):
+    def __init__(self) -> None:
+        self.task: asyncio.Task[T] | None = None
+        self.listeners: list[OnDelta] = []
+        self.latest: str | None = None
+
+    def publish(self, partial: str) -> None:
+        self.latest = partial
+        for listener in list(self.listeners):
+            try:
+                listener(partial)
+            except Exception:  # one broken waiter must not break the stream of the others
+                logging.exception("Partial answer listener failed")
+
+
+class SingleFlight(Generic[T]):
+    """
+    Coalesces concurrent calls with the same key into one in-flight task.
+
+    The first caller starts the call, later callers with the same key wait for
+    its result instead of starting their own. Waiters are shielded from each
+    other: cancelling one (or its timeout) leaves the shared task running for
+    the rest; the task also finishes when every waiter is gone, so its result
+    still reaches the caches. An exception of the call is raised to every
+    waiter. Partial results passed to `publish` reach all current waiters,
+    late joiners first get the latest one.
+    """
+
+    def __init__(self) -> None:
+        self.leaders = 0
+        self.coalesced = 0
+        self._flights: dict[Hashable, _Flight[T]] = {}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Whether a call with the key is in flight, so run() would join it"""
+        return key in self._flights
+
+    async def run(
+        self,
+        key: Hashable,
+        call: Callable[[OnDelta | None], Awaitable[T]],
+        on_delta: OnDelta | None = None,
+    ) -> T:
+        """
+        Result of call(publish) for the key. publish is None unless the caller
+        that starts the flight asked for partial results with on_delta.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            self._flights[key] = flight
+            self.leaders += 1
+            flight.task = asyncio.create_task(self._call(call, flight.publish if on_delta else None))
+            flight.task.add_done_callback(lambda _: self._flights.pop(key, None))
+        else:
+            self.coalesced += 1
+            logging.info("Request coalesced with an identical one in flight")
+            if on_delta and flight.latest is not None:
+                on_delta(flight.latest)
+
+        if on_delta:
+            flight.listeners.append(on_delta)
+        try:
+            assert flight.task is not None
+            return await asyncio.shield(flight.task)
+        finally:
+            if on_delta:
+                flight.listeners.remove(on_delta)
+
+    @staticmethod
+    async def _call(call: Callable[[OnDelta | None], Awaitable[T]], publish: OnDelta | None) -> T:
+        return await call(publish)
@@ -0,0 +1,72 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from metrics import REGISTRY
+
+
+def process_age() -> float | None:
+    """Seconds since the process was started, None where /proc is not available"""
+    try:
+        with open("/proc/self/stat", "r", encoding="utf-8") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])  # field 22, starttime
+        with open("/proc/uptime", "r", encoding="utf-8") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+def current_rss_mb() -> float | None:
+    """Resident set size of the process in megabytes, None where /proc is not available"""
+    try:
+        with open("/proc/self/statm", "r", encoding="utf-8") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round(pages * os.sysconf("SC_PAGE_SIZE") / 2**20, 1)
+
+
+class StartupProfile:
+    """
+    Wall-clock breakdown of the startup phases, logged and exported as
+    startup_phase_seconds{phase}. report() compares the time since the
+    process start with a target, so a slow import or load shows up in the log.
+    """
+
+    def __init__(self, metric: str = "startup_phase_seconds") -> None:
+        self.metric = metric
+        self.phases: dict[str, float] = {}
+
+    def record(self, name: str, seconds: float) -> None:
+        self.phases[name] = seconds
+        REGISTRY.gauge(self.metric, "Duration of a loading phase", labels={"phase": name}).set(seconds)
+
+    def breakdown(self) -> str:
+        return ", ".join(f"{name} {seconds:.2f} s" for name, seconds in self.phases.items())
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def report(self, milestone: str, target: float | None = None) -> None:
+        age = process_age()
+        breakdown = self.breakdown()
+        if age is None:
+            logging.info("%s (%s)", milestone, breakdown)
+            return
+        REGISTRY.gauge("startup_milestone_seconds", "Time from the process start", labels={"milestone": milestone}).set(
+            age
+        )
+        if target is not None and age > target:
+            logging.warning(
+                "%s %.2f s after the process start, over the %.1f s target (%s)", milestone, age, target, breakdown
+            )
+        else:
+            logging.info("%s %.2f s after the process start (%s)", milestone, age, breakdown)
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.utils.exceptions import MessageNotModified
+from aiogram.utils.exceptions import RetryAfter
+from aiogram.utils.exceptions import TelegramAPIError
+from sender import MessageSender
+from telegram_html import MESSAGE_LIMIT
+from telegram_html import balanced_prefix
+from telegram_html import split_message
+
+
+PLACEHOLDER = "⏳"
+
+
+class StreamingReply:
+    """
+    Reply that grows while the answer is generated.
+
+    start() posts a placeholder, update() records the latest partial text and
+    a background task edits the message with it, no more often than
+    `min_interval` and within the sender's rate limits. finish() writes the
+    final text; parts beyond the Telegram limit are sent as new messages.
+    """
+
+    def __init__(self, bot: Bot, sender: MessageSender, chat_id: int, min_interval: float = 1.5) -> None:
+        self.bot = bot
+        self.sender = sender
+        self.chat_id = chat_id
+        self.min_interval = min_interval
+        self.message_id: int | None = None
+        self._latest = ""
+        self._shown = ""
+        self._changed = asyncio.Event()
+        self._edit_task: asyncio.Task[None] | None = None
+        self._last_edit = 0.0
+
+    async def start(self, text: str = PLACEHOLDER) -> None:
+        await self.sender.acquire(self.chat_id)
+        try:
+            message = await self.bot.send_message(self.chat_id, text, parse_mode="HTML")
+        except TelegramAPIError:
+            logging.exception("Failed to post a placeholder to chat %s", self.chat_id)
+            return
+        self.message_id = message.message_id
+        self._shown = text
+        self._last_edit = time.monotonic()
+        self._edit_task = asyncio.create_task(self._edit_loop())
+
+    def update(self, text: str) -> None:
+        self._latest = text
+        self._changed.set()
+
+    async def _edit_loop(self) -> None:
+        while True:
+            await self._changed.wait()
+            await asyncio.sleep(max(0.0, self._last_edit + self.min_interval - time.monotonic()))
+            await self.sender.acquire(self.chat_id)
+            self._changed.clear()
+            # Partial text may end inside a tag or an entity: cut it to valid HTML first
+            await self._edit(balanced_prefix(self._latest[: MESSAGE_LIMIT - 64]))
+
+    async def _edit(self, text: str) -> None:
+        if text == self._shown or not text.strip():
+            return
+        try:
+            await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, parse_mode="HTML")
+            self._shown = text
+        except MessageNotModified:
+            pass
+        except RetryAfter as e:
+            self.sender.block(self.chat_id, e.timeout)
+        except TelegramAPIError:
+            logging.exception("Failed to edit message in chat %s", self.chat_id)
+        self._last_edit = time.monotonic()
+
+    async def finish(self, text: str) -> None:
+        if self._edit_task:
+            self._edit_task.cancel()
+            try:
+                await self._edit_task
+            except asyncio.CancelledError:
+                pass
+        if self.message_id is None:
+            await self.sender.enqueue(self.chat_id, text)
+            return
+
+        first, *rest = split_message(text)
+        for _ in range(self.sender.max_retries):
+            await self.sender.acquire(self.chat_id)
+            try:
+                await self.bot.edit_message_text(
+                    first, chat_id=self.chat_id, message_id=self.message_id, parse_mode="HTML"
+                )
+                break
+            except MessageNotModified:
+                break
+            except RetryAfter as e:
+                self.sender.block(self.chat_id, e.timeout)
+            except TelegramAPIError:
+                logging.exception("Failed to write the final answer to chat %s", self.chat_id)
+                rest.insert(0, first)
+                break
+        else:
+            rest.insert(0, first)
+        for part in rest:
+            await self.sender.enqueue(self.chat_id, part)
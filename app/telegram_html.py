@@ -0,0 +1,91 @@
+import re
+
+
+MESSAGE_LIMIT = 4096  # Telegram limit for the text of one message
+
+_tag_regex = re.compile(r"<(/?)([a-zA-Z-]+)[^>]*>")
+_token_regex = re.compile(r"<[^>]*>|&#?\w+;|[^<&]+|[<&]")
+
+
+def escape_html(text: str) -> str:
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+
+def open_tags(text: str) -> list[tuple[str, str]]:
+    """Stack of (name, opening tag) left unclosed at the end of text"""
+    stack: list[tuple[str, str]] = []
+    for match in _tag_regex.finditer(text):
+        name = match.group(2).lower()
+        if not match.group(1):
+            stack.append((name, match.group(0)))
+        elif any(open_name == name for open_name, _ in stack):
+            while stack.pop()[0] != name:
+                pass
+    return stack
+
+
+def close_tags(text: str) -> str:
+    return "".join(f"</{name}>" for name, _ in reversed(open_tags(text)))
+
+
+def reopen_tags(text: str) -> str:
+    return "".join(tag for _, tag in open_tags(text))
+
+
+def balanced_prefix(text: str) -> str:
+    """
+    Cuts a partially received HTML text to something Telegram accepts:
+    drops a trailing incomplete tag or entity and closes the open tags.
+    """
+    lt = text.rfind("<")
+    if lt > text.rfind(">"):
+        text = text[:lt]
+    amp = text.rfind("&")
+    if amp != -1 and ";" not in text[amp:] and re.fullmatch(r"&#?\w*", text[amp:]):
+        text = text[:amp]
+    return text + close_tags(text)
+
+
+def _split_long(text: str, size: int) -> list[str]:
+    """Splits text into pieces of at most size chars, never inside a tag or an entity"""
+    pieces: list[str] = []
+    current = ""
+    for token in _token_regex.findall(text):
+        if current and len(current) + len(token) > size:
+            pieces.append(current)
+            current = ""
+        while len(token) > size and not token.startswith(("<", "&")):
+            cut = token.rfind(" ", 0, size)
+            cut = cut + 1 if cut > 0 else size
+            pieces.append(token[:cut])
+            token = token[cut:]
+        current += token
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> list[str]:
+    """
+    Splits an HTML message into parts that fit the Telegram limit.
+    Parts are cut at line breaks where possible, every part is valid HTML:
+    tags open at the cut are closed and reopened in the next part.
+    """
+    if len(text) <= limit:
+        return [text]
+
+    pieces: list[str] = []
+    for line in text.splitlines(keepends=True):
+        pieces.extend(_split_long(line, limit // 2))
+
+    parts: list[str] = []
+    current = ""
+    for piece in pieces:
+        candidate = current + piece
+        if current and len(candidate) + len(close_tags(candidate)) > limit:
+            parts.append(current + close_tags(current))
+            current = reopen_tags(current) + piece
+        else:
+            current = candidate
+    parts.append(current)
+    return [part for part in parts if part.strip()]
@@ -0,0 +1,30 @@
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+
+if TYPE_CHECKING:
+    import tiktoken
+
+
+# cl100k_base is the newest encoding of the pinned tiktoken; it tracks the chat model counts closely
+ENCODING_NAME = "cl100k_base"
+
+
+@lru_cache(maxsize=1)
+def _encoding() -> "tiktoken.Encoding":
+    import tiktoken  # imported on first use, it is not needed to start the bot
+
+    return tiktoken.get_encoding(ENCODING_NAME)
+
+
+def count_tokens(text: str) -> int:
+    return len(_encoding().encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, budget: int) -> str:
+    """The longest prefix of text within budget tokens, cut back to a word boundary"""
+    tokens = _encoding().encode(text, disallowed_special=())
+    if len(tokens) <= budget:
+        return text
+    prefix: str = _encoding().decode(tokens[:budget])
+    return prefix[: prefix.rfind(" ")] if " " in prefix else prefix
@@ -0,0 +1,126 @@
+import argparse
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+from typing import Iterator
+
+from metrics import REGISTRY
+from metrics import Summary
+
+
+class Trace:
+    """Stage durations and token counts of one answered question"""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans: dict[str, float] = {}
+        self.tokens: dict[str, int] = {}
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(stage, time.perf_counter() - started)
+
+    def add_span(self, stage: str, seconds: float) -> None:
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+    def add_tokens(self, kind: str, count: int) -> None:
+        self.tokens[kind] = self.tokens.get(kind, 0) + count
+
+
+current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Times the block as a stage of the current trace, a no-op outside of a trace"""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    with trace.span(stage):
+        yield
+
+
+def add_tokens(kind: str, count: int) -> None:
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_tokens(kind, count)
+
+
+class Tracer:
+    """
+    Starts traces and exports finished ones.
+
+    Stage durations go to the answer_stage_seconds summary (p50/p95/p99 on the
+    metrics endpoint), token counts to the answer_tokens counter. With
+    jsonl_path every trace is also appended as one JSON line to a rolling file.
+    Only a few perf_counter calls and dict updates are done per stage.
+    """
+
+    def __init__(self, jsonl_path: str | None = None, max_bytes: int = 10_000_000, backup_count: int = 2) -> None:
+        self._total = REGISTRY.summary("answer_seconds", "Time from the question to the delivered answer")
+        self._logger: logging.Logger | None = None
+        if jsonl_path:
+            self._logger = logging.getLogger("tracing.jsonl")
+            self._logger.propagate = False
+            self._logger.setLevel(logging.INFO)
+            self._logger.addHandler(RotatingFileHandler(jsonl_path, maxBytes=max_bytes, backupCount=backup_count))
+
+    def start(self, name: str) -> Trace:
+        """Creates a trace and makes it current for the calling task and the tasks it spawns"""
+        trace = Trace(name)
+        current_trace.set(trace)
+        return trace
+
+    def finish(self, trace: Trace) -> None:
+        total = time.perf_counter() - trace.started
+        self._total.observe(total)
+        for stage, seconds in trace.spans.items():
+            REGISTRY.summary(
+                "answer_stage_seconds", "Time spent in a stage of answering", labels={"stage": stage}
+            ).observe(seconds)
+        for kind, count in trace.tokens.items():
+            REGISTRY.counter("answer_tokens", "LLM tokens used for answers", labels={"kind": kind}).inc(count)
+        if self._logger:
+            record = {
+                "ts": time.time(),
+                "name": trace.name,
+                "total": total,
+                "spans": trace.spans,
+                "tokens": trace.tokens,
+            }
+            self._logger.info(json.dumps(record))
+
+
+def summarize(path: str) -> dict[str, dict[str, float]]:
+    """p50/p95/p99 of every stage and of the total over a JSONL trace file"""
+    values: dict[str, list[float]] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            values.setdefault("total", []).append(record["total"])
+            for stage, seconds in record["spans"].items():
+                values.setdefault(stage, []).append(seconds)
+    result: dict[str, dict[str, float]] = {}
+    for stage, samples in values.items():
+        samples.sort()
+        result[stage] = {"count": len(samples)}
+        for q in Summary.quantiles:
+            result[stage][f"p{round(q * 100)}"] = samples[min(len(samples) - 1, int(q * len(samples)))]
+    return result
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Stage latency percentiles from a JSONL trace file")
+    arg_parser.add_argument("trace_log", nargs="?", default="app/logs/traces.jsonl")
+    args = arg_parser.parse_args()
+    for stage, row in summarize(args.trace_log).items():
+        print(f"{stage:>16}: n={row['count']:<6} p50={row['p50']:.3f}s p95={row['p95']:.3f}s p99={row['p99']:.3f}s")
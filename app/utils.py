@@ -1,5 +1,12 @@
-from string import punctuation
+import asyncio
+import multiprocessing
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from typing import Any
+from typing import Sequence
 
 import nltk
 import numpy as np
@@ -8,24 +15,161 @@ from pymystem3 import Mystem
 
 
 nltk.download('stopwords')
-mystem = Mystem()
-rus_stopwords = stopwords.words('russian')
+rus_stopwords = frozenset(stopwords.words('russian'))
+skip_tokens = frozenset({"https", "http", "www"})
+word_regex = re.compile(r"\w+")
+SENTINEL = "|"  # separates the words of a batch on the single line sent to Mystem; never part of a \w+ word
+
+_worker_mystem: Mystem | None = None
+
+
+def _init_worker() -> None:
+    global _worker_mystem
+    _worker_mystem = Mystem()
+
+
+def _lemmas(mystem: Mystem, text: str) -> list[list[str]]:
+    """Lemmas of the single-line text, grouped by the SENTINEL separators Mystem passes through as non-words"""
+    groups: list[list[str]] = [[]]
+    for item in mystem.analyze(text):
+        token = item.get("text", "")
+        if "analysis" not in item and SENTINEL in token:
+            groups.extend([] for _ in range(token.count(SENTINEL)))
+        elif item.get("analysis"):
+            groups[-1].append(item["analysis"][0]["lex"])
+        elif token.strip():
+            groups[-1].append(token.strip())  # numbers, unknown words, "_" inside a \w+ word
+    return groups
+
+
+def _lemmatize_words(words: Sequence[str]) -> list[str]:
+    """
+    Lemmatizes a batch of words in one Mystem round-trip. pymystem3 sends every
+    input line to Mystem separately, so the words go on one line, separated
+    by SENTINEL, and the lemmas are split back at it.
+    """
+    global _worker_mystem
+    if _worker_mystem is None:
+        _init_worker()
+    assert _worker_mystem is not None
+    groups = _lemmas(_worker_mystem, f" {SENTINEL} ".join(words))
+    if len(groups) != len(words):  # never expected; word by word keeps the mapping exact
+        groups = [_lemmas(_worker_mystem, word)[0] for word in words]
+    return ["".join(group) or word for group, word in zip(groups, words)]
+
+
+class Lemmatizer:
+    """
+    Lemmatization service: long-lived Mystem processes in a process pool
+    and an LRU word -> lemma cache in front of them.
+
+    A batch of texts costs one Mystem round-trip per pool chunk for all words
+    not seen before; repeated words never leave the cache.
+    """
+
+    def __init__(self, workers: int = 2, cache_size: int = 200_000, min_chunk: int = 500) -> None:
+        self.workers = workers
+        self.cache_size = cache_size
+        self.min_chunk = min_chunk
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool: ProcessPoolExecutor | None = None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # The bot has executor threads by now; forking it could copy a lock held by one of them.
+            # Workers fork from a clean forkserver process instead, which imports this module once.
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            if start_method == "forkserver":
+                multiprocessing.get_context("forkserver").set_forkserver_preload([__name__])
+            context = multiprocessing.get_context(start_method)
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_init_worker)
+        return self._pool
+
+    def start(self) -> None:
+        """Starts the worker pool and a Mystem process ahead of the first query"""
+        if self.workers:
+            self._executor().submit(_lemmatize_words, ["старт"]).result()
+
+    def _cached(self, words: Sequence[str]) -> tuple[dict[str, str], list[str]]:
+        found: dict[str, str] = {}
+        missing: dict[str, None] = {}
+        with self._lock:
+            for word in words:
+                if word in found or word in missing:
+                    continue
+                lemma = self._cache.get(word)
+                if lemma is None:
+                    missing[word] = None
+                else:
+                    self._cache.move_to_end(word)
+                    found[word] = lemma
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, list(missing)
+
+    def _store(self, lemmas: dict[str, str]) -> None:
+        with self._lock:
+            self._cache.update(lemmas)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def lemmatize_words(self, words: Sequence[str]) -> dict[str, str]:
+        found, missing = self._cached(words)
+        if missing:
+            size = max(self.min_chunk, -(-len(missing) // max(self.workers, 1)))
+            chunks = [missing[i : i + size] for i in range(0, len(missing), size)]
+            if self.workers:
+                results = list(self._executor().map(_lemmatize_words, chunks))
+            else:
+                results = [_lemmatize_words(chunk) for chunk in chunks]
+            lemmas = {word: lemma for chunk, result in zip(chunks, results) for word, lemma in zip(chunk, result)}
+            self._store(lemmas)
+            found.update(lemmas)
+        return found
+
+    def is_cached(self, text: str) -> bool:
+        with self._lock:
+            return all(word in self._cache for word in word_regex.findall(text.lower()))
+
+    def tokenize_batch(self, texts: Sequence[str]) -> list[list[str]]:
+        """Lemmatizes texts, drops stopwords, punctuation, links and numbers"""
+        docs = [word_regex.findall(text.lower()) for text in texts]
+        lemmas = self.lemmatize_words([word for doc in docs for word in doc])
+        return [
+            [
+                lemma
+                for lemma in (lemmas[word] for word in doc)
+                if lemma not in rus_stopwords and lemma not in skip_tokens and not lemma.isdigit()
+            ]
+            for doc in docs
+        ]
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+lemmatizer = Lemmatizer(workers=int(os.getenv("LEMMATIZER_WORKERS", "2")))
+
+
+def tokenize(text: str) -> list[str]:
+    """Lemmatizes text, drops stopwords, punctuation, links and numbers"""
+    return lemmatizer.tokenize_batch([text])[0]
+
+
+def tokenize_batch(texts: Sequence[str]) -> list[list[str]]:
+    return lemmatizer.tokenize_batch(texts)
 
 
 async def preprocess_text(text: str) -> list[str]:
-    """Tokenizes text"""
-    tokens_ = mystem.lemmatize(text.lower())
-    tokens: list[str] = [
-        token
-        for token in tokens_
-        if token not in rus_stopwords
-        and token != " "
-        and token.strip() not in punctuation
-        and token != 'https'
-        and token != '://'
-        and not token.isdigit()
-    ]
-    return tokens
+    """Tokenizes text without blocking the event loop: Mystem is only called from a thread"""
+    if lemmatizer.is_cached(text):
+        return tokenize(text)
+    return await asyncio.get_running_loop().run_in_executor(None, tokenize, text)
 
 
 async def predict_with_trained_model(
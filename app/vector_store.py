@@ -0,0 +1,319 @@
+import argparse
+import json
+import logging
+import os
+import uuid
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Any
+from typing import Iterable
+from typing import Protocol
+from typing import Sequence
+from typing import TypedDict
+
+import numpy as np
+import numpy.typing as npt
+
+
+MANIFEST_FILE = "manifest.json"
+VECTORS_FILE = "vectors.f32"
+NODES_FILE = "nodes.bin"
+OFFSETS_FILE = "offsets.i64"
+IDS_FILE = "ids.txt"
+GENERATION_FILE = "generation.json"
+FORMAT_VERSION = 1
+
+
+class NodeRecord(TypedDict):
+    """Docstore entry of a single chunk as stored in nodes.bin"""
+
+    id: str
+    text: str
+    metadata: dict[str, Any]
+    ref_doc_id: str | None
+    hash: str
+
+
+class QueryEmbedder(Protocol):
+    async def aget_query_embedding(self, query: str) -> list[float]: ...
+
+
+class VectorSearcher(Protocol):
+    """Approximate search over the store vectors, e.g. ann_index.IvfIndex"""
+
+    def search(self, query: Sequence[float], top_k: int) -> list[tuple[int, float]]: ...
+
+
+@dataclass(frozen=True)
+class SourceNode:
+    """Retrieved chunk, mirrors the fields of llama_index NodeWithScore used by the bot"""
+
+    node_id: str
+    text: str
+    metadata: dict[str, Any]
+    score: float
+    row: int = -1
+
+
+@dataclass(frozen=True)
+class Retrieval:
+    source_nodes: list[SourceNode] = field(default_factory=list)
+
+
+def _normalize(matrix: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32)
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    tmp_path = f"{path}.{os.getpid()}.tmp"  # bot workers converting the same JSON index do not share it
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def write_mmap_index(
+    folder: str,
+    records: Sequence[NodeRecord],
+    embeddings: Sequence[Sequence[float]] | npt.NDArray[np.float32],
+) -> None:
+    """
+    Writes chunks and their embeddings in the binary format read by MmapVectorStore.
+
+    Vectors are L2-normalized on write, so a dot product at query time
+    is the cosine similarity used by llama_index SimpleVectorStore.
+    The manifest is replaced last: a reader never sees a half-written index.
+    """
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    if len(records) != len(matrix):
+        raise ValueError(f"Got {len(records)} records for {len(matrix)} embeddings")
+    dim = int(matrix.shape[1]) if matrix.ndim == 2 else 0
+
+    os.makedirs(folder, exist_ok=True)
+    payloads = [json.dumps(record, ensure_ascii=False).encode("utf-8") for record in records]
+    offsets = np.zeros(len(payloads) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(p) for p in payloads])
+
+    _write_atomic(os.path.join(folder, VECTORS_FILE), _normalize(matrix).tobytes() if dim else b"")
+    _write_atomic(os.path.join(folder, NODES_FILE), b"".join(payloads))
+    _write_atomic(os.path.join(folder, OFFSETS_FILE), offsets.tobytes())
+    _write_atomic(os.path.join(folder, IDS_FILE), "".join(f"{r['id']}\n" for r in records).encode("utf-8"))
+
+    manifest = {"format": FORMAT_VERSION, "dim": dim, "count": len(records), "version": uuid.uuid4().hex}
+    _write_atomic(os.path.join(folder, MANIFEST_FILE), json.dumps(manifest).encode("utf-8"))
+    logging.info("Mmap index written to %s: %s vectors of dim %s", folder, len(records), dim)
+
+
+def _append(path: str, data: bytes, keep_bytes: int) -> None:
+    """Truncates the file to keep_bytes (rows left by an interrupted append) and appends data"""
+    with open(path, "r+b" if os.path.exists(path) else "w+b") as f:
+        f.truncate(keep_bytes)
+        f.seek(keep_bytes)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def append_mmap_index(
+    folder: str,
+    records: Sequence[NodeRecord],
+    embeddings: Sequence[Sequence[float]] | npt.NDArray[np.float32],
+) -> None:
+    """
+    Appends chunks to an existing mmap index, writing only the new rows.
+
+    Data files are append-only and the manifest is replaced last, so readers
+    of the previous version keep seeing a consistent prefix of the files.
+    """
+    manifest_path = os.path.join(folder, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        write_mmap_index(folder, records, embeddings)
+        return
+    if not records:
+        return
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    count, dim = manifest["count"], manifest["dim"]
+
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    if len(records) != len(matrix):
+        raise ValueError(f"Got {len(records)} records for {len(matrix)} embeddings")
+    if count and matrix.shape[1] != dim:
+        raise ValueError(f"Embedding dim {matrix.shape[1]} does not match the index dim {dim}")
+    dim = int(matrix.shape[1])
+
+    offsets_path = os.path.join(folder, OFFSETS_FILE)
+    offsets = np.fromfile(offsets_path, dtype=np.int64, count=count + 1)
+    payloads = [json.dumps(record, ensure_ascii=False).encode("utf-8") for record in records]
+    new_offsets = offsets[-1] + np.cumsum([len(p) for p in payloads], dtype=np.int64)
+
+    with open(os.path.join(folder, IDS_FILE), "r", encoding="utf-8") as f:
+        ids = [line.rstrip("\n") for line in f][:count]
+    ids_bytes = len("".join(f"{node_id}\n" for node_id in ids).encode("utf-8"))
+
+    _append(os.path.join(folder, VECTORS_FILE), _normalize(matrix).tobytes(), count * dim * 4)
+    _append(os.path.join(folder, NODES_FILE), b"".join(payloads), int(offsets[-1]))
+    _append(offsets_path, new_offsets.tobytes(), (count + 1) * 8)
+    _append(os.path.join(folder, IDS_FILE), "".join(f"{r['id']}\n" for r in records).encode("utf-8"), ids_bytes)
+
+    manifest.update(dim=dim, count=count + len(records), version=uuid.uuid4().hex)
+    _write_atomic(manifest_path, json.dumps(manifest).encode("utf-8"))
+    logging.info("Mmap index %s: appended %s vectors, %s in total", folder, len(records), manifest["count"])
+
+
+def read_generation(folder: str) -> int:
+    """Generation of the index last published by publish_generation, 0 if none was"""
+    path = os.path.join(folder, GENERATION_FILE)
+    if not os.path.exists(path):
+        return 0
+    with open(path, "r", encoding="utf-8") as f:
+        generation: int = json.load(f)["generation"]
+    return generation
+
+
+def publish_generation(folder: str) -> int:
+    """
+    Announces a complete new version of the index to running bots. Called
+    after the vector index and all side indexes (IVF, BM25) are written;
+    bots reload the folder when the generation number grows.
+    """
+    with open(os.path.join(folder, MANIFEST_FILE), "r", encoding="utf-8") as f:
+        version = json.load(f)["version"]
+    generation = read_generation(folder) + 1
+    _write_atomic(
+        os.path.join(folder, GENERATION_FILE),
+        json.dumps({"generation": generation, "version": version}).encode("utf-8"),
+    )
+    logging.info("Index %s published as generation %s", folder, generation)
+    return generation
+
+
+def convert_json_index(json_folder: str, mmap_folder: str) -> int:
+    """One-shot conversion of a persisted llama_index JSON storage folder to the mmap format"""
+    with open(os.path.join(json_folder, "default__vector_store.json"), "r", encoding="utf-8") as f:
+        vector_data = json.load(f)
+    with open(os.path.join(json_folder, "docstore.json"), "r", encoding="utf-8") as f:
+        docstore = json.load(f)["docstore/data"]
+
+    records: list[NodeRecord] = []
+    embeddings = []
+    for node_id, embedding in vector_data["embedding_dict"].items():
+        node = docstore[node_id]["__data__"]
+        source = node.get("relationships", {}).get("1")
+        records.append(
+            {
+                "id": node_id,
+                "text": node["text"],
+                "metadata": node.get("metadata", {}),
+                "ref_doc_id": source["node_id"] if source else vector_data["text_id_to_ref_doc_id"].get(node_id),
+                "hash": node["hash"],
+            }
+        )
+        embeddings.append(embedding)
+
+    write_mmap_index(mmap_folder, records, embeddings)
+    return len(records)
+
+
+class MmapVectorStore:
+    """
+    Read-only vector index over a memory-mapped float32 matrix.
+
+    Only the manifest and the id table are read eagerly; vectors and node
+    payloads are paged in by the OS on first access.
+    """
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        with open(os.path.join(folder, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest["format"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported mmap index format: {manifest['format']}")
+
+        self.dim: int = manifest["dim"]
+        self.count: int = manifest["count"]
+        self.version: str = manifest["version"]
+
+        self.vectors: npt.NDArray[np.float32] = self._map(VECTORS_FILE, np.float32, (self.count, self.dim))
+        self._offsets: npt.NDArray[np.int64] = self._map(OFFSETS_FILE, np.int64, (self.count + 1,))
+        self._nodes: npt.NDArray[np.uint8] = self._map(NODES_FILE, np.uint8, (int(self._offsets[-1]),))
+        with open(os.path.join(folder, IDS_FILE), "r", encoding="utf-8") as f:
+            self.ids = [line.rstrip("\n") for line in f][: self.count]
+
+    def _map(self, file_name: str, dtype: Any, shape: tuple[int, ...]) -> Any:
+        if 0 in shape:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.folder, file_name), dtype=dtype, mode="r", shape=shape)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def record(self, row: int) -> NodeRecord:
+        start, end = int(self._offsets[row]), int(self._offsets[row + 1])
+        record: NodeRecord = json.loads(self._nodes[start:end].tobytes().decode("utf-8"))
+        return record
+
+    def records(self) -> Iterable[NodeRecord]:
+        for row in range(self.count):
+            yield self.record(row)
+
+    def search(self, query: Sequence[float] | npt.NDArray[np.float32], top_k: int) -> list[tuple[int, float]]:
+        """Returns (row, cosine similarity) pairs of the top_k nearest vectors, best first"""
+        if not self.count or top_k <= 0:
+            return []
+        q = _normalize(np.asarray(query, dtype=np.float32))
+        scores = self.vectors @ q
+        top_k = min(top_k, self.count)
+        rows = np.argpartition(scores, -top_k)[-top_k:] if top_k < self.count else np.arange(self.count)
+        rows = rows[np.argsort(scores[rows])[::-1]]
+        return [(int(row), float(scores[row])) for row in rows]
+
+    def source_node(self, row: int, score: float) -> SourceNode:
+        record = self.record(row)
+        return SourceNode(node_id=record["id"], text=record["text"], metadata=record["metadata"], score=score, row=row)
+
+
+class MmapQueryEngine:
+    """
+    Drop-in replacement for the retrieval-only llama_index query engine.
+    Searches the store exactly unless an approximate searcher is given.
+    """
+
+    def __init__(
+        self,
+        store: MmapVectorStore,
+        embed_model: QueryEmbedder,
+        similarity_top_k: int = 3,
+        searcher: VectorSearcher | None = None,
+    ) -> None:
+        self.store = store
+        self.embed_model = embed_model
+        self.similarity_top_k = similarity_top_k
+        self.searcher: VectorSearcher = searcher or store
+
+    def retrieve(self, query_embedding: Sequence[float], top_k: int | None = None) -> Retrieval:
+        hits = self.searcher.search(query_embedding, top_k or self.similarity_top_k)
+        return Retrieval(source_nodes=[self.store.source_node(row, score) for row, score in hits])
+
+    def nodes(self, query_embedding: Sequence[float], rows: Sequence[int]) -> list[SourceNode]:
+        """Nodes of the given rows, in that order, scored by cosine similarity to the query"""
+        if not rows:
+            return []
+        scores = self.store.vectors[list(rows)] @ _normalize(np.asarray(query_embedding, dtype=np.float32))
+        return [self.store.source_node(row, float(score)) for row, score in zip(rows, scores)]
+
+    async def aquery(self, query: str) -> Retrieval:
+        query_embedding = await self.embed_model.aget_query_embedding(query)
+        return self.retrieve(query_embedding)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Convert a llama_index JSON storage folder to the mmap format")
+    arg_parser.add_argument("json_folder", nargs="?", default="data/index_storage_1024")
+    arg_parser.add_argument("mmap_folder", nargs="?", default="data/index_mmap_1024")
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(module)s: %(message)s")
+    convert_json_index(args.json_folder, args.mmap_folder)
@@ -0,0 +1,133 @@
+import asyncio
+import hmac
+import logging
+import os
+import secrets
+import sys
+import time
+
+from aiogram import Bot
+from aiohttp import web
+from dotenv import load_dotenv
+from metrics import REGISTRY
+from metrics import start_metrics_server
+from work_queue import WorkQueue
+
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(module)s: %(message)s")
+
+load_dotenv()
+
+TOKEN = os.getenv("TG_TOKEN")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Telegram присылает его в заголовке X-Telegram-Bot-Api-Secret-Token; по умолчанию новый при каждом запуске
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+WORKERS = int(os.getenv("WORKERS", "2"))  # процессов бота
+WORK_QUEUE_PATH = os.getenv("WORK_QUEUE_PATH", "data/work_queue.sqlite3")
+WORKER_START_TIMEOUT = float(os.getenv("WORKER_START_TIMEOUT", "600"))  # секунд на загрузку индекса воркером
+METRICS_PORT_ = os.getenv("METRICS_PORT")
+METRICS_PORT = int(METRICS_PORT_) if METRICS_PORT_ else None  # воркеры получают METRICS_PORT + 1 + WORKER_ID
+
+queue = WorkQueue(WORK_QUEUE_PATH)
+received = REGISTRY.counter("webhook_updates", "Updates received by the webhook")
+rejected = REGISTRY.counter("webhook_rejected", "Requests without the webhook secret token")
+for worker_id in range(WORKERS):
+    REGISTRY.gauge(
+        "work_queue_depth",
+        "Updates queued or in progress",
+        labels={"worker": str(worker_id)},
+        callback=lambda worker_id=worker_id: queue.depth(worker_id),
+    )
+
+
+async def handle_update(request: web.Request) -> web.Response:
+    if not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+        rejected.inc()
+        raise web.HTTPForbidden()
+    queue.push(await request.json(), WORKERS)
+    received.inc()
+    return web.Response()
+
+
+def worker_env(worker_id: int) -> dict[str, str]:
+    env = {
+        **os.environ,
+        "WORKER_ID": str(worker_id),
+        "WORK_QUEUE_PATH": WORK_QUEUE_PATH,
+        "LOG_FILE": f"app/logs/worker_{worker_id}.log",
+    }
+    if METRICS_PORT:
+        env["METRICS_PORT"] = str(METRICS_PORT + 1 + worker_id)
+    return env
+
+
+async def start_worker(worker_id: int) -> asyncio.subprocess.Process:
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(os.path.dirname(__file__), "app.py"), env=worker_env(worker_id)
+    )
+    logging.info("Worker %s started, pid %s", worker_id, process.pid)
+    return process
+
+
+async def wait_ready(worker_id: int, process: asyncio.subprocess.Process, started: float) -> None:
+    """Waits for the first heartbeat of the worker, written once its index is loaded"""
+    while queue.heartbeats().get(worker_id, 0) < started:
+        if process.returncode is not None:
+            raise RuntimeError(f"Worker {worker_id} exited with code {process.returncode} during startup")
+        if time.time() - started > WORKER_START_TIMEOUT:
+            raise TimeoutError(f"Worker {worker_id} is not ready after {WORKER_START_TIMEOUT:.0f} s")
+        await asyncio.sleep(0.5)
+    logging.info("Worker %s is ready in %.1f s", worker_id, time.time() - started)
+
+
+async def supervise(worker_id: int, processes: list[asyncio.subprocess.Process]) -> None:
+    """Restarts the worker whenever it exits; the updates it had claimed are requeued when it starts"""
+    while True:
+        code = await processes[worker_id].wait()
+        logging.error("Worker %s exited with code %s, restarting", worker_id, code)
+        await asyncio.sleep(1)
+        processes[worker_id] = await start_worker(worker_id)
+
+
+async def on_startup(app: web.Application) -> None:
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_PORT)
+
+    # Worker 0 starts alone: on a fresh checkout it converts the JSON index, the others then only map the files
+    started = time.time()
+    processes = [await start_worker(0)]
+    await wait_ready(0, processes[0], started)
+    for worker_id in range(1, WORKERS):
+        processes.append(await start_worker(worker_id))
+    app["supervisors"] = [asyncio.create_task(supervise(worker_id, processes)) for worker_id in range(WORKERS)]
+    app["processes"] = processes
+
+    bot = Bot(token=TOKEN)
+    try:
+        # Raw Bot API call: set_webhook of aiogram 2.11 has no secret_token parameter
+        await bot.request("setWebhook", {"url": WEBHOOK_URL + WEBHOOK_PATH, "secret_token": WEBHOOK_SECRET})
+    finally:
+        await bot.close()
+    logging.info("Webhook set to %s%s, %s workers", WEBHOOK_URL, WEBHOOK_PATH, WORKERS)
+
+
+async def on_shutdown(app: web.Application) -> None:
+    for task in app.get("supervisors", []):
+        task.cancel()
+    for process in app.get("processes", []):
+        if process.returncode is None:
+            process.terminate()
+    logging.info("Workers stopped, %s updates left in the queue", queue.depth())
+
+
+if __name__ == "__main__":
+    if not WEBHOOK_URL:
+        raise SystemExit("WEBHOOK_URL is required in webhook mode")
+    webapp = web.Application()
+    webapp.router.add_post(WEBHOOK_PATH, handle_update)
+    webapp.on_startup.append(on_startup)
+    webapp.on_shutdown.append(on_shutdown)
+    web.run_app(webapp, host=WEBAPP_HOST, port=WEBAPP_PORT)
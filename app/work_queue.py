@@ -0,0 +1,186 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+
+
+PENDING = 0
+TAKEN = 1
+
+
+def chat_id_of(update: dict[str, Any]) -> int:
+    """Chat of a Telegram update, 0 for updates without one"""
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if key in update:
+            chat_id: int = update[key]["chat"]["id"]
+            return chat_id
+    message = update.get("callback_query", {}).get("message")
+    return message["chat"]["id"] if message else 0
+
+
+def worker_of(chat_id: int, workers: int) -> int:
+    """Chats are pinned to workers, so replies to one chat keep their order"""
+    return chat_id % workers
+
+
+class WorkQueue:
+    """
+    Durable queue of Telegram updates in SQLite (WAL), shared by the webhook
+    front end and the worker processes.
+
+    An update is claimed by its worker (status TAKEN) and deleted once
+    processed. Updates a crashed worker had claimed are returned to the queue
+    when it starts again, so every update is processed at least once.
+    Telegram's update_id is unique, so webhook retries are not queued twice.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS updates (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                update_id INTEGER UNIQUE,
+                worker INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                status INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS updates_by_worker ON updates (worker, status, id);
+            CREATE TABLE IF NOT EXISTS workers (
+                worker INTEGER PRIMARY KEY,
+                pid INTEGER NOT NULL,
+                heartbeat REAL NOT NULL
+            );
+            """
+        )
+        self._conn.commit()
+
+    def push(self, update: dict[str, Any], workers: int) -> int:
+        """Queues the update for the worker of its chat and returns that worker"""
+        chat_id = chat_id_of(update)
+        worker = worker_of(chat_id, workers)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO updates (update_id, worker, chat_id, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+                (update.get("update_id"), worker, chat_id, json.dumps(update, ensure_ascii=False), time.time()),
+            )
+        return worker
+
+    def claim(self, worker: int, limit: int) -> list[tuple[int, int, dict[str, Any], float]]:
+        """Oldest pending updates of the worker as (id, chat_id, update, created_at), marked as taken"""
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                "SELECT id, chat_id, payload, created_at FROM updates WHERE worker = ? AND status = ? ORDER BY id LIMIT ?",
+                (worker, PENDING, limit),
+            ).fetchall()
+            self._conn.executemany("UPDATE updates SET status = ? WHERE id = ?", [(TAKEN, row[0]) for row in rows])
+        return [(row_id, chat_id, json.loads(payload), created_at) for row_id, chat_id, payload, created_at in rows]
+
+    def done(self, row_id: int) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM updates WHERE id = ?", (row_id,))
+
+    def requeue(self, worker: int) -> int:
+        """Returns updates the worker had claimed before a restart to the queue"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE updates SET status = ? WHERE worker = ? AND status = ?", (PENDING, worker, TAKEN)
+            )
+        return cursor.rowcount
+
+    def depth(self, worker: int | None = None) -> int:
+        with self._lock:
+            if worker is None:
+                row = self._conn.execute("SELECT COUNT(*) FROM updates").fetchone()
+            else:
+                row = self._conn.execute("SELECT COUNT(*) FROM updates WHERE worker = ?", (worker,)).fetchone()
+        count: int = row[0]
+        return count
+
+    def heartbeat(self, worker: int) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO workers VALUES (?, ?, ?)", (worker, os.getpid(), time.time()))
+
+    def heartbeats(self) -> dict[int, float]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT worker, heartbeat FROM workers").fetchall())
+
+
+class QueueWorker:
+    """
+    Processes the updates of one worker process. Updates of a chat are handled
+    one after another in arrival order, different chats concurrently, with at
+    most `concurrency` updates claimed and not yet finished.
+    """
+
+    def __init__(
+        self,
+        queue: WorkQueue,
+        worker: int,
+        handle: Callable[[dict[str, Any]], Awaitable[None]],
+        concurrency: int = 16,
+        poll_interval: float = 0.2,
+    ) -> None:
+        self.queue = queue
+        self.worker = worker
+        self.handle = handle
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.in_flight = 0
+        self._chats: dict[int, asyncio.Queue[tuple[int, dict[str, Any], float]]] = {}
+        self._tasks: dict[int, asyncio.Task[None]] = {}
+
+    async def run(self) -> None:
+        requeued = self.queue.requeue(self.worker)
+        if requeued:
+            logging.info("Worker %s: %s unfinished updates returned to the queue", self.worker, requeued)
+        last_heartbeat = 0.0
+        while True:
+            if time.time() - last_heartbeat > 5:
+                self.queue.heartbeat(self.worker)
+                last_heartbeat = time.time()
+            rows = (
+                self.queue.claim(self.worker, self.concurrency - self.in_flight)
+                if self.in_flight < self.concurrency
+                else []
+            )
+            for row_id, chat_id, update, created_at in rows:
+                self.in_flight += 1
+                if chat_id not in self._chats:
+                    self._chats[chat_id] = asyncio.Queue()
+                self._chats[chat_id].put_nowait((row_id, update, created_at))
+                if chat_id not in self._tasks:
+                    self._tasks[chat_id] = asyncio.create_task(self._chat_worker(chat_id))
+            if not rows:
+                await asyncio.sleep(self.poll_interval)
+
+    async def _chat_worker(self, chat_id: int) -> None:
+        queue = self._chats[chat_id]
+        try:
+            while not queue.empty():
+                row_id, update, created_at = queue.get_nowait()
+                logging.info(
+                    "Worker %s: update of chat %s waited %.2f s", self.worker, chat_id, time.time() - created_at
+                )
+                try:
+                    await self.handle(update)
+                except Exception:
+                    logging.exception("Worker %s failed to process an update of chat %s", self.worker, chat_id)
+                finally:
+                    self.queue.done(row_id)
+                    self.in_flight -= 1
+        finally:
+            del self._tasks[chat_id]
+            del self._chats[chat_id]
@@ -0,0 +1,270 @@
+import argparse
+import logging
+import os
+import re
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+
+# Битрейт, с которым прежний пайплайн перекодировал сегменты (libmp3lame по умолчанию) - база для отчета
+BASELINE_BITRATE = 128_000
+# Битрейт, в который yt-dlp конвертировал скачанное аудио в прежнем пайплайне
+BASELINE_DOWNLOAD_BITRATE = "192k"
+
+_silence_start_regex = re.compile(r"silence_start: (-?[\d.]+)")
+_silence_end_regex = re.compile(r"silence_end: (-?[\d.]+)")
+
+
+@dataclass(frozen=True)
+class PreparedAudio:
+    """Результат предобработки одного аудиофайла"""
+
+    segments: list[str]
+    source_seconds: float  # длительность исходного аудио
+    kept_seconds: float  # длительность после вырезания длинных пауз
+    uploaded_bytes: int  # размер сегментов, которые уйдут в Whisper
+    baseline_bytes: int  # оценка объема сегментов прежнего пайплайна (128 кбит/с)
+    seconds: float  # время предобработки
+    # время прежнего пути (mp3 192 кбит/с + нарезка с перекодированием) на том же входе, если его замеряли
+    baseline_seconds: float | None = None
+
+    @property
+    def saved_seconds(self) -> float | None:
+        return None if self.baseline_seconds is None else self.baseline_seconds - self.seconds
+
+    @property
+    def saved_bytes(self) -> int:
+        return max(self.baseline_bytes - self.uploaded_bytes, 0)
+
+    @property
+    def trimmed_seconds(self) -> float:
+        return max(self.source_seconds - self.kept_seconds, 0.0)
+
+
+def probe_duration(path: str) -> float:
+    """Длительность аудиофайла в секундах по данным ffprobe"""
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return float(result.stdout.strip() or 0)
+
+
+def parse_silences(ffmpeg_log: str) -> list[tuple[float, float]]:
+    """Интервалы тишины (начало, конец) из вывода фильтра silencedetect"""
+    starts = [float(x) for x in _silence_start_regex.findall(ffmpeg_log)]
+    ends = [float(x) for x in _silence_end_regex.findall(ffmpeg_log)]
+    return list(zip(starts, ends))
+
+
+def choose_cuts(silences: list[tuple[float, float]], duration: float, segment_time: float) -> list[float]:
+    """
+    Точки разреза: для каждого сегмента - середина последней паузы, попадающей
+    во вторую половину окна длиной segment_time. Если такой паузы нет,
+    сегмент режется ровно через segment_time.
+    """
+    middles = [(start + end) / 2 for start, end in silences]
+    cuts: list[float] = []
+    position = 0.0
+    while duration - position > segment_time:
+        window = [m for m in middles if position + segment_time / 2 <= m <= position + segment_time]
+        position = window[-1] if window else position + segment_time
+        cuts.append(position)
+    return cuts
+
+
+def _encode(
+    source: str,
+    target: str,
+    sample_rate: int,
+    bitrate: str,
+    silence_threshold: str,
+    min_silence: float,
+    keep_silence: float,
+) -> str:
+    """
+    Один проход ffmpeg: 16 кГц моно с низким битрейтом, паузы длиннее
+    min_silence укорачиваются до keep_silence, паузы для разрезов ищутся
+    silencedetect уже на укороченной дорожке. Возвращает лог ffmpeg.
+    """
+    audio_filter = ",".join(
+        [
+            f"silenceremove=stop_periods=-1:stop_duration={min_silence}:stop_threshold={silence_threshold}"
+            f":stop_silence={keep_silence}",
+            f"silencedetect=noise={silence_threshold}:d={keep_silence / 2}",
+        ]
+    )
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-nostats",
+        "-y",
+        "-i",
+        source,
+        "-vn",
+        "-ac",
+        "1",
+        "-ar",
+        str(sample_rate),
+        "-af",
+        audio_filter,
+        "-c:a",
+        "libmp3lame",
+        "-b:a",
+        bitrate,
+        target,
+    ]
+    result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+    return result.stderr
+
+
+def _cut(source: str, target: str, start: float, end: float | None) -> None:
+    """Вырезает отрезок без перекодирования (stream copy)"""
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-ss", f"{start:.3f}"]
+    if end is not None:
+        cmd += ["-to", f"{end:.3f}"]
+    cmd += ["-i", source, "-c", "copy", target]
+    subprocess.run(cmd, check=True)
+
+
+def measure_baseline(
+    source: str, source_seconds: float, tmp_dir: str, segment_time: float, sample: float | None
+) -> float:
+    """
+    Время прежнего пути на том же входе: конвертация в mp3 192 кбит/с
+    (постпроцессор yt-dlp) и нарезка с перекодированием libmp3lame
+    (прежний _split_audio). Если задан sample, прогоняются только первые
+    sample секунд, и время масштабируется на всю длительность.
+    """
+    limit = ["-t", str(sample)] if sample and sample < source_seconds else []
+    converted = os.path.join(tmp_dir, "baseline.mp3")
+    started = time.perf_counter()
+    subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *limit, "-i", source, "-vn"]
+        + ["-c:a", "libmp3lame", "-b:a", BASELINE_DOWNLOAD_BITRATE, converted],
+        check=True,
+    )
+    subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-i", converted, "-f", "segment"]
+        + ["-segment_time", str(segment_time), "-c:a", "libmp3lame", os.path.join(tmp_dir, "baseline%03d.mp3")],
+        check=True,
+    )
+    elapsed = time.perf_counter() - started
+    measured = probe_duration(converted)
+    return elapsed * source_seconds / measured if measured else elapsed
+
+
+def preprocess_audio(
+    source: str,
+    segments_dir: str,
+    segment_time: float = 900,
+    sample_rate: int = 16000,
+    bitrate: str = "32k",
+    silence_threshold: str = "-40dB",
+    min_silence: float = 1.0,
+    keep_silence: float = 0.5,
+    workers: int = 4,
+    baseline_sample: float | None = 0,
+) -> PreparedAudio:
+    """
+    Готовит аудио к отправке в Whisper.
+
+    Исходный файл (в любом формате, который читает ffmpeg) перекодируется
+    один раз во временный каталог, затем режется по паузам на сегменты
+    не длиннее segment_time секунд. Сегменты копируются без перекодирования
+    параллельно в `workers` процессов ffmpeg и пишутся в segments_dir как
+    segmentNNN.mp3.
+
+    Parameters
+    ----------
+    source : str
+        Путь к скачанному аудио.
+    segments_dir : str
+        Каталог для сегментов (должен существовать).
+    baseline_sample : float | None
+        Сколько секунд входа прогнать прежним путем для оценки сэкономленного
+        времени (None - весь файл). По умолчанию 0 - не измерять: замер - это
+        два лишних прохода libmp3lame, он нужен только для бенчмарка.
+
+    Returns
+    -------
+    PreparedAudio
+        Пути к сегментам по порядку, длительности и объемы для отчета.
+
+    """
+    started = time.perf_counter()
+    source_seconds = probe_duration(source)
+    with tempfile.TemporaryDirectory(prefix="audio_") as tmp_dir:
+        encoded = os.path.join(tmp_dir, "audio.mp3")
+        ffmpeg_log = _encode(source, encoded, sample_rate, bitrate, silence_threshold, min_silence, keep_silence)
+        kept_seconds = probe_duration(encoded)
+        cuts = choose_cuts(parse_silences(ffmpeg_log), kept_seconds, segment_time)
+
+        bounds = list(zip([0.0] + cuts, cuts + [None]))
+        segments = [os.path.join(segments_dir, f"segment{i:03d}.mp3") for i in range(len(bounds))]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_cut, encoded, path, start, end) for path, (start, end) in zip(segments, bounds)]
+            for future in futures:
+                future.result()
+        seconds = time.perf_counter() - started
+
+        # Замер прежнего пути не входит во время предобработки
+        baseline_seconds = (
+            measure_baseline(source, source_seconds, tmp_dir, segment_time, baseline_sample)
+            if baseline_sample != 0
+            else None
+        )
+
+    prepared = PreparedAudio(
+        segments=segments,
+        source_seconds=source_seconds,
+        kept_seconds=kept_seconds,
+        uploaded_bytes=sum(os.path.getsize(path) for path in segments),
+        baseline_bytes=int(source_seconds * BASELINE_BITRATE / 8),
+        seconds=seconds,
+        baseline_seconds=baseline_seconds,
+    )
+    logging.info(
+        "Audio %s: %.0f s, %.0f s of pauses trimmed, %s segments, %.1f MB to upload (%.1f MB saved), "
+        "preprocessing took %.1f s",
+        os.path.basename(source),
+        prepared.source_seconds,
+        prepared.trimmed_seconds,
+        len(segments),
+        prepared.uploaded_bytes / 1e6,
+        prepared.saved_bytes / 1e6,
+        prepared.seconds,
+    )
+    if prepared.saved_seconds is not None:
+        logging.info(
+            "Audio %s: the old encode-and-split path takes %.1f s, %.1f s saved",
+            os.path.basename(source),
+            prepared.baseline_seconds,
+            prepared.saved_seconds,
+        )
+    return prepared
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Предобработка аудио для Whisper и сравнение с прежним пайплайном")
+    arg_parser.add_argument("source")
+    arg_parser.add_argument("--segment-time", type=float, default=900)
+    arg_parser.add_argument("--bitrate", default="32k")
+    arg_parser.add_argument(
+        "--baseline-sample", type=float, default=60, help="секунд входа для замера прежнего пути, 0 - весь файл"
+    )
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(module)s: %(message)s")
+    with tempfile.TemporaryDirectory(prefix="segments_") as out_dir:
+        preprocess_audio(
+            args.source,
+            out_dir,
+            segment_time=args.segment_time,
+            bitrate=args.bitrate,
+            baseline_sample=args.baseline_sample or None,
+        )
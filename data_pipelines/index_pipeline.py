@@ -1,36 +1,42 @@
-import json
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from logging.handlers import RotatingFileHandler
 from typing import List
 
-import httpx
+import tiktoken
 from dotenv import load_dotenv
 from llama_index import Document
-from llama_index import ServiceContext
-from llama_index import StorageContext
-from llama_index import VectorStoreIndex
-from llama_index import load_index_from_storage
 from llama_index.node_parser import SimpleNodeParser
+from llama_index.schema import MetadataMode
 
+from app.ann_index import update_ivf_index
+from app.custom_embedding import EmbeddingCache
 from app.custom_embedding import OpenAIEmbeddingProxy
+from app.http_clients import HttpClientConfig
+from app.http_clients import PoolStats
+from app.http_clients import create_client
+from app.lexical_index import update_lexical_index
+from app.quantization import update_quantized_index
+from app.utils import tokenize_batch
+from app.vector_store import MANIFEST_FILE
+from app.vector_store import MmapVectorStore
+from app.vector_store import NodeRecord
+from app.vector_store import append_mmap_index
+from app.vector_store import convert_json_index
+from app.vector_store import publish_generation
+from data_pipelines.metadata_store import VideoMetadataStore
+from data_pipelines.metadata_store import default_db_path
 from data_pipelines.parser_transcribe import ParserTranscribe
+from data_pipelines.parser_transcribe import http_stats as transcribe_http_stats
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(module)s: %(message)s",
-    handlers=[
-        RotatingFileHandler(
-            os.path.join(os.path.dirname(__file__), "../app/logs/app.log"), maxBytes=5000000, backupCount=2
-        ),
-        logging.StreamHandler(),
-    ],
-)
 load_dotenv()
-PROXY = os.getenv("PROXY")
-http_client = httpx.Client(proxies=PROXY)
+http_config = HttpClientConfig.from_env()
+http_stats = PoolStats()
+http_client = create_client(http_config, http_stats)
 
 
 @dataclass()
@@ -43,73 +49,146 @@ class IndexPipeline:
     path_to_save: str
     url_file_path: str
     json_video_info_path: str
-    index_folder: str
+    index_folder: str  # JSON-индекс LlamaIndex, конвертируется в mmap-индекс, если того еще нет
+    mmap_index_folder: str  # Папка бинарного индекса для бота
     chunk_size: int = 200
     chunk_overlap: int = 50
+    embed_batch_size: int = 256  # Чанков в одном запросе к API эмбеддингов
+    embed_workers: int = 4  # Одновременных запросов к API эмбеддингов
+    embedding_cache_path: str | None = "data/embedding_cache.sqlite3"  # Общий с ботом кэш эмбеддингов
+    ivf_index: bool = True  # Поддерживать IVF-индекс для приближенного поиска (VECTOR_SEARCH=ivf)
+    ivf_nlist: int | None = None  # Число списков IVF, по умолчанию 4 * sqrt(N)
+    int8_codes: bool = True  # Поддерживать int8-коды векторов для поиска VECTOR_SEARCH=int8
+    video_workers: int = 2  # Видео, скачиваемых и транскрибируемых одновременно
+    transcribe_workers: int = 4  # Одновременных запросов к Whisper
 
     def _get_download_urls(self, channel_url: str | None = None) -> List[str]:
         with open(self.url_file_path, "r", encoding="utf-8") as f:
             return [line.strip() for line in f if line.strip()]
 
+    def _metadata_store(self) -> VideoMetadataStore:
+        return VideoMetadataStore(default_db_path(self.json_video_info_path), self.json_video_info_path)
+
     def _transcribe_videos(self, new_videos: List[str]) -> None:
         """
         Скачивает и транскрибирует видео из списка self.new_videos.
         Текст и метаданные сохраняются в json-файл.
+        Видео обрабатываются параллельно (self.video_workers), одновременных
+        запросов к Whisper не больше self.transcribe_workers.
         """
-        transcriber = ParserTranscribe(self.path_to_save, self.json_video_info_path)
-        for i, url in enumerate(new_videos):
-            # print(f"Transcribe {i} video")
+        transcriber = ParserTranscribe(
+            self.path_to_save, self.json_video_info_path, max_workers=self.transcribe_workers
+        )
+
+        def transcribe(i: int, url: str) -> None:
             logging.info("Transcribe %s video", i)
             transcriber.get_transcribe_video(url)
 
+        with ThreadPoolExecutor(max_workers=self.video_workers) as executor:
+            list(executor.map(transcribe, range(len(new_videos)), new_videos))
+        logging.info("Whisper HTTP pool: %s", transcribe_http_stats.stats())
+
     def _get_index(self, new_videos: List[str]) -> None:
         """
-        Функция должна работать следующим образом:
+        Добавляет в индекс видео из списка new_videos:
 
-        1. Если есть сохраненный индекс в self.storage_index_path -
-        загружает его.
-        2. По списку new_videos находит документы в json и добавляет их в индекс.
-        Или создает новый индекс, если self.storage_index_path не существует
-        3. Сохраняет индекс
+        1. Находит в хранилище метаданных документы видео, которых еще нет в индексе,
+           и нарезает их на чанки.
+        2. Пропускает чанки, хеш содержимого которых уже есть в индексе.
+        3. Считает эмбеддинги новых чанков крупными батчами в несколько потоков.
+        4. Дописывает в mmap-индекс только новые строки, распределяет их по спискам IVF
+           и добавляет их в BM25-индекс.
+
+        Если mmap-индекса еще нет, а в self.index_folder есть JSON-индекс LlamaIndex,
+        он сначала конвертируется.
         """
-        embed_model = OpenAIEmbeddingProxy(http_client=http_client)
-        node_parser = SimpleNodeParser.from_defaults(chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
-        service_context = ServiceContext.from_defaults(node_parser=node_parser, embed_model=embed_model)
-        # Загружаем индекс
-        index_store_path = os.path.join(self.index_folder, "index_store.json")
-        if os.path.exists(index_store_path):
-            storage_context = StorageContext.from_defaults(persist_dir=self.index_folder)
-            index = load_index_from_storage(storage_context, service_context=service_context)
-        else:
-            # Или создаем пустой
-            index = VectorStoreIndex([], service_context=service_context)
+        started = time.perf_counter()
+        index_exists = os.path.exists(os.path.join(self.mmap_index_folder, MANIFEST_FILE))
+        if not index_exists and os.path.exists(os.path.join(self.index_folder, "docstore.json")):
+            convert_json_index(self.index_folder, self.mmap_index_folder)
+            index_exists = True
+        indexed = list(MmapVectorStore(self.mmap_index_folder).records()) if index_exists else []
+        known_hashes = {record["hash"] for record in indexed}
 
         # Выбираем документы для добавления в индекс
-        with open(self.json_video_info_path, "r", encoding="utf-8") as f:
-            data_json = json.load(f)
-        to_download_data = []
-        for i in new_videos:
-            for j in data_json:
-                if i == j["url"][0]:
-                    to_download_data.append(j)
-
-        # Формируем документы
+        # Видео, уже лежащие в индексе, пропускаются целиком: у сконвертированного JSON-индекса другие
+        # границы чанков (в нем только первый сегмент текста), и хеши его чанков не совпадут с новыми
+        known_urls = {record["metadata"].get("url") for record in indexed}
+        found = self._metadata_store().get_many(new_videos)
         documents = [
             Document(
-                text=data["text"][0],
+                id_=data["url"][0],
+                text=" ".join(data["text"]),
                 metadata={"url": data["url"][0], "title": data["title"][0]},
             )
-            for data in to_download_data
+            for data in (found[url] for url in new_videos if url in found and url not in known_urls)
         ]
 
-        # Добавляем документы в индекс
-        for ind, doc in enumerate(documents):
-            # print(f"Add {i} video to index")
-            logging.info("Add %s video to index", ind)
-            index.insert(doc)
-
-        # Сохраняем индекс
-        index.storage_context.persist(self.index_folder)
+        # Нарезаем на чанки и отбрасываем уже проиндексированные
+        node_parser = SimpleNodeParser.from_defaults(chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
+        nodes = []
+        all_nodes = node_parser.get_nodes_from_documents(documents)
+        for node in all_nodes:
+            if node.hash not in known_hashes:
+                known_hashes.add(node.hash)
+                nodes.append(node)
+        if not nodes:
+            logging.info("No new chunks to index (%s already indexed)", len(all_nodes))
+            return
+
+        # Эмбеддинги батчами, батчи - параллельно
+        cache = EmbeddingCache(self.embedding_cache_path) if self.embedding_cache_path else None
+        encoding = tiktoken.get_encoding("cl100k_base")
+        sent_tokens: list[int] = []  # токены текстов, ушедших в API (промахи кэша)
+        embed_model = OpenAIEmbeddingProxy(
+            http_client=http_client,
+            embed_batch_size=self.embed_batch_size,
+            timeout=http_config.read_timeout,
+            cache=cache,
+            on_upstream=lambda sent: sent_tokens.append(sum(len(encoding.encode(text)) for text in sent)),
+        )
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        batches = [texts[i : i + self.embed_batch_size] for i in range(0, len(texts), self.embed_batch_size)]
+        with ThreadPoolExecutor(max_workers=self.embed_workers) as executor:
+            embeddings = [e for batch in executor.map(embed_model.get_text_embedding_batch, batches) for e in batch]
+
+        # Дописываем только новые строки
+        records: list[NodeRecord] = [
+            {
+                "id": node.node_id,
+                "text": node.text,
+                "metadata": dict(node.metadata),
+                "ref_doc_id": node.ref_doc_id,
+                "hash": node.hash,
+            }
+            for node in nodes
+        ]
+        append_mmap_index(self.mmap_index_folder, records, embeddings)
+        store = MmapVectorStore(self.mmap_index_folder)
+        if self.ivf_index:
+            update_ivf_index(self.mmap_index_folder, store.vectors, self.ivf_nlist)
+        if self.int8_codes:
+            update_quantized_index(self.mmap_index_folder, store.vectors)
+        # BM25: лемматизируются только новые чанки, веса пересчитываются по сохраненным частотам
+        update_lexical_index(self.mmap_index_folder, [record["text"] for record in store.records()], tokenize_batch)
+        # Бот перечитывает индекс, когда номер поколения растет, поэтому он пишется последним
+        publish_generation(self.mmap_index_folder)
+
+        if cache:
+            logging.info("Embedding cache: %s", cache.stats())
+            cache.close()
+        logging.info("Embedding HTTP pool: %s", http_stats.stats())
+
+        elapsed = time.perf_counter() - started
+        tokens = sum(sent_tokens)
+        logging.info(
+            "Indexed %s new chunks (%s skipped) in %.1f s: %.1f chunks/s, %s tokens sent to the embedding API",
+            len(nodes),
+            len(all_nodes) - len(nodes),
+            elapsed,
+            len(nodes) / elapsed,
+            tokens,
+        )
 
     def run(self, channel_url: str, test: bool = False) -> None:
         """Запускает пайплайн получения индекса"""
@@ -118,6 +197,7 @@ class IndexPipeline:
             if test:
                 new_videos = new_videos[:1]
             self._transcribe_videos(new_videos)
+            self._metadata_store().export_json(self.json_video_info_path)
             self._get_index(new_videos)
         else:
             # print("No new videos to download")
@@ -125,11 +205,22 @@ class IndexPipeline:
 
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(module)s: %(message)s",
+        handlers=[
+            RotatingFileHandler(
+                os.path.join(os.path.dirname(__file__), "../app/logs/app.log"), maxBytes=5000000, backupCount=2
+            ),
+            logging.StreamHandler(),
+        ],
+    )
     pipe = IndexPipeline(
         path_to_save="data/audio",
         url_file_path="data/my_videos.txt",
         json_video_info_path="data/video_info.json",
         index_folder="data/index_storage_1024",
+        mmap_index_folder="data/index_mmap_1024",
         chunk_size=768,
     )
 
@@ -0,0 +1,139 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any
+from typing import Iterable
+
+
+# Формат записи в video_info.json: каждое поле - список, text - список сегментов
+VideoItem = dict[str, list[str]]
+
+FIELDS = ("url", "title", "description", "audio_path")
+
+
+def default_db_path(json_path: str) -> str:
+    return os.path.splitext(json_path)[0] + ".sqlite3"
+
+
+class VideoMetadataStore:
+    """
+    Хранилище метаданных видео в SQLite (WAL), ключ - url.
+
+    Вставка и обновление одной записи - один UPSERT без перезаписи файла,
+    каждое изменение атомарно. Для совместимости данные выгружаются
+    в прежний формат video_info.json (export_json). Если база пуста,
+    при открытии в нее переносятся данные из json_path.
+    """
+
+    def __init__(self, db_path: str, json_path: str | None = None) -> None:
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS videos (
+                url TEXT PRIMARY KEY,
+                title TEXT NOT NULL DEFAULT '',
+                description TEXT NOT NULL DEFAULT '',
+                audio_path TEXT NOT NULL DEFAULT '',
+                text TEXT NOT NULL DEFAULT '[]',
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+        if json_path and os.path.exists(json_path) and not len(self):
+            self.migrate_from_json(json_path)
+
+    def __len__(self) -> int:
+        with self._lock:
+            count: int = self._conn.execute("SELECT COUNT(*) FROM videos").fetchone()[0]
+        return count
+
+    @staticmethod
+    def _to_item(row: tuple[Any, ...]) -> VideoItem:
+        url, title, description, audio_path, text = row
+        return {
+            "url": [url],
+            "title": [title],
+            "description": [description],
+            "audio_path": [audio_path],
+            "text": json.loads(text),
+        }
+
+    def get(self, url: str) -> VideoItem | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT url, title, description, audio_path, text FROM videos WHERE url = ?", (url,)
+            ).fetchone()
+        return self._to_item(row) if row else None
+
+    def get_many(self, urls: Iterable[str]) -> dict[str, VideoItem]:
+        items = {}
+        for url in urls:
+            item = self.get(url)
+            if item:
+                items[url] = item
+        return items
+
+    def all(self) -> list[VideoItem]:
+        """Все записи в порядке добавления"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT url, title, description, audio_path, text FROM videos ORDER BY rowid"
+            ).fetchall()
+        return [self._to_item(row) for row in rows]
+
+    def upsert(self, url: str, **values: str | list[str]) -> None:
+        """Добавляет видео или обновляет переданные поля (title, description, audio_path, text)"""
+        unknown = set(values) - set(FIELDS[1:]) - {"text"}
+        if unknown:
+            raise ValueError(f"Unknown video fields: {sorted(unknown)}")
+        columns = {k: json.dumps(v, ensure_ascii=False) if k == "text" else v for k, v in values.items()}
+        names = ["url", *columns, "updated_at"]
+        updates = ", ".join(f"{name} = excluded.{name}" for name in names[1:])
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT INTO videos ({', '.join(names)}) VALUES ({', '.join('?' * len(names))}) "
+                f"ON CONFLICT(url) DO UPDATE SET {updates}",
+                (url, *columns.values(), time.time()),
+            )
+
+    def export_json(self, json_path: str) -> None:
+        """Выгружает данные в формате video_info.json; файл заменяется атомарно"""
+        tmp_path = f"{json_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.all(), f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, json_path)
+
+    def migrate_from_json(self, json_path: str) -> int:
+        """Однократный перенос данных из video_info.json"""
+        with open(json_path, "r", encoding="utf-8") as f:
+            items: list[VideoItem] = json.load(f)
+        for item in items:
+            self.upsert(
+                item["url"][0],
+                **{key: item[key][0] for key in FIELDS[1:] if item.get(key)},
+                text=item.get("text", []),
+            )
+        logging.info("Migrated %s videos from %s to %s", len(items), json_path, self.db_path)
+        return len(items)
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Перенос video_info.json в SQLite-хранилище метаданных")
+    arg_parser.add_argument("json_path", nargs="?", default="data/video_info.json")
+    arg_parser.add_argument("db_path", nargs="?")
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(module)s: %(message)s")
+    store = VideoMetadataStore(args.db_path or default_db_path(args.json_path))
+    store.migrate_from_json(args.json_path)
@@ -1,32 +1,44 @@
-import json
 import logging
 import os
-import subprocess
+import random
+import shutil
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from dataclasses import field
 from logging.handlers import RotatingFileHandler
+from typing import Any
 
-import httpx
 import openai
 import yt_dlp
 from dotenv import load_dotenv
 from openai import OpenAI
 
+from app.http_clients import HttpClientConfig
+from app.http_clients import PoolStats
+from app.http_clients import create_client
+from data_pipelines.audio_preprocessing import preprocess_audio
+from data_pipelines.metadata_store import VideoMetadataStore
+from data_pipelines.metadata_store import default_db_path
+
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(module)s: %(message)s",
-    handlers=[
-        RotatingFileHandler(
-            os.path.join(os.path.dirname(__file__), "../app/logs/app.log"), maxBytes=5000000, backupCount=2
-        ),
-        logging.StreamHandler(),
-    ],
-)
 load_dotenv()
-PROXY = os.getenv("PROXY")
-http_client = httpx.Client(proxies=PROXY)
-client = OpenAI(http_client=http_client)
+TRANSCRIPTION_TIMEOUT = float(os.getenv("TRANSCRIPTION_TIMEOUT", "600"))  # секунд на ответ Whisper по одному сегменту
+http_config = HttpClientConfig.from_env()
+http_stats = PoolStats()
+http_client = create_client(http_config, http_stats)
+client = OpenAI(http_client=http_client, timeout=http_config.timeout(read=TRANSCRIPTION_TIMEOUT))
+
+# Форматы, которые скачивает yt-dlp (bestaudio) или сохранял прежний пайплайн
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".m4a", ".webm", ".opus", ".ogg")
+
+# Ошибки API, после которых запрос имеет смысл повторить
+TRANSIENT_ERRORS = (
+    openai.APIConnectionError,  # в т.ч. APITimeoutError
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
 
 
 @dataclass()
@@ -35,34 +47,58 @@ class ParserTranscribe:
     A pipeline for downloading and transcribing audio from YouTube videos.
     Has two public methods:
     - get_transcribe_video(url_of_video: str) - downloads and transcribes audio
-    and saves data to a json file
+    and saves data to the metadata store
     - get_video_urls(channel_url: str) - get list of all video urls from youtube-channel
+
+    The downloaded audio is kept in its original codec and converted once to
+    16 kHz mono at a low bitrate with long pauses trimmed, then cut on pauses
+    with stream copy (audio_preprocessing.preprocess_audio).
+    Segments are transcribed concurrently (at most max_workers Whisper requests
+    at a time, shared by all videos of the instance). Every finished segment is
+    checkpointed to <audio>_segments/segmentNNN.txt, so a crashed run resumes
+    without re-downloading the audio or re-transcribing finished segments.
     """
 
     path_to_save: str  # Путь к папке с аудио
-    json_video_info_path: str  # Путь к json-файлу
-    segment_time: int = 900  # Длительность сегмента при нарезке аудио
+    json_video_info_path: str  # Путь к json-файлу (выгрузка метаданных и источник для миграции)
+    segment_time: int = 900  # Максимальная длительность сегмента при нарезке аудио (режется по паузам)
+    sample_rate: int = 16000  # Частота дискретизации аудио для Whisper
+    audio_bitrate: str = "32k"  # Битрейт сегментов
+    min_silence: float = 1.0  # Паузы длиннее, секунд, укорачиваются
+    split_workers: int = 4  # Процессов ffmpeg при нарезке сегментов
+    baseline_sample: float | None = 0  # Секунд аудио для замера прежнего пути в отчете (None - весь файл, 0 - нет)
     max_attempts: int = 5  # максимальное количество попыток
-    delay: int = 10  # задержка между попытками в секундах
+    delay: int = 10  # базовая задержка между попытками в секундах, растет экспоненциально
+    max_delay: int = 300  # максимальная задержка между попытками в секундах
+    max_workers: int = 4  # максимальное число одновременных запросов к Whisper
+    metadata_db_path: str | None = None  # SQLite-хранилище метаданных (по умолчанию рядом с json)
+    transcription_client: Any = None  # клиент OpenAI API (по умолчанию модульный client)
+    _whisper_slots: threading.BoundedSemaphore = field(init=False, repr=False)
+    _store: VideoMetadataStore = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self._whisper_slots = threading.BoundedSemaphore(self.max_workers)
+        if self.transcription_client is None:
+            self.transcription_client = client
+        self._store = VideoMetadataStore(
+            self.metadata_db_path or default_db_path(self.json_video_info_path), self.json_video_info_path
+        )
+
+    @property
+    def store(self) -> VideoMetadataStore:
+        return self._store
 
     def _get_video_info(self, video_url: str) -> dict[str, str | None]:
         ydl_opts = {
             "format": "bestaudio/best",
             "outtmpl": os.path.join(self.path_to_save, "%(id)s.%(ext)s"),
             "quiet": True,
-            "postprocessors": [
-                {
-                    "key": "FFmpegExtractAudio",
-                    "preferredcodec": "mp3",
-                    "preferredquality": "192",
-                }
-            ],
         }
 
+        # Аудио сохраняется как есть, без перекодирования: его один раз пережимает preprocess_audio
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
             info = ydl.extract_info(video_url, download=True)
-
-        audio_path = os.path.join(self.path_to_save, f"{info['id']}.mp3")
+            audio_path = ydl.prepare_filename(info)
 
         return {
             "url": video_url,
@@ -73,78 +109,32 @@ class ParserTranscribe:
 
     def _download_channel_audio_track(self, url_of_video: str) -> str:
         """
-        Download audio track from YouTube-video and save info to json.
+        Download audio track from YouTube-video and save info to the metadata store.
         Return path to downloaded audio track
         """
-        if os.path.exists(self.json_video_info_path):
-            with open(self.json_video_info_path, "r", encoding="utf-8") as f:
-                video_info = json.load(f)
-        else:
-            video_info = []
+        known = self._store.get(url_of_video)
+        if known and os.path.exists(known["audio_path"][0]):
+            logging.info("Audio is already downloaded: %s", known["audio_path"][0])
+            return known["audio_path"][0]
+
         url_info = self._get_video_info(url_of_video)
-        # print(f"Path to mp4 file: {url_info['audio_path']}\n")
         logging.info("Path to mp4 file: %s\n", url_info['audio_path'])
 
-        video_info_item: dict[str, list[str]] = {
-            "url": [],
-            "title": [],
-            "description": [],
-            "audio_path": [],
-            "text": [],
-        }
-        for key, value in url_info.items():
-            video_info_item[key].append(value if value else "")
-
-        # Проверяем, что такого url в json нет
-        exist_url = True
-        if video_info:
-            for itm in video_info:
-                exist_url = exist_url and (itm["url"][0] != video_info_item["url"][0])
-        if exist_url:
-            video_info.append(video_info_item)
-
-        with open(self.json_video_info_path, "w", encoding="utf-8") as f:
-            json.dump(video_info, f, ensure_ascii=False, indent=4)
+        self._store.upsert(
+            url_of_video,
+            title=url_info["title"] or "",
+            description=url_info["description"] or "",
+            audio_path=url_info["audio_path"] or "",
+        )
+        return url_info["audio_path"] or ""
 
-        return video_info_item["audio_path"][0]
-
-    def _split_audio(self, file_path: str, output_pattern: str) -> None:
-        """
-        Разделяет аудиофайл на сегменты с использованием утилиты ffmpeg.
-
-        Parameters
-        ----------
-        file_path : str
-            Путь к исходному аудиофайлу, который необходимо разделить.
-        output_pattern : str
-            Шаблон имени выходного файла. Должен содержать %03d для нумерации сегментов
-            (например, "output_segment%03d.mp3").
-
-        Returns
-        -------
-        None
-
-        """
-        cmd = [
-            "ffmpeg",
-            "-i",
-            file_path,
-            "-f",
-            "segment",
-            "-segment_time",
-            str(self.segment_time),
-            "-c:a",
-            "libmp3lame",
-            output_pattern,
-        ]
-        subprocess.run(cmd, check=False)
-
-    def _transcribe_with_whisper(self, audio_path: str) -> str | None:
+    def _transcribe_with_whisper(self, audio_path: str) -> str:
         """
         Транскрибирует аудиофайл с использованием модели Whisper от OpenAI.
 
-        Функция пытается транскрибировать аудио многократно
-        (до max_attempts раз) в случае ошибок API.
+        При временных ошибках API (таймауты, обрывы соединения, rate limit, 5xx)
+        повторяет запрос до max_attempts раз с экспоненциально растущей
+        задержкой со случайным разбросом.
 
         Parameters
         ----------
@@ -158,66 +148,106 @@ class ParserTranscribe:
 
         Raises
         ------
-        openai.APITimeoutError
-            Если после всех попыток транскрибировать аудио возникает ошибка.
+        openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError
+            Если ошибка повторяется после всех попыток.
 
         """
 
         for attempt in range(self.max_attempts):
             try:
-                with open(audio_path, "rb") as audio_file:
-                    transcript = client.audio.transcriptions.create(
-                        file=audio_file, model="whisper-1", response_format="text", language=["ru"]
+                with self._whisper_slots, open(audio_path, "rb") as audio_file:
+                    transcript = self.transcription_client.audio.transcriptions.create(
+                        file=audio_file, model="whisper-1", response_format="text", language="ru"
                     )
                 return transcript if transcript else ''
-            except openai.APITimeoutError as e:
-                print(f"Ошибка при обращении к API (попытка {attempt + 1}): {e}")
-                if attempt < self.max_attempts - 1:  # если это не последняя попытка
-                    print(f"Ожидание {self.delay} секунд перед следующей попыткой...")
-                    time.sleep(self.delay)
-                else:
-                    print("Превышено максимальное количество попыток.")
-                    raise  # повторно вызываем исключение, чтобы сообщить о проблеме
-        return None
-
-    def _get_transcribe(self, audio_path: str) -> None:
+            except TRANSIENT_ERRORS as e:
+                if attempt == self.max_attempts - 1:
+                    logging.error("Превышено максимальное количество попыток для %s", audio_path)
+                    raise
+                delay = min(self.max_delay, self.delay * 2**attempt) * random.uniform(0.5, 1.5)
+                logging.warning(
+                    "Ошибка при обращении к API (попытка %s): %s. Повтор через %.1f с", attempt + 1, e, delay
+                )
+                time.sleep(delay)
+        raise RuntimeError("max_attempts must be positive")
+
+    def _transcribe_segment(self, segment_path: str) -> str:
+        """Транскрибирует сегмент, если для него еще нет сохраненного результата"""
+        checkpoint_path = os.path.splitext(segment_path)[0] + ".txt"
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, "r", encoding="utf-8") as f:
+                return f.read()
+
+        logging.info("Transcribe segment %s", os.path.basename(segment_path))
+        text = self._transcribe_with_whisper(segment_path)
+        with open(checkpoint_path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(checkpoint_path + ".tmp", checkpoint_path)
+        os.remove(segment_path)
+        return text
+
+    def _get_transcribe(self, audio_path: str, url_of_video: str) -> None:
         file_name = os.path.basename(audio_path)
 
-        if not file_name.endswith((".mp3", ".wav", ".m4a")):
+        if not file_name.endswith(AUDIO_EXTENSIONS):
             logging.warning("Unsupported audio format: %s", file_name)
             return
 
-        output_pattern = os.path.join(self.path_to_save, f"{file_name[:-4]}_segment%03d.mp3")
-
-        self._split_audio(audio_path, output_pattern)
-
-        transcriptions = []
-        segment_files = sorted(f for f in os.listdir(self.path_to_save) if f.startswith(file_name[:-4] + "_segment"))
-
-        for i, segment_file in enumerate(segment_files):
-            logging.info("Transcribe %s segment", i)
-            segment_path = os.path.join(self.path_to_save, segment_file)
-            transcriptions.append(self._transcribe_with_whisper(segment_path))
-            os.remove(segment_path)
-
+        # Сегменты и результаты их транскрибации - чекпоинт для возобновления после сбоя
+        segments_dir = os.path.join(self.path_to_save, f"{os.path.splitext(file_name)[0]}_segments")
+        split_done_path = os.path.join(segments_dir, ".split_done")
+        if not os.path.exists(split_done_path):
+            shutil.rmtree(segments_dir, ignore_errors=True)
+            os.makedirs(segments_dir)
+            preprocess_audio(
+                audio_path,
+                segments_dir,
+                segment_time=self.segment_time,
+                sample_rate=self.sample_rate,
+                bitrate=self.audio_bitrate,
+                min_silence=self.min_silence,
+                workers=self.split_workers,
+                baseline_sample=self.baseline_sample,
+            )
+            open(split_done_path, "w").close()
+
+        segment_names = sorted(
+            {os.path.splitext(f)[0] for f in os.listdir(segments_dir) if f.endswith((".mp3", ".txt"))}
+        )
+        segment_paths = [os.path.join(segments_dir, f"{name}.mp3") for name in segment_names]
+
+        # Порядок результатов совпадает с порядком сегментов
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            transcriptions = list(executor.map(self._transcribe_segment, segment_paths))
+        logging.info(
+            "Transcribed %s segments of %s in %.1f s", len(segment_paths), file_name, time.perf_counter() - started
+        )
+
+        self._store.upsert(url_of_video, text=transcriptions)
+
+        shutil.rmtree(segments_dir)
         os.remove(audio_path)
 
-        with open(self.json_video_info_path, "r", encoding="utf-8") as f:
-            data_list = json.load(f)
-
-        for item in data_list:
-            if item["audio_path"][0] == audio_path:
-                item["text"] = transcriptions
-                break
-
-        with open(self.json_video_info_path, "w", encoding="utf-8") as f:
-            json.dump(data_list, f, ensure_ascii=False, indent=4)
-
     def get_transcribe_video(self, url_of_video: str) -> None:
         """Основная функция для полного запуска пайплайна транскрибации видео по ссылке"""
+        known = self._store.get(url_of_video)
+        if known and any(known["text"]):
+            logging.info("Video is already transcribed: %s", url_of_video)
+            return
         audio_path = self._download_channel_audio_track(url_of_video)
-        self._get_transcribe(audio_path)
+        self._get_transcribe(audio_path, url_of_video)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(module)s: %(message)s",
+        handlers=[
+            RotatingFileHandler(
+                os.path.join(os.path.dirname(__file__), "../app/logs/app.log"), maxBytes=5000000, backupCount=2
+            ),
+            logging.StreamHandler(),
+        ],
+    )
     parser = ParserTranscribe("../data/audio", "../data/video_info.json")
@@ -0,0 +1,341 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import tempfile
+import time
+from typing import Awaitable
+from typing import Callable
+from typing import Sequence
+
+from app.ann_index import IvfIndex
+from app.ann_index import build_ivf_index
+from app.ann_index import measure_recall
+from app.lexical_index import LexicalIndex
+from app.lexical_index import build_lexical_index
+from app.lexical_index import reciprocal_rank_fusion
+from app.quantization import QuantizedIndex
+from app.quantization import build_quantized_index
+from app.reranker import Reranker
+from app.vector_store import MmapQueryEngine
+from app.vector_store import MmapVectorStore
+from app.vector_store import convert_json_index
+from app.vector_store import write_mmap_index
+from evaluation.fakes import FakeLLM
+from evaluation.fakes import HashingEmbedder
+
+
+QUESTIONS_PATH = os.path.join(os.path.dirname(__file__), "questions.jsonl")
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+RECALL_AT = (1, 3, 5, 10)
+CANDIDATES = 10  # rows returned by every retriever, also the MRR cutoff
+RERANK_CANDIDATES = 30  # rows of every first-stage retriever passed to the reranker
+
+# question text, query embedding -> ranked index rows
+Retriever = Callable[[str, Sequence[float]], Awaitable[list[int]]]
+
+
+def make_questions(json_index: str, path: str, per_chunk: int = 2, words: int = 10, seed: int = 42) -> int:
+    """
+    Builds the stored question set: word windows cut from every chunk of the
+    index, each expected to retrieve the chunk it was cut from
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        convert_json_index(json_index, folder)
+        records = list(MmapVectorStore(folder).records())
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        for record in sorted(records, key=lambda r: r["id"]):
+            text_words = record["text"].split()
+            for _ in range(per_chunk):
+                start = rng.randrange(max(1, len(text_words) - words))
+                question = {
+                    "question": " ".join(text_words[start : start + words]),
+                    "node_id": record["id"],
+                    "url": record["metadata"].get("url", ""),
+                }
+                f.write(json.dumps(question, ensure_ascii=False) + "\n")
+    return len(records) * per_chunk
+
+
+def load_questions(path: str) -> list[dict[str, str]]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentiles(values: Sequence[float]) -> dict[str, float]:
+    ordered = sorted(values)
+    if not ordered:
+        return {}
+    result = {f"p{q}": ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))] for q in (50, 95, 99)}
+    result["mean"] = sum(ordered) / len(ordered)
+    return result
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kilobytes on Linux
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class Benchmark:
+    """
+    Offline retrieval benchmark over the shipped index.
+
+    Chunks of the llama_index JSON storage are converted to the mmap format and
+    re-embedded with the deterministic HashingEmbedder, so the stored questions
+    can be embedded the same way without network access. Every retriever in
+    `retrievers` is scored on the same questions.
+    """
+
+    def __init__(
+        self,
+        json_index: str,
+        folder: str,
+        embedder: HashingEmbedder,
+        lexical: bool = True,
+        ivf_nlist: int | None = None,
+        ivf_nprobe: int = 2,
+        int8_rescore: int = 4,
+    ) -> None:
+        self.embedder = embedder
+        self.timings: dict[str, float] = {}
+
+        started = time.perf_counter()
+        source_folder = os.path.join(folder, "source")
+        convert_json_index(json_index, source_folder)
+        records = list(MmapVectorStore(source_folder).records())
+        self.timings["load_seconds"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        index_folder = os.path.join(folder, "fake")
+        write_mmap_index(index_folder, records, embedder.get_text_embedding_batch([r["text"] for r in records]))
+        self.store = MmapVectorStore(index_folder)
+        self.query_engine = MmapQueryEngine(self.store, embedder)
+        self.timings["embed_seconds"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        build_ivf_index(index_folder, self.store.vectors, ivf_nlist)
+        self.ivf_index = IvfIndex(index_folder, self.store.vectors, nprobe=ivf_nprobe)
+        self.ivf_engine = MmapQueryEngine(self.store, embedder, searcher=self.ivf_index)
+        self.timings["ivf_seconds"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        build_quantized_index(index_folder, self.store.vectors)
+        self.int8_engine = MmapQueryEngine(
+            self.store, embedder, searcher=QuantizedIndex(index_folder, self.store.vectors, rescore=int8_rescore)
+        )
+        self.timings["int8_seconds"] = time.perf_counter() - started
+
+        self.retrievers: dict[str, Retriever] = {"vector": self._vector, "ivf": self._ivf, "int8": self._int8}
+        self.tokenize: Callable[[str], list[str]] | None = None
+        if lexical:
+            try:
+                # Mystem and the NLTK stopwords have to be installed locally
+                from app.utils import tokenize
+                from app.utils import tokenize_batch
+
+                started = time.perf_counter()
+                build_lexical_index(index_folder, tokenize_batch([r["text"] for r in records]))
+                self.lexical_index = LexicalIndex(index_folder)
+                self.tokenize = tokenize
+                self.timings["lexical_seconds"] = time.perf_counter() - started
+                self.retrievers.update(bm25=self._bm25, hybrid=self._hybrid)
+            except Exception as e:
+                logging.warning("Lexical retrievers are skipped: %r", e)
+        self.reranker = Reranker(self.store.vectors, self.lexical_index if self.tokenize else None)
+        self.retrievers["rerank"] = self._rerank
+
+    @property
+    def default_retriever(self) -> str:
+        """The retriever the bot uses with its default settings"""
+        return "rerank"
+
+    async def _vector(self, question: str, embedding: Sequence[float], top_k: int = CANDIDATES) -> list[int]:
+        return [node.row for node in self.query_engine.retrieve(embedding, top_k).source_nodes]
+
+    async def _ivf(self, question: str, embedding: Sequence[float]) -> list[int]:
+        return [node.row for node in self.ivf_engine.retrieve(embedding, CANDIDATES).source_nodes]
+
+    async def _int8(self, question: str, embedding: Sequence[float]) -> list[int]:
+        return [node.row for node in self.int8_engine.retrieve(embedding, CANDIDATES).source_nodes]
+
+    def ann_recall(self, questions: list[dict[str, str]]) -> list[dict[str, float]]:
+        """IVF recall@10 against the exact search on the question embeddings, for every nprobe"""
+        nprobes = sorted({1, 2, 4, 8, self.ivf_index.nlist} & set(range(1, self.ivf_index.nlist + 1)))
+        return measure_recall(
+            self.store.vectors,
+            self.ivf_index,
+            nprobes,
+            top_k=CANDIDATES,
+            queries=self.embedder.get_text_embedding_batch([q["question"] for q in questions]),
+        )
+
+    async def _bm25(self, question: str, embedding: Sequence[float], top_k: int = CANDIDATES) -> list[int]:
+        assert self.tokenize is not None
+        return [row for row, _ in self.lexical_index.search(self.tokenize(question), top_k)]
+
+    async def _hybrid(self, question: str, embedding: Sequence[float], top_k: int = CANDIDATES) -> list[int]:
+        rankings = [await self._vector(question, embedding, top_k), await self._bm25(question, embedding, top_k)]
+        return [row for row, _ in reciprocal_rank_fusion(rankings)[:top_k]]
+
+    async def _rerank(self, question: str, embedding: Sequence[float]) -> list[int]:
+        first_stage = self._hybrid if self.tokenize else self._vector
+        candidates = await first_stage(question, embedding, RERANK_CANDIDATES)
+        tokens = self.tokenize(question) if self.tokenize else None
+        return self.reranker.rerank(question, embedding, tokens, candidates)[:CANDIDATES]
+
+    async def quality(self, name: str, questions: list[dict[str, str]]) -> dict[str, object]:
+        """recall@k and MRR by chunk, recall@3 by video, per-query retrieval latency"""
+        retriever = self.retrievers[name]
+        hits = {k: 0 for k in RECALL_AT}
+        video_hits = 0
+        reciprocal_ranks = 0.0
+        latencies = []
+        for question in questions:
+            embedding = self.embedder.get_query_embedding(question["question"])
+            started = time.perf_counter()
+            rows = await retriever(question["question"], embedding)
+            latencies.append((time.perf_counter() - started) * 1000)
+            ids = [self.store.ids[row] for row in rows]
+            if question["node_id"] in ids:
+                rank = ids.index(question["node_id"]) + 1
+                reciprocal_ranks += 1 / rank
+                for k in RECALL_AT:
+                    hits[k] += rank <= k
+            urls = [self.store.record(row)["metadata"].get("url") for row in rows[:3]]
+            video_hits += question["url"] in urls
+        n = len(questions)
+        return {
+            **{f"recall@{k}": hits[k] / n for k in RECALL_AT},
+            "mrr": reciprocal_ranks / n,
+            "video_recall@3": video_hits / n,
+            "latency_ms": percentiles(latencies),
+        }
+
+    async def throughput(
+        self, questions: list[dict[str, str]], llm: FakeLLM, concurrency: int, repeats: int
+    ) -> dict[str, object]:
+        """End-to-end answers (embedding, retrieval, judge, generation) under concurrent load"""
+        retriever = self.retrievers[self.default_retriever]
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies: list[float] = []
+
+        async def answer(question: str) -> None:
+            async with semaphore:
+                started = time.perf_counter()
+                embedding = await self.embedder.aget_query_embedding(question)
+                rows = (await retriever(question, embedding))[:3]
+                context = " ".join(node.text for node in self.query_engine.nodes(embedding, rows))
+                if await llm.judge(context, question):
+                    await llm.complete(f"{context}\n\n{question}")
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(answer(q["question"]) for q in questions * repeats))
+        elapsed = time.perf_counter() - started
+        return {
+            "retriever": self.default_retriever,
+            "concurrency": concurrency,
+            "requests": len(latencies),
+            "seconds": elapsed,
+            "qps": len(latencies) / elapsed,
+            "latency_ms": percentiles(latencies),
+        }
+
+
+async def run(args: argparse.Namespace) -> dict[str, object]:
+    questions = load_questions(args.questions)
+    with tempfile.TemporaryDirectory() as folder:
+        benchmark = Benchmark(
+            args.index,
+            folder,
+            HashingEmbedder(args.dim, delay=args.embed_delay),
+            lexical=not args.no_lexical,
+            ivf_nlist=args.ivf_nlist,
+            ivf_nprobe=args.ivf_nprobe,
+            int8_rescore=args.int8_rescore,
+        )
+        retrievers = {name: await benchmark.quality(name, questions) for name in benchmark.retrievers}
+        ann = {"nlist": benchmark.ivf_index.nlist, "recall": benchmark.ann_recall(questions)}
+        throughput = await benchmark.throughput(
+            questions, FakeLLM(delay=args.llm_delay), args.concurrency, args.repeats
+        )
+        chunks = benchmark.store.count
+        timings = benchmark.timings
+    return {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "index": {"chunks": chunks, "questions": len(questions), **timings},
+        "retrievers": retrievers,
+        "ann": ann,
+        "throughput": throughput,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def compare(result: dict[str, object], baseline: dict[str, object], max_drop: float) -> list[str]:
+    """Quality metrics that dropped by more than max_drop against the baseline run"""
+    regressions = []
+    current, previous = result["retrievers"], baseline["retrievers"]
+    assert isinstance(current, dict) and isinstance(previous, dict)
+    for name, metrics in previous.items():
+        for metric, value in metrics.items():
+            if metric == "latency_ms" or name not in current:
+                continue
+            if current[name][metric] < value - max_drop:
+                regressions.append(f"{name} {metric}: {value:.3f} -> {current[name][metric]:.3f}")
+    return regressions
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Offline retrieval benchmark over the shipped index")
+    arg_parser.add_argument("--index", default="data/index_storage_1024", help="llama_index JSON storage folder")
+    arg_parser.add_argument("--questions", default=QUESTIONS_PATH)
+    arg_parser.add_argument("--make-questions", action="store_true", help="rebuild the question set and exit")
+    arg_parser.add_argument("--output", help="result JSON, evaluation/results/<commit>.json by default")
+    arg_parser.add_argument("--baseline", help="result JSON of an earlier run to check for regressions")
+    arg_parser.add_argument("--max-drop", type=float, default=0.01, help="allowed recall/MRR drop vs the baseline")
+    arg_parser.add_argument("--dim", type=int, default=512, help="fake embedding dimension")
+    arg_parser.add_argument("--ivf-nlist", type=int, default=4, help="IVF lists of the ivf retriever")
+    arg_parser.add_argument("--ivf-nprobe", type=int, default=2, help="IVF lists probed by the ivf retriever")
+    arg_parser.add_argument("--int8-rescore", type=int, default=4, help="candidates per top_k re-scored in float")
+    arg_parser.add_argument("--no-lexical", action="store_true", help="skip BM25 and hybrid retrievers")
+    arg_parser.add_argument("--concurrency", type=int, default=16)
+    arg_parser.add_argument("--repeats", type=int, default=5, help="passes over the questions in the load test")
+    arg_parser.add_argument("--embed-delay", type=float, default=0.05, help="fake embedding API latency, seconds")
+    arg_parser.add_argument("--llm-delay", type=float, default=0.2, help="fake LLM latency per call, seconds")
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(module)s: %(message)s")
+
+    if args.make_questions:
+        count = make_questions(args.index, args.questions)
+        logging.info("Wrote %s questions to %s", count, args.questions)
+        raise SystemExit(0)
+
+    result = asyncio.run(run(args))
+    output = args.output or os.path.join(RESULTS_DIR, f"{result['commit']}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(json.dumps({k: result[k] for k in ("index", "retrievers", "ann", "throughput", "peak_rss_mb")}, indent=2))
+    logging.info("Results written to %s", output)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.max_drop)
+        for regression in regressions:
+            logging.error("Regression: %s", regression)
+        raise SystemExit(1 if regressions else 0)
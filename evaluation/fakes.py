@@ -0,0 +1,100 @@
+import asyncio
+import hashlib
+import re
+from types import SimpleNamespace
+from typing import Any
+from typing import AsyncIterator
+from typing import List
+from typing import Sequence
+
+import numpy as np
+
+
+_word_regex = re.compile(r"\w+")
+
+
+class HashingEmbedder:
+    """
+    Deterministic offline embedder: signed feature hashing of words and
+    character trigrams, L2-normalized. Texts sharing words or word stems
+    get close vectors, so retrieval quality can be measured without the API.
+
+    `delay` seconds are awaited on the async path to imitate an API round-trip.
+    """
+
+    def __init__(self, dim: int = 512, delay: float = 0.0) -> None:
+        self.dim = dim
+        self.delay = delay
+
+    def _features(self, text: str) -> list[str]:
+        words = _word_regex.findall(text.lower())
+        trigrams = [f"#{word[i : i + 3]}" for word in words for i in range(max(1, len(word) - 2))]
+        return words + trigrams
+
+    def embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in self._features(text):
+            digest = hashlib.md5(feature.encode("utf-8")).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dim
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def get_text_embedding_batch(self, texts: Sequence[str]) -> List[List[float]]:
+        return [self.embed(text) for text in texts]
+
+    def get_query_embedding(self, query: str) -> List[float]:
+        return self.embed(query)
+
+    async def aget_query_embedding(self, query: str) -> List[float]:
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return self.embed(query)
+
+
+class FakeLLM:
+    """
+    Deterministic stand-in for the chat model: the judge says YES when enough
+    question words occur in the context, the answer is cut from the prompt.
+    `delay` seconds are awaited per call to imitate generation time.
+
+    `chat.completions.create` answers the bot's judge and answer prompts the way
+    AsyncOpenAI does, so the bot itself can run on the fake.
+    """
+
+    def __init__(self, delay: float = 0.0, judge_overlap: float = 0.3) -> None:
+        self.delay = delay
+        self.judge_overlap = judge_overlap
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def judge(self, context: str, question: str) -> bool:
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        words = set(_word_regex.findall(question.lower()))
+        if not words:
+            return False
+        found = words & set(_word_regex.findall(context.lower()))
+        return len(found) / len(words) >= self.judge_overlap
+
+    async def complete(self, prompt: str) -> str:
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        words = prompt.split()
+        return " ".join(words[-40:])
+
+    async def create(self, messages: list[dict[str, str]], stream: bool = False, **options: Any) -> Any:
+        prompt = messages[-1]["content"]
+        before, _, question = prompt.rpartition("Вопрос:")
+        context = before.split("---")[1] if before.count("---") >= 2 else before
+        if "YES или NO" in prompt:
+            text = "YES" if await self.judge(context, question.split("Достаточно")[0]) else "NO"
+        else:
+            text = await self.complete(context)
+        if stream:
+            return self._stream(text)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=None)
+
+    @staticmethod
+    async def _stream(text: str) -> AsyncIterator[Any]:
+        for word in text.split(" "):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=f"{word} "))])
@@ -0,0 +1,181 @@
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any
+from typing import Callable
+
+import httpx
+import openai
+import pytest
+
+
+os.environ.setdefault("OPENAI_API_KEY", "test")  # the module creates its default client on import
+
+from data_pipelines import parser_transcribe  # noqa: E402
+from data_pipelines.parser_transcribe import ParserTranscribe  # noqa: E402
+
+
+URL = "https://www.youtube.com/watch?v=test"
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/audio/transcriptions")
+
+
+class FakeTranscriptionClient:
+    """Stand-in for OpenAI().audio.transcriptions: answers every request with respond(segment file name)"""
+
+    def __init__(self, respond: Callable[[str], str]) -> None:
+        self.respond = respond
+        self.calls: list[str] = []
+        self._lock = threading.Lock()
+        self.audio = SimpleNamespace(transcriptions=self)
+
+    def create(self, file: Any, model: str, response_format: str, language: str) -> str:
+        name = os.path.basename(file.name)
+        with self._lock:
+            self.calls.append(name)
+        return self.respond(name)
+
+
+def make_parser(tmp_path: Any, client: FakeTranscriptionClient, **kwargs: Any) -> ParserTranscribe:
+    audio_dir = tmp_path / "audio"
+    audio_dir.mkdir(exist_ok=True)
+    return ParserTranscribe(
+        str(audio_dir),
+        str(tmp_path / "video_info.json"),
+        metadata_db_path=str(tmp_path / "video_info.sqlite3"),
+        transcription_client=client,
+        **kwargs,
+    )
+
+
+def fake_preprocess(count: int, calls: list[str] | None = None) -> Callable[..., None]:
+    """Writes `count` segments the way preprocess_audio names them"""
+
+    def preprocess(source: str, segments_dir: str, **_: Any) -> None:
+        if calls is not None:
+            calls.append(source)
+        for i in range(count):
+            with open(os.path.join(segments_dir, f"segment{i:03d}.mp3"), "wb") as f:
+                f.write(b"mp3")
+
+    return preprocess
+
+
+def downloaded_audio(parser: ParserTranscribe) -> str:
+    path = os.path.join(parser.path_to_save, "test.webm")
+    with open(path, "wb") as f:
+        f.write(b"webm")
+    return path
+
+
+@pytest.fixture
+def sleeps(monkeypatch: pytest.MonkeyPatch) -> list[float]:
+    """Back-off delays requested by the parser, without waiting and without jitter"""
+    delays: list[float] = []
+    monkeypatch.setattr(parser_transcribe.time, "sleep", delays.append)
+    monkeypatch.setattr(parser_transcribe.random, "uniform", lambda low, high: 1.0)
+    return delays
+
+
+def test_retries_transient_errors_with_exponential_back_off(tmp_path: Any, sleeps: list[float]) -> None:
+    errors = [
+        openai.APITimeoutError(REQUEST),
+        openai.RateLimitError("rate limit", response=httpx.Response(429, request=REQUEST), body=None),
+        openai.InternalServerError("server error", response=httpx.Response(503, request=REQUEST), body=None),
+    ]
+
+    def respond(_: str) -> str:
+        if errors:
+            raise errors.pop(0)
+        return "текст"
+
+    client = FakeTranscriptionClient(respond)
+    parser = make_parser(tmp_path, client, delay=10, max_delay=30)
+    segment = tmp_path / "segment000.mp3"
+    segment.write_bytes(b"mp3")
+
+    assert parser._transcribe_with_whisper(str(segment)) == "текст"
+    assert len(client.calls) == 4
+    assert sleeps == [10, 20, 30]  # doubled every attempt, capped by max_delay
+
+
+def test_gives_up_after_max_attempts(tmp_path: Any, sleeps: list[float]) -> None:
+    def respond(_: str) -> str:
+        raise openai.APIConnectionError(request=REQUEST)
+
+    client = FakeTranscriptionClient(respond)
+    parser = make_parser(tmp_path, client, max_attempts=3)
+    segment = tmp_path / "segment000.mp3"
+    segment.write_bytes(b"mp3")
+
+    with pytest.raises(openai.APIConnectionError):
+        parser._transcribe_with_whisper(str(segment))
+    assert len(client.calls) == 3
+    assert len(sleeps) == 2
+
+
+def test_does_not_retry_other_errors(tmp_path: Any, sleeps: list[float]) -> None:
+    def respond(_: str) -> str:
+        raise openai.BadRequestError("bad file", response=httpx.Response(400, request=REQUEST), body=None)
+
+    client = FakeTranscriptionClient(respond)
+    parser = make_parser(tmp_path, client)
+    segment = tmp_path / "segment000.mp3"
+    segment.write_bytes(b"mp3")
+
+    with pytest.raises(openai.BadRequestError):
+        parser._transcribe_with_whisper(str(segment))
+    assert len(client.calls) == 1
+    assert sleeps == []
+
+
+def test_transcriptions_keep_segment_order(tmp_path: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(parser_transcribe, "preprocess_audio", fake_preprocess(12))
+
+    def respond(name: str) -> str:
+        time.sleep(random.uniform(0, 0.02))  # segments finish out of order
+        return f"текст {name}"
+
+    client = FakeTranscriptionClient(respond)
+    parser = make_parser(tmp_path, client, max_workers=4)
+    audio_path = downloaded_audio(parser)
+
+    parser._get_transcribe(audio_path, URL)
+
+    item = parser.store.get(URL)
+    assert item is not None
+    assert item["text"] == [f"текст segment{i:03d}.mp3" for i in range(12)]
+    assert not os.path.exists(audio_path)
+    assert not os.path.exists(os.path.join(parser.path_to_save, "test_segments"))
+
+
+def test_resumes_from_checkpoints_after_a_crash(tmp_path: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    preprocess_calls: list[str] = []
+    monkeypatch.setattr(parser_transcribe, "preprocess_audio", fake_preprocess(6, preprocess_calls))
+
+    def crash_on_segment_3(name: str) -> str:
+        if name == "segment003.mp3":
+            raise RuntimeError("process killed")
+        return f"текст {name}"
+
+    parser = make_parser(tmp_path, FakeTranscriptionClient(crash_on_segment_3), max_workers=2)
+    audio_path = downloaded_audio(parser)
+    with pytest.raises(RuntimeError):
+        parser._get_transcribe(audio_path, URL)
+
+    segments_dir = os.path.join(parser.path_to_save, "test_segments")
+    assert sorted(f for f in os.listdir(segments_dir) if f.endswith(".txt")) == [
+        f"segment{i:03d}.txt" for i in (0, 1, 2, 4, 5)
+    ]
+    assert os.path.exists(audio_path)
+
+    client = FakeTranscriptionClient(lambda name: f"текст {name}")
+    parser = make_parser(tmp_path, client, max_workers=2)
+    parser._get_transcribe(audio_path, URL)
+
+    assert preprocess_calls == [audio_path]  # the audio is split only once
+    assert client.calls == ["segment003.mp3"]  # finished segments are read from their checkpoints
+    item = parser.store.get(URL)
+    assert item is not None
+    assert item["text"] == [f"текст segment{i:03d}.mp3" for i in range(6)]
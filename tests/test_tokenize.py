@@ -0,0 +1,90 @@
+import re
+from collections import Counter
+from string import punctuation
+from typing import Any
+
+import pytest
+
+
+try:
+    from app import utils
+except LookupError:  # utils loads the NLTK stopwords on import
+    pytest.skip("NLTK stopwords are not downloaded", allow_module_level=True)
+
+
+LEMMAS = {
+    "лекции": "лекция",
+    "трансформеры": "трансформер",
+    "работает": "работать",
+    "такое": "такой",
+    "года": "год",
+    "переменные": "переменная",
+}
+
+# (query, tokens of the new tokenizer, tokens only the old preprocess_text kept, tokens only the new one keeps)
+CASES = [
+    ("Что такое RAG?", ["rag"], [], []),
+    ("Как работает attention?!", ["работать", "attention"], ["?!"], []),
+    ("Лекции про трансформеры — где посмотреть?", ["лекция", "трансформер", "посмотреть"], [" — "], []),
+    ("Ссылка на www.youtube.com/watch", ["ссылка", "youtube", "com", "watch"], ["www"], []),
+    ("https://itmo.ru/курс 2024 года", ["itmo", "ru", "курс", "год"], [], []),
+    ("Градиентный спуск, SGD и Adam...", ["градиентный", "спуск", "sgd", "adam"], ["..."], []),
+    ("snake_case переменные", ["snake_case", "переменная"], ["snake", "case"], ["snake_case"]),
+]
+
+
+class FakeMystem:
+    """Splits text the way Mystem does: letter runs are analyzed words, digits and other runs pass through"""
+
+    def analyze(self, text: str) -> list[dict[str, Any]]:
+        items: list[dict[str, Any]] = []
+        for match in re.finditer(r"[^\W\d_]+|\d+|[\W_]+", text):
+            token = match.group()
+            if token[0].isalpha():
+                analysis = [{"lex": LEMMAS.get(token, token)}] if re.match("[а-яё]", token) else []
+                items.append({"analysis": analysis, "text": token})
+            else:
+                items.append({"text": token})
+        items.append({"text": "\n"})
+        return items
+
+    def lemmatize(self, text: str) -> list[str]:
+        return [item["analysis"][0]["lex"] if item.get("analysis") else item["text"] for item in self.analyze(text)]
+
+
+def old_preprocess_text(mystem: FakeMystem, text: str) -> list[str]:
+    """preprocess_text before the Lemmatizer: Mystem over the whole text, punctuation filtered afterwards"""
+    return [
+        token
+        for token in mystem.lemmatize(text.lower())
+        if token not in utils.rus_stopwords
+        and token != " "
+        and token.strip() not in punctuation
+        and token != 'https'
+        and token != '://'
+        and not token.isdigit()
+    ]
+
+
+@pytest.fixture
+def lemmatizer(monkeypatch: pytest.MonkeyPatch) -> utils.Lemmatizer:
+    monkeypatch.setattr(utils, "_worker_mystem", FakeMystem())
+    return utils.Lemmatizer(workers=0)
+
+
+@pytest.mark.parametrize("query, expected, old_only, new_only", CASES)
+def test_tokens_against_old_preprocess_text(
+    lemmatizer: utils.Lemmatizer, query: str, expected: list[str], old_only: list[str], new_only: list[str]
+) -> None:
+    new = lemmatizer.tokenize_batch([query])[0]
+    old = old_preprocess_text(FakeMystem(), query)
+
+    assert new == expected
+    # The old filter compared whole non-word runs with string.punctuation, so runs like "?!" leaked into the tokens
+    assert list((Counter(old) - Counter(new)).elements()) == old_only
+    assert list((Counter(new) - Counter(old)).elements()) == new_only
+
+
+def test_batch_matches_single_queries(lemmatizer: utils.Lemmatizer) -> None:
+    queries = [query for query, *_ in CASES]
+    assert lemmatizer.tokenize_batch(queries) == [expected for _, expected, *_ in CASES]